@@ -1,10 +1,16 @@
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
 import argparse
+import copy
+import gc
+import hashlib
+import json
 import logging
+import math
 import os
 import sys
 import warnings
 from datetime import datetime
+from functools import partial
 
 warnings.filterwarnings('ignore')
 
@@ -15,10 +21,37 @@ import torch.distributed as dist
 from PIL import Image
 
 import wan
-from wan.configs import MAX_AREA_CONFIGS, SIZE_CONFIGS, SUPPORTED_SIZES, WAN_CONFIGS
+from wan.configs import (
+    FEW_STEP_PRESETS,
+    MAX_AREA_CONFIGS,
+    SIZE_CONFIGS,
+    SUPPORTED_SIZES,
+    WAN_CONFIGS,
+)
 from wan.distributed.util import init_distributed_group
+from wan.server import (
+    InferenceWorker,
+    Job,
+    JobCancelled,
+    JobSuspended,
+    serve,
+    submit,
+)
+from wan.utils.guidance import GuidanceInterval
+from wan.utils.preview import LatentPreviewer
 from wan.utils.prompt_extend import DashScopePromptExpander, QwenPromptExpander
-from wan.utils.utils import save_video, str2bool
+from wan.utils.sampling_checkpoint import (
+    PreemptibleSampling,
+    SamplingCheckpoint,
+    SamplingInterrupted,
+)
+from wan.utils.utils import (
+    load_video,
+    save_image,
+    save_video,
+    save_video_stream,
+    str2bool,
+)
 try:
     from wan.utils.utils import merge_video_audio
 except ImportError:
@@ -50,6 +83,25 @@ EXAMPLE_PROMPT = {
 }
 
 
+# arguments the pipeline is built from, a server job changing one reloads it
+_PIPELINE_ARGS = ("task", "ckpt_dir", "t5_fsdp", "dit_fsdp", "ulysses_size",
+                  "t5_cpu", "t5_int8", "t5_verify", "convert_model_dtype",
+                  "vae_parallel",
+                  "vae_dtype", "vae_channels_last", "vae_min_psnr",
+                  "vae_tiling", "vae_tile_size", "vae_segments",
+                  "vae_segment_warmup", "vae_segment_devices",
+                  "vae_segment_check")
+_SERVER_ARGS = ("server", "submit", "server_address", "batch_size",
+                "batch_tokens", "batch_wait")
+_PROMPT_FILE_ARGS = ("prompt_file", "queue_file")
+# arguments that may differ between the jobs of a server batch
+_BATCH_ROW_ARGS = ("prompt", "base_seed", "save_file", "preview_dir",
+                   "preview_interval")
+# paths a submitted job sends absolute, the server runs elsewhere
+_PATH_ARGS = ("ckpt_dir", "image", "audio", "pose_video", "init_video",
+              "save_file", "preview_dir", "sampling_checkpoint")
+
+
 def _validate_args(args):
     # Basic check
     assert args.ckpt_dir is not None, "Please specify the checkpoint directory."
@@ -66,8 +118,60 @@ def _validate_args(args):
     if args.task == "i2v-A14B":
         assert args.image is not None, "Please specify the image path for i2v."
 
+    assert not args.t5_int8 or args.t5_cpu, "--t5_int8 requires --t5_cpu."
+    assert not args.t5_verify or args.t5_int8, \
+        "--t5_verify requires --t5_int8."
+    assert not (args.stream_decode and "s2v" in args.task
+               ), "--stream_decode is not supported for s2v."
+    assert not (args.stream_decode and args.vae_parallel
+               ), "--stream_decode and --vae_parallel are exclusive."
+    assert args.vae_tile_size is None or args.vae_tile_size > 8, \
+        "--vae_tile_size must be larger than the tile overlap of 8 latent pixels."
+    assert args.vae_segments is None or args.vae_segments >= 1, \
+        "--vae_segments must be at least 1."
+    assert args.vae_segment_warmup >= 1, \
+        "--vae_segment_warmup must be at least 1, every segment but the first needs a warm-up latent frame."
+    assert args.vae_segments is not None or not (
+        args.vae_segment_devices or args.vae_segment_check
+    ), "--vae_segment_devices and --vae_segment_check require --vae_segments."
+    assert args.sampling_checkpoint is None or "s2v" not in args.task, \
+        "--sampling_checkpoint is not supported for s2v."
+    assert args.cascade_scale is None or (
+        "t2v" in args.task or
+        (args.task == "ti2v-5B" and args.image is None)
+    ), "--cascade_scale is only supported for text-to-video."
+    assert args.init_video is None or (
+        "t2v" in args.task or
+        (args.task == "ti2v-5B" and args.image is None)
+    ), "--init_video is only supported for text-to-video."
+    assert args.init_video is None or args.cascade_scale is None, \
+        "--init_video and --cascade_scale are exclusive."
+    assert args.guide_interval_high is None or "A14B" in args.task, \
+        "--guide_interval_high is only supported for A14B tasks."
+    assert args.num_variants == 1 or not (
+        "s2v" in args.task or args.stream_decode or
+        args.sampling_checkpoint is not None or
+        args.cascade_scale is not None or args.init_video is not None
+    ), "--num_variants is not supported for s2v, nor with --stream_decode, --sampling_checkpoint, --cascade_scale or --init_video."
+
+    assert args.lora_high is None or "A14B" in args.task, \
+        "--lora_high is only supported for A14B tasks."
+
+    if args.preset is not None:
+        # explicit sampling arguments take precedence over the preset
+        preset = FEW_STEP_PRESETS[args.preset]
+        for key in ("sample_steps", "sample_shift", "sample_guide_scale",
+                    "sample_solver"):
+            if getattr(args, key) is None:
+                setattr(args, key, preset[key])
+
     cfg = WAN_CONFIGS[args.task]
 
+    if args.sample_solver is None:
+        args.sample_solver = 'unipc'
+    assert args.num_variants == 1 or args.sample_solver != 'adaptive', \
+        "--num_variants is not supported with the adaptive solver."
+
     if args.sample_steps is None:
         args.sample_steps = cfg.sample_steps
 
@@ -80,6 +184,9 @@ def _validate_args(args):
     if args.frame_num is None:
         args.frame_num = cfg.frame_num
 
+    # a rerun only resumes the snapshot of the same job, seed included
+    assert args.sampling_checkpoint is None or args.base_seed >= 0, \
+        "--sampling_checkpoint requires a fixed --base_seed."
     args.base_seed = args.base_seed if args.base_seed >= 0 else random.randint(
         0, sys.maxsize)
     # Size check
@@ -138,6 +245,18 @@ def _parse_args():
         action="store_true",
         default=False,
         help="Whether to place T5 model on CPU.")
+    parser.add_argument(
+        "--t5_int8",
+        action="store_true",
+        default=False,
+        help="Whether to quantize the CPU T5 model to int8. Only works with --t5_cpu."
+    )
+    parser.add_argument(
+        "--t5_verify",
+        action="store_true",
+        default=False,
+        help="Whether to log the embedding error (max abs error and min cosine similarity) of the int8 T5 model against the original one on a few fixed prompts, at the cost of encoding them twice at load time. Only works with --t5_int8."
+    )
     parser.add_argument(
         "--dit_fsdp",
         action="store_true",
@@ -188,11 +307,17 @@ def _parse_args():
     parser.add_argument(
         "--sample_solver",
         type=str,
-        default='unipc',
-        choices=['unipc', 'dpm++'],
+        default=None,
+        choices=['unipc', 'dpm++', 'adaptive'],
         help="The solver used to sample.")
     parser.add_argument(
         "--sample_steps", type=int, default=None, help="The sampling steps.")
+    parser.add_argument(
+        "--sample_tolerance",
+        type=float,
+        default=0.05,
+        help="Local error tolerance of the adaptive solver, which takes at most --sample_steps steps."
+    )
     parser.add_argument(
         "--sample_shift",
         type=float,
@@ -203,12 +328,237 @@ def _parse_args():
         type=float,
         default=None,
         help="Classifier free guidance scale.")
+    parser.add_argument(
+        "--guide_interval",
+        type=float,
+        nargs=2,
+        default=None,
+        metavar=("START", "END"),
+        help="Only run the unconditional forward of classifier free guidance from START to END (see --guide_interval_unit); other steps run the conditional forward alone. For A14B tasks this sets the low noise expert."
+    )
+    parser.add_argument(
+        "--guide_interval_high",
+        type=float,
+        nargs=2,
+        default=None,
+        metavar=("START", "END"),
+        help="Guidance interval of the high noise expert of A14B tasks. If not given, --guide_interval is used."
+    )
+    parser.add_argument(
+        "--guide_interval_unit",
+        type=str,
+        default="sigma",
+        choices=["sigma", "step"],
+        help="Unit of the guidance intervals: sigma (from the higher sigma to the lower one) or fraction of the sampling steps."
+    )
+    parser.add_argument(
+        "--lora",
+        type=str,
+        action="append",
+        default=None,
+        metavar="PATH[:SCALE]",
+        help="LoRA checkpoint merged into the DiT, with an optional scale (default 1.0). Can be repeated. For A14B tasks it applies to both experts unless --lora_high is given."
+    )
+    parser.add_argument(
+        "--lora_high",
+        type=str,
+        action="append",
+        default=None,
+        metavar="PATH[:SCALE]",
+        help="LoRA checkpoint merged into the high noise expert of A14B tasks, which then only takes --lora for the low noise expert. Can be repeated."
+    )
+    parser.add_argument(
+        "--preset",
+        type=str,
+        default=None,
+        choices=list(FEW_STEP_PRESETS.keys()),
+        help="Few-step sampling preset for step-distilled LoRAs. It sets --sample_steps, --sample_shift, --sample_guide_scale and --sample_solver unless they are given."
+    )
+    parser.add_argument(
+        "--vae_tiling",
+        action="store_true",
+        default=False,
+        help="Whether to encode and decode the VAE in overlapping spatial tiles to reduce peak memory."
+    )
+    parser.add_argument(
+        "--vae_tile_size",
+        type=int,
+        default=None,
+        help="VAE tile size in latent pixels. If not given, it is derived from the free device memory."
+    )
+    parser.add_argument(
+        "--vae_dtype",
+        type=str,
+        default="float32",
+        choices=["float32", "bfloat16", "float16"],
+        help="Weight and compute dtype of the VAE. Reduced precision is checked against float32 and only used if it passes --vae_min_psnr."
+    )
+    parser.add_argument(
+        "--vae_channels_last",
+        action="store_true",
+        default=False,
+        help="Whether to run the VAE convolutions in channels_last_3d memory layout."
+    )
+    parser.add_argument(
+        "--vae_min_psnr",
+        type=float,
+        default=35.0,
+        help="Minimum PSNR in dB against float32 for --vae_dtype and --vae_channels_last to take effect."
+    )
+    parser.add_argument(
+        "--vae_segments",
+        type=int,
+        default=None,
+        help="If set, the VAE decodes this many temporal segments of the video concurrently, each warmed up with a few overlapping latent frames."
+    )
+    parser.add_argument(
+        "--vae_segment_warmup",
+        type=int,
+        default=4,
+        help="Overlapping latent frames decoded before every segment with --vae_segments."
+    )
+    parser.add_argument(
+        "--vae_segment_devices",
+        type=str,
+        default=None,
+        help="Comma-separated devices to spread the --vae_segments over, e.g. 'cuda:0,cuda:1'. Defaults to the VAE device."
+    )
+    parser.add_argument(
+        "--vae_segment_check",
+        action="store_true",
+        default=False,
+        help="Whether to also decode every video sequentially and log the largest difference to the --vae_segments decode, e.g. to choose --vae_segment_warmup. Doubles the decode cost."
+    )
+    parser.add_argument(
+        "--vae_parallel",
+        action="store_true",
+        default=False,
+        help="Whether to split the VAE decode spatially across all ranks instead of decoding on rank 0 only. Only works with torchrun."
+    )
+    parser.add_argument(
+        "--stream_decode",
+        action="store_true",
+        default=False,
+        help="Whether to write the video while the VAE decodes it, instead of decoding the whole video first. Not supported for s2v."
+    )
+    parser.add_argument(
+        "--preview_dir",
+        type=str,
+        default=None,
+        help="If set, a low-resolution preview of the video being sampled is written to preview.png in this directory every --preview_interval steps."
+    )
+    parser.add_argument(
+        "--preview_interval",
+        type=int,
+        default=5,
+        help="Sampling steps between two previews.")
+    parser.add_argument(
+        "--sampling_checkpoint",
+        type=str,
+        default=None,
+        help="If set, the sampling state is saved to this file every --sampling_checkpoint_interval steps, and rerunning the same command resumes from it. The final latent is saved too, so a failed VAE decode is retried without denoising. The file is removed once the video is saved. Not supported for s2v."
+    )
+    parser.add_argument(
+        "--sampling_checkpoint_interval",
+        type=int,
+        default=5,
+        help="Sampling steps between two saves of the sampling state.")
+    parser.add_argument(
+        "--cascade_scale",
+        type=float,
+        default=None,
+        help="If set, the high-noise steps draft the video at this fraction of the height and width, and only the steps below --cascade_switch run at full resolution. E.g. 0.5. Only for text-to-video."
+    )
+    parser.add_argument(
+        "--cascade_switch",
+        type=float,
+        default=None,
+        help="Sigma at which the cascade upsamples the draft. Defaults to the expert boundary for A14B models and 0.875 for ti2v-5B."
+    )
+    parser.add_argument(
+        "--init_video",
+        type=str,
+        default=None,
+        help="If set, the video is generated from this video instead of from noise: its first --frame_num frames are noised according to --strength and denoised with the prompt. Only for text-to-video."
+    )
+    parser.add_argument(
+        "--strength",
+        type=float,
+        default=0.8,
+        help="Fraction of the sampling steps run on --init_video, in (0, 1]. Lower keeps more of the input video and is faster."
+    )
+    parser.add_argument(
+        "--num_variants",
+        type=int,
+        default=1,
+        help="Number of videos of the seeds --base_seed, --base_seed + 1, ... to generate in one batched run that encodes the prompt and the image once. They are saved with a _seed<seed> suffix. Not supported for s2v, nor with the adaptive solver, --stream_decode, --sampling_checkpoint, --cascade_scale or --init_video."
+    )
     parser.add_argument(
         "--convert_model_dtype",
         action="store_true",
         default=False,
         help="Whether to convert model paramerters dtype.")
 
+    parser.add_argument(
+        "--prompt_file",
+        type=str,
+        default=None,
+        help="JSONL file of jobs to generate, one JSON object per line with arguments of this script, e.g. {\"prompt\": \"...\", \"base_seed\": 42, \"save_file\": \"a.mp4\"}; the command line gives the defaults. Under torchrun every rank runs whole jobs with its own models, taking them from a shared queue file, instead of all ranks sharing one video; FSDP, --ulysses_size and --vae_parallel are not supported."
+    )
+    parser.add_argument(
+        "--queue_file",
+        type=str,
+        default=None,
+        help="Queue file of --prompt_file on a filesystem all ranks see. Rerunning the same jobs skips the ones it records as done. Defaults to the prompt file with a .queue suffix."
+    )
+
+    parser.add_argument(
+        "--server",
+        action="store_true",
+        default=False,
+        help="Whether to run as a resident inference server that keeps the models loaded between jobs and accepts them at --server_address. The other arguments are the defaults of every job. Runs in a single process."
+    )
+    parser.add_argument(
+        "--submit",
+        action="store_true",
+        default=False,
+        help="Whether to send this generation as a job to the server at --server_address instead of running it. Only the arguments given on the command line are sent; the server fills in the others."
+    )
+    parser.add_argument(
+        "--server_address",
+        type=str,
+        default="127.0.0.1:8765",
+        help="host:port of the inference server.")
+    parser.add_argument(
+        "--priority",
+        type=int,
+        default=0,
+        help="With --submit, the priority of the job. The server runs jobs of a higher priority first, suspending a running job of a lower priority between two sampling steps until they are done."
+    )
+    parser.add_argument(
+        "--deadline",
+        type=float,
+        default=None,
+        help="With --submit, seconds after the submission by which the job should be done. Among jobs of the same priority the server runs the earliest deadline first, suspending running jobs of later ones."
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=1,
+        help="With --server, the most queued text-to-video jobs that share every argument but the prompt, seed and output paths are sampled together in one batch. Only for the unipc and dpm++ solvers without --init_video, --cascade_scale, --sampling_checkpoint or --stream_decode."
+    )
+    parser.add_argument(
+        "--batch_tokens",
+        type=int,
+        default=None,
+        help="With --server, bounds the batch size by the DiT tokens of a batched forward, i.e. batch size times the tokens of one video, to cap activation memory. E.g. 75600 is one 1280*720 video of 81 frames or two 832*480 ones."
+    )
+    parser.add_argument(
+        "--batch_wait",
+        type=float,
+        default=0.5,
+        help="With --server, the longest time in seconds a job waits after its submission for compatible jobs to batch with.")
+
     # following args only works for s2v
     parser.add_argument(
         "--num_clip",
@@ -241,7 +591,19 @@ def _parse_args():
 
     args = parser.parse_args()
 
-    _validate_args(args)
+    if args.submit:
+        # the server validates the job, with its own defaults
+        args.job = {
+            k: v
+            for k, v in vars(args).items()
+            if k not in _SERVER_ARGS and v != parser.get_default(k)
+        }
+        for k in _PATH_ARGS:
+            if args.job.get(k) is not None:
+                args.job[k] = os.path.abspath(args.job[k])
+        return args
+    if not args.server and args.prompt_file is None:
+        _validate_args(args)
 
     return args
 
@@ -258,6 +620,595 @@ def _init_logging(rank):
         logging.basicConfig(level=logging.ERROR)
 
 
+def _configure_vae(vae, args):
+    if args.vae_dtype != "float32" or args.vae_channels_last:
+        vae.set_precision(
+            dtype=getattr(torch, args.vae_dtype),
+            channels_last=args.vae_channels_last,
+            min_psnr=args.vae_min_psnr)
+    if args.vae_tiling:
+        vae.enable_tiling(tile_size=args.vae_tile_size)
+    if args.vae_segments is not None:
+        vae.enable_segment_decode(
+            num_segments=args.vae_segments,
+            warmup=args.vae_segment_warmup,
+            devices=args.vae_segment_devices.split(",")
+            if args.vae_segment_devices else None,
+            check=args.vae_segment_check)
+
+
+def _lora_list(specs):
+    """
+    `(path, scale)` pairs from `PATH[:SCALE]` arguments.
+    """
+    adapters = []
+    for spec in specs or []:
+        path, sep, scale = spec.rpartition(":")
+        try:
+            adapters.append((path, float(scale)) if sep else (spec, 1.0))
+        except ValueError:
+            # a colon of the path itself, e.g. a Windows drive
+            adapters.append((spec, 1.0))
+    return adapters
+
+
+def _configure_lora(pipeline, args):
+    if args.lora is None and args.lora_high is None:
+        return
+    if "A14B" in args.task:
+        pipeline.set_lora(
+            low_noise=_lora_list(args.lora),
+            high_noise=_lora_list(args.lora_high)
+            if args.lora_high is not None else None)
+    else:
+        pipeline.set_lora(_lora_list(args.lora))
+
+
+def _guide_interval(args):
+    """
+    Guidance interval argument of the pipelines, a (low noise, high noise)
+    pair for A14B tasks.
+    """
+
+    def make(bounds):
+        return None if bounds is None else GuidanceInterval(
+            *bounds, unit=args.guide_interval_unit)
+
+    interval = make(args.guide_interval)
+    if "A14B" not in args.task:
+        return interval
+    high = make(args.guide_interval_high)
+    return (interval, high if high is not None else interval)
+
+
+def _preview_saver(preview_dir):
+    """
+    Preview callback that keeps `preview_dir/preview.png` at the latest
+    in-progress preview, replacing it atomically for readers polling it.
+    The previews of `--num_variants` are put side by side.
+    """
+    os.makedirs(preview_dir, exist_ok=True)
+    path = os.path.join(preview_dir, "preview.png")
+
+    def save(step, frames):
+        if isinstance(frames, list):
+            frames = torch.cat(frames, dim=3)
+        tmp = os.path.join(preview_dir, "preview.tmp.png")
+        if save_image(
+                frames.transpose(0, 1).cpu(),
+                tmp,
+                nrow=8,
+                normalize=True,
+                value_range=(-1, 1)) is not None:
+            os.replace(tmp, path)
+            logging.info(f"Saved preview of step {step} to {path}")
+
+    return save
+
+
+def _load_inputs(args):
+    img = None
+    if args.image is not None:
+        img = Image.open(args.image).convert("RGB")
+        logging.info(f"Input image: {args.image}")
+    init_video = None
+    if args.init_video is not None:
+        init_video = load_video(
+            args.init_video,
+            args.frame_num,
+            fps=WAN_CONFIGS[args.task].sample_fps)
+        logging.info(f"Input video: {args.init_video}")
+    return img, init_video
+
+
+def _create_pipeline(args, device, rank):
+    if "t2v" in args.task:
+        pipeline_cls = wan.WanT2V
+    elif "ti2v" in args.task:
+        pipeline_cls = wan.WanTI2V
+    elif "s2v" in args.task:
+        pipeline_cls = wan.WanS2V
+    else:
+        pipeline_cls = wan.WanI2V
+    logging.info(f"Creating {pipeline_cls.__name__} pipeline.")
+    return pipeline_cls(
+        config=WAN_CONFIGS[args.task],
+        checkpoint_dir=args.ckpt_dir,
+        device_id=device,
+        rank=rank,
+        t5_fsdp=args.t5_fsdp,
+        dit_fsdp=args.dit_fsdp,
+        use_sp=(args.ulysses_size > 1),
+        t5_cpu=args.t5_cpu,
+        t5_int8=args.t5_int8,
+        t5_verify=args.t5_verify,
+        convert_model_dtype=args.convert_model_dtype,
+        vae_parallel=args.vae_parallel,
+    )
+
+
+def _generate_video(pipeline,
+                    args,
+                    img,
+                    init_video,
+                    preview_callback,
+                    preview_interval,
+                    sampling_checkpoint,
+                    step_callback=None):
+    if "t2v" in args.task:
+        return pipeline.generate(
+            args.prompt,
+            size=SIZE_CONFIGS[args.size],
+            frame_num=args.frame_num,
+            shift=args.sample_shift,
+            sample_solver=args.sample_solver,
+            sampling_steps=args.sample_steps,
+            sample_tolerance=args.sample_tolerance,
+            guide_scale=args.sample_guide_scale,
+            guide_interval=_guide_interval(args),
+            seed=args.base_seed,
+            offload_model=args.offload_model,
+            stream_output=args.stream_decode,
+            preview_callback=preview_callback,
+            preview_interval=preview_interval,
+            step_callback=step_callback,
+            sampling_checkpoint=sampling_checkpoint,
+            cascade_scale=args.cascade_scale,
+            cascade_switch=args.cascade_switch,
+            init_video=init_video,
+            strength=args.strength,
+            num_variants=args.num_variants)
+    elif "ti2v" in args.task:
+        return pipeline.generate(
+            args.prompt,
+            img=img,
+            size=SIZE_CONFIGS[args.size],
+            max_area=MAX_AREA_CONFIGS[args.size],
+            frame_num=args.frame_num,
+            shift=args.sample_shift,
+            sample_solver=args.sample_solver,
+            sampling_steps=args.sample_steps,
+            sample_tolerance=args.sample_tolerance,
+            guide_scale=args.sample_guide_scale,
+            guide_interval=_guide_interval(args),
+            seed=args.base_seed,
+            offload_model=args.offload_model,
+            stream_output=args.stream_decode,
+            preview_callback=preview_callback,
+            preview_interval=preview_interval,
+            step_callback=step_callback,
+            sampling_checkpoint=sampling_checkpoint,
+            cascade_scale=args.cascade_scale,
+            cascade_switch=args.cascade_switch,
+            init_video=init_video,
+            strength=args.strength,
+            num_variants=args.num_variants)
+    elif "s2v" in args.task:
+        return pipeline.generate(
+            input_prompt=args.prompt,
+            ref_image_path=args.image,
+            audio_path=args.audio,
+            num_repeat=args.num_clip,
+            pose_video=args.pose_video,
+            max_area=MAX_AREA_CONFIGS[args.size],
+            infer_frames=args.infer_frames,
+            shift=args.sample_shift,
+            sample_solver=args.sample_solver,
+            sampling_steps=args.sample_steps,
+            sample_tolerance=args.sample_tolerance,
+            guide_scale=args.sample_guide_scale,
+            guide_interval=_guide_interval(args),
+            seed=args.base_seed,
+            offload_model=args.offload_model,
+            init_first_frame=args.start_from_ref,
+            preview_callback=preview_callback,
+            preview_interval=preview_interval,
+            step_callback=step_callback,
+        )
+    return pipeline.generate(
+        args.prompt,
+        img,
+        max_area=MAX_AREA_CONFIGS[args.size],
+        frame_num=args.frame_num,
+        shift=args.sample_shift,
+        sample_solver=args.sample_solver,
+        sampling_steps=args.sample_steps,
+        sample_tolerance=args.sample_tolerance,
+        guide_scale=args.sample_guide_scale,
+        guide_interval=_guide_interval(args),
+        seed=args.base_seed,
+        offload_model=args.offload_model,
+        stream_output=args.stream_decode,
+        preview_callback=preview_callback,
+        preview_interval=preview_interval,
+        step_callback=step_callback,
+        sampling_checkpoint=sampling_checkpoint,
+        num_variants=args.num_variants)
+
+
+def _save_video(video, args, tag=""):
+    cfg = WAN_CONFIGS[args.task]
+    if args.save_file is not None and tag:
+        root, ext = os.path.splitext(args.save_file)
+        args.save_file = root + tag + ext
+    elif args.save_file is None:
+        formatted_time = datetime.now().strftime("%Y%m%d_%H%M%S")
+        formatted_prompt = args.prompt.replace(" ", "_").replace("/",
+                                                                 "_")[:50]
+        suffix = '.mp4'
+        args.save_file = f"{args.task}_{args.size.replace('*','x') if sys.platform=='win32' else args.size}_{args.ulysses_size}_{formatted_prompt}_{formatted_time}{tag}" + suffix
+
+    logging.info(f"Saving generated video to {args.save_file}")
+    if args.stream_decode:
+        saved = save_video_stream(
+            video,
+            save_file=args.save_file,
+            fps=cfg.sample_fps,
+            value_range=(-1, 1))
+    else:
+        saved = save_video(
+            tensor=video[None],
+            save_file=args.save_file,
+            fps=cfg.sample_fps,
+            nrow=1,
+            normalize=True,
+            value_range=(-1, 1))
+    if saved is None:
+        return None
+    if "s2v" in args.task and merge_video_audio is not None:
+        merge_video_audio(video_path=args.save_file, audio_path=args.audio)
+    return args.save_file
+
+
+def _save_videos(videos, args):
+    """
+    Saves the output of `_generate_video`, a list of videos for
+    `--num_variants` > 1, and returns the paths of the files, None for
+    those that failed to be written.
+    """
+    if args.num_variants == 1:
+        return [_save_video(videos, args)]
+    # one copy per variant, as _save_video fills in args.save_file
+    return [
+        _save_video(video, copy.copy(args), tag=f"_seed{args.base_seed + k}")
+        for k, video in enumerate(videos)
+    ]
+
+
+def _on_step(jobs, info):
+    """
+    Step callback of the server. Sends a progress event to the clients of
+    `jobs`, and cancels sampling once all of them are cancelled.
+    """
+    if all(job.poll() == "cancel" for job in jobs):
+        raise SamplingInterrupted(cancelled=True)
+    for job in jobs:
+        job.emit(
+            "progress",
+            step=info.step,
+            steps=info.num_steps,
+            timestep=round(info.timestep, 3),
+            expert=info.expert,
+            clip=info.clip,
+            elapsed=round(info.elapsed, 3))
+
+
+class _JobRunner:
+    """
+    Runs the jobs of the inference server or of a prompt file, keeping the
+    pipeline of the last job loaded for the next ones.
+    """
+
+    def __init__(self, args, device=0):
+        self.args = args
+        self.device = device
+        self.key = None
+        self.pipeline = None
+        self.lora = (None, None)
+        # job id: (arguments, sampling state) of the suspended jobs
+        self.suspended = {}
+
+    def _job_args(self, job):
+        unknown = (set(job.spec) - set(vars(self.args))) | (
+            set(job.spec) & set(_SERVER_ARGS + _PROMPT_FILE_ARGS))
+        assert not unknown, f"Unknown job arguments: {sorted(unknown)}"
+        args = argparse.Namespace(**{**vars(self.args), **job.spec})
+        _validate_args(args)
+        assert not args.use_prompt_extend, \
+            "Prompt extension is not supported for jobs."
+        if args.offload_model is None:
+            args.offload_model = True
+        return args
+
+    def _prepare(self, args, jobs):
+        key = tuple(getattr(args, k) for k in _PIPELINE_ARGS)
+        if key != self.key:
+            self.pipeline = self.key = None
+            gc.collect()
+            torch.cuda.empty_cache()
+            for job in jobs:
+                job.emit("loading", task=args.task)
+            self.pipeline = _create_pipeline(args, device=self.device, rank=0)
+            _configure_vae(self.pipeline.vae, args)
+            self.key = key
+            self.lora = (None, None)
+        if args.preview_dir is not None:
+            # calibrated once per pipeline, or loaded from its cache file
+            LatentPreviewer.for_vae(self.pipeline.vae)
+        lora = (args.lora, args.lora_high)
+        if lora != self.lora:
+            if any(lora):
+                _configure_lora(self.pipeline, args)
+            else:
+                # drop the adapters of the previous job
+                self.pipeline.set_lora()
+            self.lora = lora
+
+    def batch_key(self, job):
+        """
+        `(key, batch size)` of a job that can be sampled with the queued jobs
+        of the same key, None if it runs alone.
+        """
+        if self.args.batch_size < 2:
+            return None
+        args = self._job_args(job)
+        if not ("t2v" in args.task or
+                (args.task == "ti2v-5B" and args.image is None)):
+            return None
+        if args.sample_solver not in ("unipc", "dpm++") or any(
+                getattr(args, k) is not None
+                for k in ("init_video", "cascade_scale",
+                          "sampling_checkpoint")) or args.stream_decode or \
+                args.num_variants > 1:
+            return None
+        key = tuple((k, repr(v))
+                    for k, v in sorted(vars(args).items())
+                    if k not in _BATCH_ROW_ARGS)
+        batch_size = self.args.batch_size
+        if self.args.batch_tokens is not None:
+            cfg = WAN_CONFIGS[args.task]
+            width, height = SIZE_CONFIGS[args.size]
+            tokens = ((args.frame_num - 1) // cfg.vae_stride[0] + 1) * (
+                height // (cfg.vae_stride[1] * cfg.patch_size[1])) * (
+                    width // (cfg.vae_stride[2] * cfg.patch_size[2]))
+            batch_size = max(1,
+                             min(batch_size, self.args.batch_tokens // tokens))
+        return key, batch_size
+
+    def discard(self, job):
+        self.suspended.pop(job.id, None)
+
+    def __call__(self, job):
+        if job.id in self.suspended:
+            args, sampling_checkpoint = self.suspended.pop(job.id)
+        else:
+            args = self._job_args(job)
+            # in host memory between suspensions, on disk if asked for
+            sampling_checkpoint = PreemptibleSampling(
+                job.poll,
+                path=args.sampling_checkpoint,
+                interval=args.sampling_checkpoint_interval)
+            if args.num_variants > 1:
+                # variants run through generate_batch, which does not
+                # checkpoint, so they are not preempted either
+                sampling_checkpoint = None
+        self._prepare(args, [job])
+
+        img, init_video = _load_inputs(args)
+        preview_saver = None
+        if args.preview_dir is not None:
+            preview_saver = _preview_saver(args.preview_dir)
+
+        logging.info(f"Generating video of job {job.id} ...")
+        cancelled = None
+        try:
+            video = _generate_video(
+                self.pipeline,
+                args,
+                img,
+                init_video,
+                preview_saver,
+                args.preview_interval,
+                sampling_checkpoint,
+                step_callback=partial(_on_step, [job]))
+        except SamplingInterrupted as e:
+            cancelled = e.cancelled
+        if cancelled is not None:
+            # the activations of the interrupted step are unreferenced now
+            gc.collect()
+            torch.cuda.empty_cache()
+            if cancelled:
+                logging.info(f"Cancelled job {job.id}.")
+                raise JobCancelled()
+            logging.info(f"Suspended job {job.id}.")
+            self.suspended[job.id] = (args, sampling_checkpoint)
+            raise JobSuspended()
+        save_files = _save_videos(video, args)
+        if None in save_files:
+            raise RuntimeError(f"Saving the video of job {job.id} failed.")
+        save_files = [os.path.abspath(f) for f in save_files]
+        if sampling_checkpoint is not None:
+            sampling_checkpoint.clear()
+        if args.num_variants > 1:
+            return {"save_files": save_files}
+        return {"save_file": save_files[0]}
+
+    def run_batch(self, jobs):
+        rows = [self._job_args(job) for job in jobs]
+        # the jobs share their batch key, so all but the row arguments
+        args = rows[0]
+        self._prepare(args, jobs)
+
+        preview_savers = [
+            _preview_saver(row.preview_dir)
+            if row.preview_dir is not None else None for row in rows
+        ]
+        # previews are made at the steps of every row's interval
+        preview_interval = math.gcd(*[
+            row.preview_interval
+            for row, preview_saver in zip(rows, preview_savers)
+            if preview_saver is not None
+        ])
+
+        def previews(step, frames):
+            for row, preview_saver, preview in zip(rows, preview_savers,
+                                                   frames):
+                if preview_saver is not None and \
+                        step % row.preview_interval == 0:
+                    preview_saver(step, preview)
+
+        logging.info(f"Generating videos of jobs "
+                     f"{', '.join(job.id for job in jobs)} in a batch ...")
+        try:
+            videos = self.pipeline.generate_batch(
+                [row.prompt for row in rows], [row.base_seed for row in rows],
+                size=SIZE_CONFIGS[args.size],
+                frame_num=args.frame_num,
+                shift=args.sample_shift,
+                sample_solver=args.sample_solver,
+                sampling_steps=args.sample_steps,
+                guide_scale=args.sample_guide_scale,
+                guide_interval=_guide_interval(args),
+                offload_model=args.offload_model,
+                preview_callback=previews if preview_interval else None,
+                preview_interval=preview_interval or 1,
+                step_callback=partial(_on_step, jobs))
+        except SamplingInterrupted:
+            # batches are only interrupted once all their jobs are cancelled
+            gc.collect()
+            torch.cuda.empty_cache()
+            logging.info(f"Cancelled jobs {', '.join(job.id for job in jobs)}.")
+            raise JobCancelled()
+        save_files = [
+            _save_video(video, row) for video, row in zip(videos, rows)
+        ]
+        if None in save_files:
+            raise RuntimeError("Saving the videos of jobs "
+                               f"{', '.join(job.id for job in jobs)} failed.")
+        return [{
+            "save_file": os.path.abspath(save_file)
+        } for save_file in save_files]
+
+
+def _serve(args):
+    _init_logging(0)
+    assert int(os.getenv("WORLD_SIZE", 1)) == 1, \
+        "--server runs in a single process."
+    host, _, port = args.server_address.rpartition(":")
+    worker = InferenceWorker(_JobRunner(args), max_wait=args.batch_wait)
+    serve(worker, host=host, port=int(port))
+
+
+def _generate_prompt_file(args):
+    # the queue locks with fcntl or msvcrt, only needed in this mode
+    from wan.distributed.work_queue import FileWorkQueue
+
+    rank = int(os.getenv("RANK", 0))
+    world_size = int(os.getenv("WORLD_SIZE", 1))
+    local_rank = int(os.getenv("LOCAL_RANK", 0))
+    # every rank reports its own jobs
+    logging.basicConfig(
+        level=logging.INFO,
+        format=f"[%(asctime)s] rank {rank} %(levelname)s: %(message)s",
+        handlers=[logging.StreamHandler(stream=sys.stdout)])
+    assert not (args.t5_fsdp or args.dit_fsdp or args.ulysses_size > 1 or
+                args.vae_parallel), \
+        "--prompt_file runs whole jobs per rank, without FSDP, --ulysses_size or --vae_parallel."
+
+    with open(args.prompt_file) as f:
+        specs = [json.loads(line) for line in f if line.strip()]
+    assert all(isinstance(spec, dict) for spec in specs), \
+        "every line of --prompt_file is a JSON object"
+    queue = FileWorkQueue(args.queue_file or args.prompt_file + ".queue",
+                          len(specs), rank, world_size)
+    # the gloo group only orders the queue reset before the first claims;
+    # the pipelines must not see a process group of independent ranks
+    if world_size > 1:
+        dist.init_process_group(
+            backend="gloo",
+            init_method="env://",
+            rank=rank,
+            world_size=world_size)
+    if rank == 0:
+        fingerprint = hashlib.sha1(
+            json.dumps([vars(args), specs], sort_keys=True,
+                       default=str).encode()).hexdigest()
+        skipped = queue.reset(fingerprint)
+        logging.info(f"{len(specs)} jobs in {args.prompt_file}, "
+                     f"{skipped} of them already done.")
+    if world_size > 1:
+        dist.barrier()
+        dist.destroy_process_group()
+
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank)
+    runner = _JobRunner(args, device=local_rank)
+    num_done = num_failed = 0
+    while True:
+        index = queue.claim()
+        if index is None:
+            break
+        job = Job(specs[index])
+        try:
+            result = runner(job)
+        except Exception as e:
+            logging.exception(f"Job {index} failed.")
+            queue.finish(index, error=f"{type(e).__name__}: {e}")
+            num_failed += 1
+            continue
+        queue.finish(index, result=result)
+        logging.info(f"Job {index} done: "
+                     f"{result.get('save_file') or result['save_files']}")
+        num_done += 1
+
+    done, failed = queue.summary()
+    logging.info(f"Finished {num_done} jobs, {num_failed} failed; "
+                 f"{done - failed} of {len(specs)} jobs are done so far.")
+
+
+def _submit(args):
+    _init_logging(0)
+    for event in submit(args.server_address, args.job):
+        if event["event"] == "progress":
+            expert = f" ({event['expert']})" if event.get("expert") else ""
+            logging.info(f"Step {event['step']}/{event['steps']}{expert}, "
+                         f"t={event['timestep']:.0f}, "
+                         f"{event['elapsed']:.1f}s")
+        elif event["event"] == "done":
+            result = event["result"]
+            for save_file in result.get("save_files",
+                                        [result.get("save_file")]):
+                logging.info(f"Saved {save_file}")
+        elif event["event"] == "error":
+            logging.error(f"Job {event['job']} failed: {event['message']}")
+            sys.exit(1)
+        elif event["event"] == "cancelled":
+            logging.error(f"Job {event['job']} was cancelled.")
+            sys.exit(1)
+        else:
+            logging.info(f"Job {event['job']} {event['event']}.")
+
+
 def generate(args):
     rank = int(os.getenv("RANK", 0))
     world_size = int(os.getenv("WORLD_SIZE", 1))
@@ -317,10 +1268,7 @@ def generate(args):
         args.base_seed = base_seed[0]
 
     logging.info(f"Input prompt: {args.prompt}")
-    img = None
-    if args.image is not None:
-        img = Image.open(args.image).convert("RGB")
-        logging.info(f"Input image: {args.image}")
+    img, init_video = _load_inputs(args)
 
     # prompt extend
     if args.use_prompt_extend:
@@ -346,134 +1294,36 @@ def generate(args):
         args.prompt = input_prompt[0]
         logging.info(f"Extended prompt: {args.prompt}")
 
-    if "t2v" in args.task:
-        logging.info("Creating WanT2V pipeline.")
-        wan_t2v = wan.WanT2V(
-            config=cfg,
-            checkpoint_dir=args.ckpt_dir,
-            device_id=device,
-            rank=rank,
-            t5_fsdp=args.t5_fsdp,
-            dit_fsdp=args.dit_fsdp,
-            use_sp=(args.ulysses_size > 1),
-            t5_cpu=args.t5_cpu,
-            convert_model_dtype=args.convert_model_dtype,
-        )
+    preview_callback = None
+    if args.preview_dir is not None and rank == 0:
+        preview_callback = _preview_saver(args.preview_dir)
+    sampling_checkpoint = None
+    if args.sampling_checkpoint is not None:
+        sampling_checkpoint = SamplingCheckpoint(
+            args.sampling_checkpoint,
+            interval=args.sampling_checkpoint_interval)
 
-        logging.info(f"Generating video ...")
-        video = wan_t2v.generate(
-            args.prompt,
-            size=SIZE_CONFIGS[args.size],
-            frame_num=args.frame_num,
-            shift=args.sample_shift,
-            sample_solver=args.sample_solver,
-            sampling_steps=args.sample_steps,
-            guide_scale=args.sample_guide_scale,
-            seed=args.base_seed,
-            offload_model=args.offload_model)
-    elif "ti2v" in args.task:
-        logging.info("Creating WanTI2V pipeline.")
-        wan_ti2v = wan.WanTI2V(
-            config=cfg,
-            checkpoint_dir=args.ckpt_dir,
-            device_id=device,
-            rank=rank,
-            t5_fsdp=args.t5_fsdp,
-            dit_fsdp=args.dit_fsdp,
-            use_sp=(args.ulysses_size > 1),
-            t5_cpu=args.t5_cpu,
-            convert_model_dtype=args.convert_model_dtype,
-        )
+    pipeline = _create_pipeline(args, device, rank)
+    _configure_vae(pipeline.vae, args)
+    _configure_lora(pipeline, args)
+    if preview_callback is not None:
+        # calibrated before sampling, or loaded from its cache file
+        LatentPreviewer.for_vae(pipeline.vae)
 
-        logging.info(f"Generating video ...")
-        video = wan_ti2v.generate(
-            args.prompt,
-            img=img,
-            size=SIZE_CONFIGS[args.size],
-            max_area=MAX_AREA_CONFIGS[args.size],
-            frame_num=args.frame_num,
-            shift=args.sample_shift,
-            sample_solver=args.sample_solver,
-            sampling_steps=args.sample_steps,
-            guide_scale=args.sample_guide_scale,
-            seed=args.base_seed,
-            offload_model=args.offload_model)
-    elif "s2v" in args.task:
-        logging.info("Creating WanS2V pipeline.")
-        wan_s2v = wan.WanS2V(
-            config=cfg,
-            checkpoint_dir=args.ckpt_dir,
-            device_id=device,
-            rank=rank,
-            t5_fsdp=args.t5_fsdp,
-            dit_fsdp=args.dit_fsdp,
-            use_sp=(args.ulysses_size > 1),
-            t5_cpu=args.t5_cpu,
-            convert_model_dtype=args.convert_model_dtype,
-        )
-        logging.info(f"Generating video ...")
-        video = wan_s2v.generate(
-            input_prompt=args.prompt,
-            ref_image_path=args.image,
-            audio_path=args.audio,
-            num_repeat=args.num_clip,
-            pose_video=args.pose_video,
-            max_area=MAX_AREA_CONFIGS[args.size],
-            infer_frames=args.infer_frames,
-            shift=args.sample_shift,
-            sample_solver=args.sample_solver,
-            sampling_steps=args.sample_steps,
-            guide_scale=args.sample_guide_scale,
-            seed=args.base_seed,
-            offload_model=args.offload_model,
-            init_first_frame=args.start_from_ref,
-        )
-
-    else:
-        logging.info("Creating WanI2V pipeline.")
-        wan_i2v = wan.WanI2V(
-            config=cfg,
-            checkpoint_dir=args.ckpt_dir,
-            device_id=device,
-            rank=rank,
-            t5_fsdp=args.t5_fsdp,
-            dit_fsdp=args.dit_fsdp,
-            use_sp=(args.ulysses_size > 1),
-            t5_cpu=args.t5_cpu,
-            convert_model_dtype=args.convert_model_dtype,
-        )
-
-        logging.info("Generating video ...")
-        video = wan_i2v.generate(
-            args.prompt,
-            img,
-            max_area=MAX_AREA_CONFIGS[args.size],
-            frame_num=args.frame_num,
-            shift=args.sample_shift,
-            sample_solver=args.sample_solver,
-            sampling_steps=args.sample_steps,
-            guide_scale=args.sample_guide_scale,
-            seed=args.base_seed,
-            offload_model=args.offload_model)
+    logging.info("Generating video ...")
+    video = _generate_video(pipeline, args, img, init_video, preview_callback,
+                            args.preview_interval, sampling_checkpoint)
 
+    saved = True
     if rank == 0:
-        if args.save_file is None:
-            formatted_time = datetime.now().strftime("%Y%m%d_%H%M%S")
-            formatted_prompt = args.prompt.replace(" ", "_").replace("/",
-                                                                     "_")[:50]
-            suffix = '.mp4'
-            args.save_file = f"{args.task}_{args.size.replace('*','x') if sys.platform=='win32' else args.size}_{args.ulysses_size}_{formatted_prompt}_{formatted_time}" + suffix
-
-        logging.info(f"Saving generated video to {args.save_file}")
-        save_video(
-            tensor=video[None],
-            save_file=args.save_file,
-            fps=cfg.sample_fps,
-            nrow=1,
-            normalize=True,
-            value_range=(-1, 1))
-        if "s2v" in args.task and merge_video_audio is not None:
-            merge_video_audio(video_path=args.save_file, audio_path=args.audio)
+        saved = None not in _save_videos(video, args)
+        if sampling_checkpoint is not None:
+            if saved:
+                sampling_checkpoint.clear()
+            else:
+                # a rerun decodes the final latent again without sampling
+                logging.error(f"Keeping {args.sampling_checkpoint} to retry "
+                              f"saving the video.")
     del video
 
     torch.cuda.synchronize()
@@ -481,9 +1331,18 @@ def generate(args):
         dist.barrier()
         dist.destroy_process_group()
 
+    if not saved:
+        sys.exit(1)
     logging.info("Finished.")
 
 
 if __name__ == "__main__":
     args = _parse_args()
-    generate(args)
+    if args.server:
+        _serve(args)
+    elif args.prompt_file is not None:
+        _generate_prompt_file(args)
+    elif args.submit:
+        _submit(args)
+    else:
+        generate(args)
@@ -4,6 +4,7 @@ import os
 
 os.environ['TOKENIZERS_PARALLELISM'] = 'false'
 
+from .few_step import FEW_STEP_PRESETS
 from .wan_i2v_A14B import i2v_A14B
 from .wan_s2v_14B import s2v_14B
 from .wan_t2v_A14B import t2v_A14B
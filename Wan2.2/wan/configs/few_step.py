@@ -0,0 +1,23 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+from easydict import EasyDict
+
+#------------------------ Few-step presets ------------------------#
+# Sampling settings for step-distilled LoRAs. They are distilled without
+# classifier-free guidance, so the unconditional forward is skipped.
+
+few_step_4 = EasyDict(__name__='Preset: 4 steps')
+few_step_4.sample_steps = 4
+few_step_4.sample_shift = 5.0
+few_step_4.sample_guide_scale = 1.0
+few_step_4.sample_solver = 'unipc'
+
+few_step_8 = EasyDict(__name__='Preset: 8 steps')
+few_step_8.sample_steps = 8
+few_step_8.sample_shift = 5.0
+few_step_8.sample_guide_scale = 1.0
+few_step_8.sample_solver = 'unipc'
+
+FEW_STEP_PRESETS = {
+    '4step': few_step_4,
+    '8step': few_step_8,
+}
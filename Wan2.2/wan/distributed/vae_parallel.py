@@ -0,0 +1,83 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import math
+
+import torch
+import torch.cuda.amp as amp
+import torch.distributed as dist
+
+from ..modules.vae_tiling import _feather, tile_spans
+
+__all__ = ['parallel_decode']
+
+
+def _rank_spans(size, world_size, overlap):
+    """
+    Splits `[0, size)` into at most `world_size` overlapping spans of equal
+    length, so every rank exchanges tensors of the same shape.
+    """
+    overlap = min(overlap, size // 2)
+    tile = math.ceil((size + (world_size - 1) * overlap) / world_size)
+    return tile_spans(size, max(tile, overlap + 1), overlap)
+
+
+def parallel_decode(vae, z, overlap=4, dst=0, group=None):
+    r"""
+    Decodes one latent video with every rank of `group` decoding an
+    overlapping strip of it. The strips are cut along the longer spatial side
+    and blended with feathered weights over the halo, like tiled decoding.
+    All ranks must call this with the same `z`; it works with any backend
+    whose tensors live on the VAE device, including gloo on CPU.
+
+    Args:
+        vae (`Wan2_1_VAE` or `Wan2_2_VAE`):
+            The VAE, with the same weights on every rank.
+        z (Tensor):
+            Latent video of shape `[C, T, h, w]`.
+        overlap (`int`, *optional*, defaults to 4):
+            Halo between neighbouring strips in latent pixels.
+        dst (`int`, *optional*, defaults to 0):
+            Rank that receives the video. If None, every rank receives it.
+        group (`ProcessGroup`, *optional*, defaults to None):
+            Process group to decode on, the default group if None.
+
+    Returns:
+        Tensor:
+            The video `[3, N, H, W]` in `[-1, 1]` on `dst` (or on every rank if
+            `dst` is None), None on the other ranks.
+    """
+    rank = dist.get_rank(group)
+    world_size = dist.get_world_size(group)
+    dim = 2 if z.shape[2] > z.shape[3] else 3
+    spans = _rank_spans(z.shape[dim], world_size, overlap)
+
+    # ranks beyond the last strip decode the first one again, so every rank
+    # sends a tensor of the same shape
+    start, end = spans[rank] if rank < len(spans) else spans[0]
+    with amp.autocast(dtype=vae.dtype), torch.no_grad():
+        piece = vae._decode_one(
+            z.narrow(dim, start, end - start).unsqueeze(0)).float().squeeze(0)
+
+    if dst is None:
+        pieces = [torch.empty_like(piece) for _ in range(world_size)]
+        dist.all_gather(pieces, piece, group=group)
+    else:
+        dst_global = dist.get_global_rank(group, dst) \
+            if group is not None else dst
+        pieces = [torch.empty_like(piece) for _ in range(world_size)] \
+            if rank == dst else None
+        dist.gather(piece, pieces, dst=dst_global, group=group)
+        if rank != dst:
+            return None
+
+    s = vae.spatial_stride
+    shape = list(piece.shape)
+    shape[dim] = z.shape[dim] * s
+    out = piece.new_zeros(shape)
+    weight = piece.new_zeros(shape[dim])
+    for i, (start, end) in enumerate(spans):
+        w = _feather(spans, i, s, piece.device)
+        w_view = w.view(-1, 1) if dim == 2 else w
+        out.narrow(dim, start * s, (end - start) * s).add_(pieces[i] * w_view)
+        weight[start * s:end * s] += w
+    weight = weight.view(-1, 1) if dim == 2 else weight
+    return (out / weight).clamp_(-1, 1)
@@ -0,0 +1,156 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import json
+import os
+import socket
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+__all__ = ['FileWorkQueue']
+
+
+class FileWorkQueue:
+    r"""
+    Indices of independent jobs shared by the ranks of a data-parallel run
+    through a JSON file on a filesystem they all see.
+
+    Every rank first takes the jobs of its own shard (`index % world_size ==
+    rank`) in order. Once its shard is exhausted it steals the last
+    unclaimed job of the rank with the most left, so ranks that got the
+    fast jobs help the others and all ranks finish at about the same time.
+    Every access holds an exclusive lock of `path + '.lock'`, with `flock`,
+    or `msvcrt.locking` on Windows.
+
+    Finished jobs stay recorded, so a rerun of the same jobs after a crash
+    only runs the unfinished ones, see `reset`.
+
+    Args:
+        path (`str`):
+            File of the queue state.
+        num_jobs (`int`):
+            Number of jobs.
+        rank (`int`):
+            Rank taking jobs from this object.
+        world_size (`int`):
+            Number of ranks.
+    """
+
+    def __init__(self, path, num_jobs, rank, world_size):
+        self.path = path
+        self.num_jobs = num_jobs
+        self.rank = rank
+        self.world_size = world_size
+
+    @contextmanager
+    def _locked(self):
+        with open(self.path + '.lock', 'a+') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            else:
+                # locks the first byte; LK_LOCK gives up after 10 seconds
+                lock.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(lock.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        pass
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+                else:
+                    lock.seek(0)
+                    msvcrt.locking(lock.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def _read(self):
+        with open(self.path) as f:
+            return json.load(f)
+
+    def _write(self, state):
+        tmp = f'{self.path}.{socket.gethostname()}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, self.path)
+
+    def reset(self, fingerprint):
+        r"""
+        Prepares the queue for a run, on one rank before any rank claims a
+        job. Claims of earlier runs are dropped; their successfully finished
+        jobs are kept if `fingerprint` matches, and skipped by this run.
+        Returns the number of those.
+
+        Args:
+            fingerprint (`str`):
+                Identifies the jobs and their arguments.
+        """
+        with self._locked():
+            done = {}
+            if os.path.exists(self.path):
+                state = self._read()
+                if state.get('fingerprint') == fingerprint:
+                    # failed jobs run again
+                    done = {
+                        k: v
+                        for k, v in state['done'].items()
+                        if v['error'] is None
+                    }
+            self._write({
+                'fingerprint': fingerprint,
+                'num_jobs': self.num_jobs,
+                'claims': dict.fromkeys(done, None),
+                'done': done,
+            })
+        return len(done)
+
+    def claim(self):
+        """
+        Index of the next job of this rank, None once every job is claimed.
+        """
+        with self._locked():
+            state = self._read()
+            assert state['num_jobs'] == self.num_jobs, \
+                f'{self.path} belongs to another job list'
+            claims = state['claims']
+            unclaimed = [[] for _ in range(self.world_size)]
+            for index in range(self.num_jobs):
+                if str(index) not in claims:
+                    unclaimed[index % self.world_size].append(index)
+            if unclaimed[self.rank]:
+                index = unclaimed[self.rank][0]
+            else:
+                victim = max(unclaimed, key=len)
+                if not victim:
+                    return None
+                index = victim[-1]
+            claims[str(index)] = {'rank': self.rank, 'time': time.time()}
+            self._write(state)
+            return index
+
+    def finish(self, index, result=None, error=None):
+        """
+        Records the result, or the error message, of a claimed job.
+        """
+        with self._locked():
+            state = self._read()
+            state['done'][str(index)] = {
+                'rank': self.rank,
+                'result': result,
+                'error': error,
+            }
+            self._write(state)
+
+    def summary(self):
+        """
+        Numbers of finished and failed jobs.
+        """
+        with self._locked():
+            done = self._read()['done'].values()
+        return len(done), sum(d['error'] is not None for d in done)
@@ -1,5 +1,6 @@
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
 import gc
+import hashlib
 import logging
 import math
 import os
@@ -19,15 +20,26 @@ from tqdm import tqdm
 from .distributed.fsdp import shard_model
 from .distributed.sequence_parallel import sp_attn_forward, sp_dit_forward
 from .distributed.util import get_world_size
+from .distributed.vae_parallel import parallel_decode
+from .modules.lora import LoraMerger
 from .modules.model import WanModel
-from .modules.t5 import T5EncoderModel
+from .modules.t5 import VERIFY_TEXTS, T5EncoderModel
 from .modules.vae2_1 import Wan2_1_VAE
 from .utils.fm_solvers import (
     FlowDPMSolverMultistepScheduler,
     get_sampling_sigmas,
     retrieve_timesteps,
 )
+from .utils.fm_solvers_adaptive import FlowAdaptiveScheduler
+from .utils.fm_solvers_batched import (
+    BatchedFlowDPMSolverScheduler,
+    BatchedFlowUniPCScheduler,
+)
 from .utils.fm_solvers_unipc import FlowUniPCMultistepScheduler
+from .utils.guidance import expert_intervals, is_guided
+from .utils.preview import LatentPreviewer, flow_x0
+from .utils.sampling_checkpoint import remaining_timesteps
+from .utils.step_callback import StepReporter
 
 
 class WanI2V:
@@ -42,8 +54,11 @@ class WanI2V:
         dit_fsdp=False,
         use_sp=False,
         t5_cpu=False,
+        t5_int8=False,
+        t5_verify=False,
         init_on_cpu=True,
         convert_model_dtype=False,
+        vae_parallel=False,
     ):
         r"""
         Initializes the image-to-video generation model components.
@@ -65,16 +80,27 @@ class WanI2V:
                 Enable distribution strategy of sequence parallel.
             t5_cpu (`bool`, *optional*, defaults to False):
                 Whether to place T5 model on CPU. Only works without t5_fsdp.
+            t5_int8 (`bool`, *optional*, defaults to False):
+                Quantize the CPU T5 model to int8 for faster text encoding. Only works with t5_cpu.
+            t5_verify (`bool`, *optional*, defaults to False):
+                Log the embedding error of the int8 T5 model against the
+                original one on a few fixed prompts. Only works with t5_int8.
             init_on_cpu (`bool`, *optional*, defaults to True):
                 Enable initializing Transformer Model on CPU. Only works without FSDP or USP.
             convert_model_dtype (`bool`, *optional*, defaults to False):
                 Convert DiT model parameters dtype to 'config.param_dtype'.
                 Only works without FSDP.
+            vae_parallel (`bool`, *optional*, defaults to False):
+                Decode the VAE on all ranks, each rank decoding a strip of the
+                latent, instead of on rank 0 only. Only works in distributed mode.
         """
         self.device = torch.device(f"cuda:{device_id}")
         self.config = config
         self.rank = rank
         self.t5_cpu = t5_cpu
+        self.vae_parallel = (
+            vae_parallel and dist.is_initialized() and
+            dist.get_world_size() > 1)
         self.init_on_cpu = init_on_cpu
 
         self.num_train_timesteps = config.num_train_timesteps
@@ -93,12 +119,18 @@ class WanI2V:
             tokenizer_path=os.path.join(checkpoint_dir, config.t5_tokenizer),
             shard_fn=shard_fn if t5_fsdp else None,
         )
+        if t5_cpu and t5_int8:
+            self.text_encoder.optimize_for_cpu(
+                verify_texts=[*VERIFY_TEXTS, config.sample_neg_prompt]
+                if t5_verify else None)
 
         self.vae_stride = config.vae_stride
         self.patch_size = config.patch_size
-        self.vae = Wan2_1_VAE(
-            vae_pth=os.path.join(checkpoint_dir, config.vae_checkpoint),
-            device=self.device)
+        self.vae_checkpoint = os.path.join(checkpoint_dir,
+                                           config.vae_checkpoint)
+        self.vae = Wan2_1_VAE(vae_pth=self.vae_checkpoint, device=self.device)
+        # (key, y) of the last conditioning image, reused by repeated jobs
+        self._cond_cache = None
 
         logging.info(f"Creating WanModel from {checkpoint_dir}")
         self.low_noise_model = WanModel.from_pretrained(
@@ -203,6 +235,72 @@ class WanI2V:
                 getattr(self, required_model_name).to(self.device)
         return getattr(self, required_model_name)
 
+    def set_lora(self, low_noise=None, high_noise=None):
+        r"""
+        Merges LoRA adapters into the experts, replacing the ones merged
+        before. See `wan.modules.lora.LoraMerger`.
+
+        Args:
+            low_noise (`list[tuple[str, float]]`, *optional*, defaults to None):
+                `(path, scale)` of the adapters of the low noise model.
+            high_noise (`list[tuple[str, float]]`, *optional*, defaults to None):
+                Adapters of the high noise model. If None, `low_noise` is used.
+        """
+        low_noise = low_noise or []
+        high_noise = low_noise if high_noise is None else high_noise
+        LoraMerger.of(self.low_noise_model).set_adapters(low_noise)
+        LoraMerger.of(self.high_noise_model).set_adapters(high_noise)
+
+    def _image_condition(self, img, img_hash, F, lat_h, lat_w):
+        r"""
+        DiT conditioning `y` of the first frame `img`: the frame mask and the
+        VAE latent of the image followed by blank frames. The result of the
+        last image is reused.
+
+        Args:
+            img (`torch.Tensor`):
+                The image, [3, H, W] in [-1, 1].
+            img_hash (`str`):
+                Hash of the image.
+            F (`int`):
+                Number of frames.
+            lat_h (`int`):
+                Latent height.
+            lat_w (`int`):
+                Latent width.
+        """
+        h = lat_h * self.vae_stride[1]
+        w = lat_w * self.vae_stride[2]
+        # the encode depends on the precision mode and the tiling of the VAE
+        cond_key = (img_hash, img.shape, h, w, F, self.vae_checkpoint,
+                    str(self.vae.dtype), self.vae.channels_last,
+                    str(self.vae.tiling))
+        if self._cond_cache is not None and self._cond_cache[0] == cond_key:
+            logging.info("Reusing the VAE conditioning of the last image.")
+            return self._cond_cache[1]
+
+        msk = torch.ones(1, F, lat_h, lat_w, device=self.device)
+        msk[:, 1:] = 0
+        msk = torch.concat([
+            torch.repeat_interleave(msk[:, 0:1], repeats=4, dim=1), msk[:, 1:]
+        ],
+                           dim=1)
+        msk = msk.view(1, msk.shape[1] // 4, 4, lat_h, lat_w)
+        msk = msk.transpose(1, 2)[0]
+
+        y = self.vae.encode([
+            torch.concat([
+                torch.nn.functional.interpolate(
+                    img[None].cpu(), size=(h, w),
+                    mode='bicubic').transpose(0, 1),
+                torch.zeros(3, F - 1, h, w)
+            ],
+                         dim=1).to(self.device)
+        ])[0]
+        y = torch.concat([msk, y])
+        self._cond_cache = (cond_key, y)
+        return y
+
     def generate(self,
                  input_prompt,
                  img,
@@ -211,10 +309,18 @@ class WanI2V:
                  shift=5.0,
                  sample_solver='unipc',
                  sampling_steps=40,
+                 sample_tolerance=0.05,
                  guide_scale=5.0,
+                 guide_interval=None,
                  n_prompt="",
                  seed=-1,
-                 offload_model=True):
+                 offload_model=True,
+                 stream_output=False,
+                 preview_callback=None,
+                 preview_interval=5,
+                 step_callback=None,
+                 sampling_checkpoint=None,
+                 num_variants=1):
         r"""
         Generates video frames from input image and text prompt using diffusion process.
 
@@ -234,16 +340,52 @@ class WanI2V:
                 Solver used to sample the video.
             sampling_steps (`int`, *optional*, defaults to 40):
                 Number of diffusion sampling steps. Higher values improve quality but slow generation
+            sample_tolerance (`float`, *optional*, defaults to 0.05):
+                Local error tolerance of the 'adaptive' solver, which then takes
+                at most `sampling_steps` steps.
             guide_scale (`float` or tuple[`float`], *optional*, defaults 5.0):
                 Classifier-free guidance scale. Controls prompt adherence vs. creativity.
                 If tuple, the first guide_scale will be used for low noise model and
                 the second guide_scale will be used for high noise model.
+            guide_interval (`GuidanceInterval` or tuple, *optional*, defaults to None):
+                Steps that run the unconditional forward for classifier-free
+                guidance; the others only run the conditional one. If tuple,
+                the first interval is used for low noise model and the second
+                for high noise model. If None, every step is guided.
             n_prompt (`str`, *optional*, defaults to ""):
                 Negative prompt for content exclusion. If not given, use `config.sample_neg_prompt`
             seed (`int`, *optional*, defaults to -1):
                 Random seed for noise generation. If -1, use random seed
             offload_model (`bool`, *optional*, defaults to True):
                 If True, offloads models to CPU during generation to save VRAM
+            stream_output (`bool`, *optional*, defaults to False):
+                If True, return a generator that decodes the video lazily and
+                yields float frame groups of shape (C, n, H, W), instead of the
+                whole video tensor. See `decode_stream` of the VAE.
+            preview_callback (`callable`, *optional*, defaults to None):
+                Called on rank 0 every `preview_interval` steps as
+                `preview_callback(step, frames)` with a latent-resolution RGB
+                preview ([3, T, h, w] in [-1, 1]) of the current clean-video
+                estimate. See `wan.utils.preview.LatentPreviewer`.
+            preview_interval (`int`, *optional*, defaults to 5):
+                Sampling steps between two previews.
+            step_callback (`callable`, *optional*, defaults to None):
+                Called on rank 0 after every sampling step as
+                `step_callback(info)` with a `StepInfo` of the step, its
+                timestep, expert and elapsed time and the clean-video estimate.
+                A truthy return stops sampling early and decodes that estimate.
+                Under torchrun, give it on every rank. See
+                `wan.utils.step_callback.StepReporter`.
+            sampling_checkpoint (`SamplingCheckpoint`, *optional*, defaults to None):
+                If given, the sampling state is saved to it periodically and
+                the run resumes from its snapshot of the same job, if any.
+                See `wan.utils.sampling_checkpoint.SamplingCheckpoint`.
+            num_variants (`int`, *optional*, defaults to 1):
+                If above 1, this many videos of the seeds `seed`, `seed + 1`,
+                ... are generated in one batched trajectory that encodes the
+                prompts and the image once, see `generate_batch`, and their
+                list is returned. Not supported with the 'adaptive' solver,
+                `stream_output` or `sampling_checkpoint`.
 
         Returns:
             torch.Tensor:
@@ -253,9 +395,31 @@ class WanI2V:
                 - H: Frame height (from max_area)
                 - W: Frame width from max_area)
         """
+        if num_variants > 1:
+            assert not (stream_output or sampling_checkpoint is not None), \
+                'variants are sampled without these options'
+            seed = seed if seed >= 0 else random.randint(0, sys.maxsize)
+            return self.generate_batch(
+                [input_prompt] * num_variants,
+                img, [seed + k for k in range(num_variants)],
+                max_area=max_area,
+                frame_num=frame_num,
+                shift=shift,
+                sample_solver=sample_solver,
+                sampling_steps=sampling_steps,
+                guide_scale=guide_scale,
+                guide_interval=guide_interval,
+                n_prompts=[n_prompt] * num_variants,
+                offload_model=offload_model,
+                preview_callback=preview_callback,
+                preview_interval=preview_interval,
+                step_callback=step_callback)
+
         # preprocess
         guide_scale = (guide_scale, guide_scale) if isinstance(
             guide_scale, float) else guide_scale
+        guide_interval = expert_intervals(guide_interval)
+        img_hash = hashlib.sha1(np.asarray(img).tobytes()).hexdigest()
         img = TF.to_tensor(img).sub_(0.5).div_(0.5).to(self.device)
 
         F = frame_num
@@ -274,6 +438,21 @@ class WanI2V:
             self.patch_size[1] * self.patch_size[2])
         max_seq_len = int(math.ceil(max_seq_len / self.sp_size)) * self.sp_size
 
+        job = dict(
+            task='i2v',
+            prompt=input_prompt,
+            n_prompt=n_prompt,
+            image=img_hash,
+            shape=(F, lat_h, lat_w),
+            seed=seed,
+            solver=sample_solver,
+            steps=sampling_steps,
+            tolerance=sample_tolerance,
+            shift=shift,
+            guide_scale=guide_scale,
+            guide_interval=repr(guide_interval),
+            lora=(LoraMerger.adapters_of(self.low_noise_model),
+                  LoraMerger.adapters_of(self.high_noise_model)))
         seed = seed if seed >= 0 else random.randint(0, sys.maxsize)
         seed_g = torch.Generator(device=self.device)
         seed_g.manual_seed(seed)
@@ -286,41 +465,20 @@ class WanI2V:
             generator=seed_g,
             device=self.device)
 
-        msk = torch.ones(1, F, lat_h, lat_w, device=self.device)
-        msk[:, 1:] = 0
-        msk = torch.concat([
-            torch.repeat_interleave(msk[:, 0:1], repeats=4, dim=1), msk[:, 1:]
-        ],
-                           dim=1)
-        msk = msk.view(1, msk.shape[1] // 4, 4, lat_h, lat_w)
-        msk = msk.transpose(1, 2)[0]
-
         if n_prompt == "":
             n_prompt = self.sample_neg_prompt
 
         # preprocess
         if not self.t5_cpu:
             self.text_encoder.model.to(self.device)
-            context = self.text_encoder([input_prompt], self.device)
-            context_null = self.text_encoder([n_prompt], self.device)
-            if offload_model:
-                self.text_encoder.model.cpu()
-        else:
-            context = self.text_encoder([input_prompt], torch.device('cpu'))
-            context_null = self.text_encoder([n_prompt], torch.device('cpu'))
-            context = [t.to(self.device) for t in context]
-            context_null = [t.to(self.device) for t in context_null]
+        text_future = self.text_encoder.encode_async([input_prompt, n_prompt],
+                                                     self.device)
+        if offload_model and not self.t5_cpu:
+            self.text_encoder.model.cpu()
 
-        y = self.vae.encode([
-            torch.concat([
-                torch.nn.functional.interpolate(
-                    img[None].cpu(), size=(h, w), mode='bicubic').transpose(
-                        0, 1),
-                torch.zeros(3, F - 1, h, w)
-            ],
-                         dim=1).to(self.device)
-        ])[0]
-        y = torch.concat([msk, y])
+        y = self._image_condition(img, img_hash, F, lat_h, lat_w)
+        context, context_null = text_future.result()
+        context, context_null = [context], [context_null]
 
         @contextmanager
         def noop_no_sync():
@@ -358,11 +516,28 @@ class WanI2V:
                     sample_scheduler,
                     device=self.device,
                     sigmas=sampling_sigmas)
+            elif sample_solver == 'adaptive':
+                sample_scheduler = FlowAdaptiveScheduler(
+                    num_train_timesteps=self.num_train_timesteps,
+                    tolerance=sample_tolerance)
+                sample_scheduler.set_timesteps(
+                    sampling_steps,
+                    device=self.device,
+                    shift=shift,
+                    boundary=boundary)
+                timesteps = sample_scheduler.timesteps
             else:
                 raise NotImplementedError("Unsupported solver.")
 
             # sample videos
             latent = noise
+            start_step = 0
+            if sampling_checkpoint is not None:
+                resumed = sampling_checkpoint.restore(job, sample_scheduler,
+                                                      seed_g, self.device)
+                if resumed is not None:
+                    start_step, latent = resumed
+                    x0 = [latent]
 
             arg_c = {
                 'context': [context[0]],
@@ -379,7 +554,18 @@ class WanI2V:
             if offload_model:
                 torch.cuda.empty_cache()
 
-            for _, t in enumerate(tqdm(timesteps)):
+            reporter = None
+            if step_callback is not None:
+                reporter = StepReporter(step_callback, len(timesteps),
+                                        self.num_train_timesteps, self.rank)
+            if preview_callback is not None and self.rank == 0:
+                # a first fit encodes calibration images, not inside the loop
+                previewer = LatentPreviewer.for_vae(self.vae)
+
+            num_unguided = 0
+            for i, t in enumerate(
+                    tqdm(remaining_timesteps(timesteps, start_step)),
+                    start_step):
                 latent_model_input = [latent.to(self.device)]
                 timestep = [t]
 
@@ -389,17 +575,30 @@ class WanI2V:
                     t, boundary, offload_model)
                 sample_guide_scale = guide_scale[1] if t.item(
                 ) >= boundary else guide_scale[0]
+                sample_guide_interval = guide_interval[1] if t.item(
+                ) >= boundary else guide_interval[0]
 
                 noise_pred_cond = model(
                     latent_model_input, t=timestep, **arg_c)[0]
                 if offload_model:
                     torch.cuda.empty_cache()
-                noise_pred_uncond = model(
-                    latent_model_input, t=timestep, **arg_null)[0]
-                if offload_model:
-                    torch.cuda.empty_cache()
-                noise_pred = noise_pred_uncond + sample_guide_scale * (
-                    noise_pred_cond - noise_pred_uncond)
+                if is_guided(sample_guide_interval, t, i, len(timesteps),
+                             self.num_train_timesteps, sample_guide_scale):
+                    noise_pred_uncond = model(
+                        latent_model_input, t=timestep, **arg_null)[0]
+                    if offload_model:
+                        torch.cuda.empty_cache()
+                    noise_pred = noise_pred_uncond + sample_guide_scale * (
+                        noise_pred_cond - noise_pred_uncond)
+                else:
+                    noise_pred = noise_pred_cond
+                    num_unguided += 1
+
+                if (preview_callback is not None and self.rank == 0 and
+                        (i + 1) % preview_interval == 0):
+                    x0_pred = flow_x0(latent, noise_pred, t,
+                                      self.num_train_timesteps)
+                    preview_callback(i + 1, previewer(x0_pred))
 
                 temp_x0 = sample_scheduler.step(
                     noise_pred.unsqueeze(0),
@@ -407,18 +606,60 @@ class WanI2V:
                     latent.unsqueeze(0),
                     return_dict=False,
                     generator=seed_g)[0]
-                latent = temp_x0.squeeze(0)
+                prev_latent, latent = latent, temp_x0.squeeze(0)
 
                 x0 = [latent]
                 del latent_model_input, timestep
 
+                if sampling_checkpoint is not None and self.rank == 0:
+                    sampling_checkpoint.save(
+                        job,
+                        i + 1,
+                        latent,
+                        sample_scheduler,
+                        seed_g,
+                        expert='high_noise'
+                        if t.item() >= boundary else 'low_noise')
+
+                if reporter is not None and reporter(
+                        i + 1,
+                        t,
+                        prev_latent,
+                        noise_pred,
+                        expert='high_noise'
+                        if t.item() >= boundary else 'low_noise'):
+                    logging.info(f'Stopped early after step {i + 1}.')
+                    x0 = [reporter.x0]
+                    break
+
+            if sampling_checkpoint is not None and self.rank == 0:
+                sampling_checkpoint.save(
+                    job,
+                    len(timesteps),
+                    x0[0],
+                    sample_scheduler,
+                    seed_g,
+                    final=True)
+
+            if sample_solver == 'adaptive':
+                logging.info(
+                    f'Adaptive solver used {sample_scheduler.nfe} function '
+                    f'evaluations of at most {sampling_steps}.')
+            if num_unguided:
+                logging.info(f'Guidance interval skipped {num_unguided} '
+                             f'unconditional forwards.')
             if offload_model:
                 self.low_noise_model.cpu()
                 self.high_noise_model.cpu()
                 torch.cuda.empty_cache()
 
-            if self.rank == 0:
-                videos = self.vae.decode(x0)
+            if self.vae_parallel:
+                videos = [parallel_decode(self.vae, x0[0])]
+            elif self.rank == 0:
+                if stream_output:
+                    videos = [self.vae.decode_stream(x0[0])]
+                else:
+                    videos = self.vae.decode(x0)
 
         del noise, latent, x0
         del sample_scheduler
@@ -429,3 +670,235 @@ class WanI2V:
             dist.barrier()
 
         return videos[0] if self.rank == 0 else None
+
+    def generate_batch(self,
+                       input_prompts,
+                       img,
+                       seeds,
+                       max_area=720 * 1280,
+                       frame_num=81,
+                       shift=5.0,
+                       sample_solver='unipc',
+                       sampling_steps=40,
+                       guide_scale=5.0,
+                       guide_interval=None,
+                       n_prompts=None,
+                       offload_model=True,
+                       preview_callback=None,
+                       preview_interval=5,
+                       step_callback=None):
+        r"""
+        Generates several videos from the same image and schedule with shared
+        DiT forwards: the image conditioning is encoded once, every row has
+        its own prompt and seed, and a batched scheduler steps all rows
+        together. A row matches the video of `generate` with the same prompt
+        and seed, up to batched-kernel numerics. The arguments not listed are
+        those of `generate`; `sample_solver` is 'unipc' or 'dpm++'.
+
+        Args:
+            input_prompts (`list[str]`):
+                Text prompt of every video.
+            img (PIL.Image.Image):
+                Input image shared by all videos.
+            seeds (`list[int]`):
+                Seed of every video. -1 draws a random seed.
+            n_prompts (`list[str]`, *optional*, defaults to None):
+                Negative prompt of every video. Empty or None uses
+                `config.sample_neg_prompt`.
+            preview_callback (`callable`, *optional*, defaults to None):
+                Called on rank 0 every `preview_interval` steps as
+                `preview_callback(step, frames)` with the list of previews of
+                all rows, as in `generate`.
+
+        Returns:
+            list[torch.Tensor]:
+                Generated video of every row, (C, N, H, W), on rank 0.
+        """
+        assert len(input_prompts) == len(seeds), \
+            'every prompt needs a seed'
+        batch_size = len(input_prompts)
+        # preprocess
+        guide_scale = (guide_scale, guide_scale) if isinstance(
+            guide_scale, float) else guide_scale
+        guide_interval = expert_intervals(guide_interval)
+        img_hash = hashlib.sha1(np.asarray(img).tobytes()).hexdigest()
+        img = TF.to_tensor(img).sub_(0.5).div_(0.5).to(self.device)
+
+        F = frame_num
+        h, w = img.shape[1:]
+        aspect_ratio = h / w
+        lat_h = round(
+            np.sqrt(max_area * aspect_ratio) // self.vae_stride[1] //
+            self.patch_size[1] * self.patch_size[1])
+        lat_w = round(
+            np.sqrt(max_area / aspect_ratio) // self.vae_stride[2] //
+            self.patch_size[2] * self.patch_size[2])
+
+        max_seq_len = ((F - 1) // self.vae_stride[0] + 1) * lat_h * lat_w // (
+            self.patch_size[1] * self.patch_size[2])
+        max_seq_len = int(math.ceil(max_seq_len / self.sp_size)) * self.sp_size
+
+        noise = []
+        for seed in seeds:
+            seed = seed if seed >= 0 else random.randint(0, sys.maxsize)
+            seed_g = torch.Generator(device=self.device)
+            seed_g.manual_seed(seed)
+            noise.append(
+                torch.randn(
+                    16, (F - 1) // self.vae_stride[0] + 1,
+                    lat_h,
+                    lat_w,
+                    dtype=torch.float32,
+                    generator=seed_g,
+                    device=self.device))
+
+        n_prompts = [p or self.sample_neg_prompt
+                     for p in (n_prompts or [''] * batch_size)]
+
+        # preprocess
+        if not self.t5_cpu:
+            self.text_encoder.model.to(self.device)
+        # duplicate prompts, typically the negative ones, are encoded once
+        text_future = self.text_encoder.encode_async(
+            list(input_prompts) + n_prompts, self.device)
+        if offload_model and not self.t5_cpu:
+            self.text_encoder.model.cpu()
+
+        y = self._image_condition(img, img_hash, F, lat_h, lat_w)
+        contexts = text_future.result()
+
+        @contextmanager
+        def noop_no_sync():
+            yield
+
+        no_sync_low_noise = getattr(self.low_noise_model, 'no_sync',
+                                    noop_no_sync)
+        no_sync_high_noise = getattr(self.high_noise_model, 'no_sync',
+                                     noop_no_sync)
+
+        # evaluation mode
+        with (
+                torch.amp.autocast('cuda', dtype=self.param_dtype),
+                torch.no_grad(),
+                no_sync_low_noise(),
+                no_sync_high_noise(),
+        ):
+            boundary = self.boundary * self.num_train_timesteps
+
+            if sample_solver == 'unipc':
+                sample_scheduler = BatchedFlowUniPCScheduler(
+                    num_train_timesteps=self.num_train_timesteps)
+            elif sample_solver == 'dpm++':
+                sample_scheduler = BatchedFlowDPMSolverScheduler(
+                    num_train_timesteps=self.num_train_timesteps)
+            else:
+                raise NotImplementedError(
+                    "Unsupported solver for batched sampling.")
+            slots = [
+                sample_scheduler.add_request(sampling_steps, shift=shift)
+                for _ in range(batch_size)
+            ]
+
+            # sample videos
+            latents = torch.stack(noise)
+
+            # the rows share the image conditioning
+            arg_c = {
+                'context': contexts[:batch_size],
+                'seq_len': max_seq_len,
+                'y': [y] * batch_size,
+            }
+
+            arg_null = {
+                'context': contexts[batch_size:],
+                'seq_len': max_seq_len,
+                'y': [y] * batch_size,
+            }
+
+            if offload_model:
+                torch.cuda.empty_cache()
+
+            reporter = None
+            if step_callback is not None:
+                reporter = StepReporter(step_callback, sampling_steps,
+                                        self.num_train_timesteps, self.rank)
+            if preview_callback is not None and self.rank == 0:
+                # a first fit encodes calibration images, not inside the loop
+                previewer = LatentPreviewer.for_vae(self.vae)
+
+            num_unguided = 0
+            for i in tqdm(range(sampling_steps)):
+                timestep = sample_scheduler.timesteps(slots, self.device)
+                # the rows share the schedule, so the step and the expert
+                t = timestep[0]
+
+                model = self._prepare_model_for_timestep(
+                    t, boundary, offload_model)
+                sample_guide_scale = guide_scale[1] if t.item(
+                ) >= boundary else guide_scale[0]
+                sample_guide_interval = guide_interval[1] if t.item(
+                ) >= boundary else guide_interval[0]
+
+                latent_model_input = list(latents.unbind(0))
+                noise_pred_cond = torch.stack(
+                    model(latent_model_input, t=timestep, **arg_c))
+                if offload_model:
+                    torch.cuda.empty_cache()
+                if is_guided(sample_guide_interval, t, i, sampling_steps,
+                             self.num_train_timesteps, sample_guide_scale):
+                    noise_pred_uncond = torch.stack(
+                        model(latent_model_input, t=timestep, **arg_null))
+                    if offload_model:
+                        torch.cuda.empty_cache()
+                    noise_pred = noise_pred_uncond + sample_guide_scale * (
+                        noise_pred_cond - noise_pred_uncond)
+                else:
+                    noise_pred = noise_pred_cond
+                    num_unguided += 1
+
+                if (preview_callback is not None and self.rank == 0 and
+                        (i + 1) % preview_interval == 0):
+                    preview_callback(i + 1, [
+                        previewer(
+                            flow_x0(u, v, t, self.num_train_timesteps))
+                        for u, v in zip(latents, noise_pred)
+                    ])
+
+                latent, latents = latents, sample_scheduler.step(
+                    noise_pred, slots, latents, return_dict=False)[0]
+                del latent_model_input, timestep
+
+                if reporter is not None and reporter(
+                        i + 1,
+                        t,
+                        latent,
+                        noise_pred,
+                        expert='high_noise'
+                        if t.item() >= boundary else 'low_noise'):
+                    logging.info(f'Stopped early after step {i + 1}.')
+                    latents = reporter.x0
+                    break
+
+            x0 = list(latents.unbind(0))
+            if num_unguided:
+                logging.info(f'Guidance interval skipped {num_unguided} '
+                             f'unconditional forwards.')
+            if offload_model:
+                self.low_noise_model.cpu()
+                self.high_noise_model.cpu()
+                torch.cuda.empty_cache()
+
+            if self.vae_parallel:
+                videos = [parallel_decode(self.vae, u) for u in x0]
+            elif self.rank == 0:
+                videos = self.vae.decode(x0)
+
+        del noise, latents, x0
+        del sample_scheduler
+        if offload_model:
+            gc.collect()
+            torch.cuda.synchronize()
+        if dist.is_initialized():
+            dist.barrier()
+
+        return videos if self.rank == 0 else None
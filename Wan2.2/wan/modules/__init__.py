@@ -1,5 +1,6 @@
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
 from .attention import flash_attention
+from .lora import LoraAdapter, LoraMerger
 from .model import WanModel
 from .t5 import T5Decoder, T5Encoder, T5EncoderModel, T5Model
 from .tokenizers import HuggingfaceTokenizer
@@ -10,6 +11,8 @@ __all__ = [
     'Wan2_1_VAE',
     'Wan2_2_VAE',
     'WanModel',
+    'LoraAdapter',
+    'LoraMerger',
     'T5Model',
     'T5Encoder',
     'T5Decoder',
@@ -0,0 +1,213 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import logging
+import os
+from collections import OrderedDict
+
+import torch
+
+__all__ = ['LoraAdapter', 'LoraMerger']
+
+# prefixes trainers put in front of the DiT parameter names
+_PREFIXES = ('diffusion_model.', 'model.', 'lora_unet_')
+_LOW_RANK = {
+    'lora_down.weight': 'down',
+    'lora_up.weight': 'up',
+    'lora_A.weight': 'down',
+    'lora_B.weight': 'up',
+    'alpha': 'alpha',
+}
+_FULL = {'diff': 'weight', 'diff_b': 'bias'}
+
+
+def _load_state_dict(path):
+    if path.endswith('.safetensors'):
+        from safetensors import safe_open
+        tensors = {}
+        with safe_open(path, framework="pt", device="cpu") as f:
+            for key in f.keys():
+                tensors[key] = f.get_tensor(key)
+        return tensors
+    return torch.load(path, map_location='cpu')
+
+
+class LoraAdapter:
+    """
+    Weight deltas of one LoRA checkpoint for a DiT, keyed by parameter name.
+    Low-rank pairs (`lora_down`/`lora_up` or `lora_A`/`lora_B`, with an
+    optional `alpha`) and full `diff`/`diff_b` deltas are understood, with
+    the usual trainer prefixes and kohya-style underscored names.
+    """
+
+    def __init__(self, path, model):
+        self.path = path
+        params = dict(model.named_parameters())
+        # kohya checkpoints replace the dots of module names by underscores
+        underscored = {
+            name.rsplit('.', 1)[0].replace('.', '_'): name.rsplit('.', 1)[0]
+            for name in params
+        }
+
+        low_rank, self.full = {}, {}
+        unmatched = 0
+        for key, value in _load_state_dict(path).items():
+            for prefix in _PREFIXES:
+                if key.startswith(prefix):
+                    key = key[len(prefix):]
+                    break
+            module, part = None, None
+            for suffix, kind in list(_LOW_RANK.items()) + list(_FULL.items()):
+                if key.endswith('.' + suffix):
+                    module, part = key[:-len(suffix) - 1], kind
+                    break
+            module = underscored.get(module, module)
+            if part in _FULL.values():
+                name = f'{module}.{part}'
+                if name in params:
+                    self.full[name] = value
+                    continue
+            elif part is not None and f'{module}.weight' in params:
+                low_rank.setdefault(module, {})[part] = value
+                continue
+            unmatched += 1
+
+        self.low_rank = {}
+        for module, parts in low_rank.items():
+            down, up = parts['down'], parts['up']
+            rank = down.shape[0]
+            alpha = float(parts['alpha']) if 'alpha' in parts else rank
+            self.low_rank[f'{module}.weight'] = (down, up, alpha / rank)
+        if not self.low_rank and not self.full:
+            raise ValueError(f'{path} has no weights for this model')
+        if unmatched:
+            logging.warning(
+                f'Ignored {unmatched} tensors of {path} that match no '
+                f'parameter of the model.')
+
+    @property
+    def names(self):
+        return set(self.low_rank) | set(self.full)
+
+    def delta(self, name, param):
+        """
+        Float32 delta of parameter `name` at unit scale, on its device.
+        """
+        out = torch.zeros(param.shape, dtype=torch.float32, device=param.device)
+        if name in self.low_rank:
+            down, up, scale = self.low_rank[name]
+            down = down.to(param.device, torch.float32).flatten(1)
+            up = up.to(param.device, torch.float32).flatten(1)
+            out += (up @ down).view(param.shape) * scale
+        if name in self.full:
+            out += self.full[name].to(param.device, torch.float32)
+        return out
+
+
+class LoraMerger:
+    r"""
+    Merges LoRA adapters into the weights of a DiT in place, so sampling runs
+    the plain model with no adapter overhead per forward.
+
+    The first merge keeps a host copy of every parameter it touches, and
+    unmerging restores them exactly, so adapters can be swapped between
+    requests without drift. Merged weights of the last `cache_size` adapter
+    sets are kept on the host too: switching back to one of them is a copy
+    instead of a merge. Each cached set costs the host memory of the touched
+    parameters. Models sharded with FSDP are not supported.
+
+    Args:
+        model (`torch.nn.Module`):
+            The DiT.
+        cache_size (`int`, *optional*, defaults to 1):
+            Number of merged adapter sets kept on the host.
+    """
+
+    def __init__(self, model, cache_size=1):
+        assert not any('_fsdp_wrapped_module' in name
+                       for name, _ in model.named_modules()), \
+            'LoRA merging does not support FSDP sharded models'
+        self.model = model
+        self.cache_size = cache_size
+        self.adapters = {}
+        self.originals = {}
+        self.cache = OrderedDict()
+        self.active = ()
+        self.merged = set()
+
+    @classmethod
+    def of(cls, model, cache_size=1):
+        """
+        The merger of `model`, created on first use.
+        """
+        merger = getattr(model, 'lora_merger', None)
+        if merger is None:
+            merger = model.lora_merger = cls(model, cache_size)
+        return merger
+
+    @staticmethod
+    def adapters_of(model):
+        """
+        `(path, scale)` of the adapters merged into `model`, empty if none.
+        """
+        merger = getattr(model, 'lora_merger', None)
+        return () if merger is None else merger.active
+
+    def _adapter(self, path):
+        path = os.path.abspath(path)
+        if path not in self.adapters:
+            self.adapters[path] = LoraAdapter(path, self.model)
+        return self.adapters[path]
+
+    @torch.no_grad()
+    def unmerge(self):
+        params = dict(self.model.named_parameters())
+        for name in self.merged:
+            params[name].copy_(self.originals[name])
+        self.merged = set()
+        self.active = ()
+
+    @torch.no_grad()
+    def set_adapters(self, adapters):
+        r"""
+        Makes `adapters` the merged set, replacing the current one.
+
+        Args:
+            adapters (`list[tuple[str, float]]`):
+                `(path, scale)` of every adapter; empty restores the base
+                weights.
+        """
+        key = tuple((os.path.abspath(p), float(s)) for p, s in adapters)
+        if key == self.active:
+            return
+        self.unmerge()
+        if not key:
+            return
+
+        params = dict(self.model.named_parameters())
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            for name, weight in self.cache[key].items():
+                params[name].copy_(weight)
+            self.merged = set(self.cache[key])
+        else:
+            loaded = [(self._adapter(p), s) for p, s in key]
+            names = set().union(*[a.names for a, _ in loaded])
+            for name in names:
+                param = params[name]
+                if name not in self.originals:
+                    self.originals[name] = param.detach().to('cpu', copy=True)
+                weight = param.float()
+                for adapter, scale in loaded:
+                    if name in adapter.names:
+                        weight += scale * adapter.delta(name, param)
+                param.copy_(weight)
+            self.merged = names
+            if self.cache_size > 0:
+                self.cache[key] = {
+                    name: params[name].detach().to('cpu', copy=True)
+                    for name in names
+                }
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+            logging.info(f'Merged {len(key)} LoRA adapters into '
+                         f'{len(names)} parameters.')
+        self.active = key
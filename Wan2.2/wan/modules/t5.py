@@ -2,6 +2,8 @@
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
 import logging
 import math
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import torch
 import torch.nn as nn
@@ -14,6 +16,19 @@ __all__ = [
     'T5Encoder',
     'T5Decoder',
     'T5EncoderModel',
+    'VERIFY_TEXTS',
+]
+
+# prompts of `optimize_for_cpu(verify_texts=...)` covering short, long and
+# Chinese text; the pipelines add their default negative prompt
+VERIFY_TEXTS = [
+    'A cat walks on the grass, realistic style.',
+    'Summer beach vacation style, a white cat wearing sunglasses sits on a '
+    'surfboard. The fluffy-furred feline gazes directly at the camera with '
+    'a relaxed expression. Blurred beach scenery forms the background '
+    'featuring crystal-clear waters, distant green hills, and a blue sky '
+    'dotted with white clouds.',
+    '两只拟人化的猫咪身穿舒适的拳击装备，戴着鲜艳的手套，在聚光灯照射的舞台上激烈对战。',
 ]
 
 
@@ -82,6 +97,7 @@ class T5Attention(nn.Module):
         self.v = nn.Linear(dim, dim_attn, bias=False)
         self.o = nn.Linear(dim_attn, dim, bias=False)
         self.dropout = nn.Dropout(dropout)
+        self.use_sdpa = False
 
     def forward(self, x, context=None, mask=None, pos_bias=None):
         """
@@ -109,9 +125,17 @@ class T5Attention(nn.Module):
             attn_bias.masked_fill_(mask == 0, torch.finfo(x.dtype).min)
 
         # compute attention (T5 does not use scaling)
-        attn = torch.einsum('binc,bjnc->bnij', q, k) + attn_bias
-        attn = F.softmax(attn.float(), dim=-1).type_as(attn)
-        x = torch.einsum('bnij,bjnc->binc', attn, v)
+        if self.use_sdpa:
+            x = F.scaled_dot_product_attention(
+                q.transpose(1, 2),
+                k.transpose(1, 2),
+                v.transpose(1, 2),
+                attn_mask=attn_bias,
+                scale=1.0).transpose(1, 2)
+        else:
+            attn = torch.einsum('binc,bjnc->bnij', q, k) + attn_bias
+            attn = F.softmax(attn.float(), dim=-1).type_as(attn)
+            x = torch.einsum('bnij,bjnc->binc', attn, v)
 
         # output
         x = x.reshape(b, -1, n * c)
@@ -502,6 +526,8 @@ class T5EncoderModel:
         # init tokenizer
         self.tokenizer = HuggingfaceTokenizer(
             name=tokenizer_path, seq_len=text_len, clean='whitespace')
+        self._executor = None
+        self._embedding_hook = None
 
     def __call__(self, texts, device):
         ids, mask = self.tokenizer(
@@ -511,3 +537,136 @@ class T5EncoderModel:
         seq_lens = mask.gt(0).sum(dim=1).long()
         context = self.model(ids, mask)
         return [u[:v] for u, v in zip(context, seq_lens)]
+
+    def encode_batch(self, texts, device, batch_size=None):
+        r"""
+        Encodes several prompts (e.g. positive, negative and extra prompts)
+        in length-sorted, minimally padded batches.
+
+        Args:
+            texts (`list[str]`):
+                Prompts to encode. Duplicates are only encoded once.
+            device (`torch.device`):
+                Device of the returned embeddings. If it differs from the
+                device T5 runs on, all embeddings are moved with a single
+                (pinned) host-to-device copy.
+            batch_size (`int`, *optional*, defaults to None):
+                Maximum number of prompts per T5 forward. None encodes all
+                unique prompts in one forward.
+
+        Returns:
+            List[Tensor]:
+                Text embeddings each with shape [L_i, C], in input order.
+        """
+        device = torch.device(device)
+        unique = list(dict.fromkeys(texts))
+        ids, mask = self.tokenizer(
+            unique, return_mask=True, add_special_tokens=True,
+            padding='longest')
+        seq_lens = mask.gt(0).sum(dim=1).long()
+        model_device = next(self.model.parameters()).device
+
+        # longest first, so every batch is only padded to its own maximum
+        order = torch.argsort(seq_lens, descending=True).tolist()
+        batch_size = batch_size or len(order)
+        context = [None] * len(unique)
+        for i in range(0, len(order), batch_size):
+            idx = order[i:i + batch_size]
+            max_len = seq_lens[idx[0]].item()
+            out = self.model(ids[idx, :max_len].to(model_device),
+                             mask[idx, :max_len].to(model_device))
+            for j, u in zip(idx, out):
+                context[j] = u[:seq_lens[j]]
+
+        # coalesce the host-to-device copies into one transfer
+        if model_device != device:
+            flat = torch.cat(context)
+            if model_device.type == 'cpu' and device.type == 'cuda':
+                flat = flat.pin_memory()
+            flat = flat.to(device, non_blocking=True)
+            context = list(flat.split(seq_lens.tolist()))
+
+        index = {u: i for i, u in enumerate(unique)}
+        return [context[index[u]] for u in texts]
+
+    def encode_async(self, texts, device):
+        r"""
+        Starts `encode_batch` in a background thread when T5 lives on the
+        CPU, so text encoding overlaps with work on the device. On other
+        devices the texts are encoded immediately.
+
+        Returns:
+            concurrent.futures.Future:
+                Resolves to the output of `encode_batch`.
+        """
+        if next(self.model.parameters()).device.type != 'cpu':
+            future = Future()
+            future.set_result(self.encode_batch(texts, device))
+            return future
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='t5_cpu')
+        return self._executor.submit(self.encode_batch, texts, device)
+
+    def optimize_for_cpu(self, quantize=True, num_threads=None,
+                         verify_texts=None):
+        r"""
+        Prepares the encoder for CPU inference: float32 activations, fused
+        SDPA attention, dynamic int8 quantization of the `T5Attention` and
+        `T5FeedForward` linears and intra-op thread tuning. The token
+        embedding stays in its original dtype to save memory.
+
+        Args:
+            quantize (`bool`, *optional*, defaults to True):
+                Apply dynamic int8 quantization to the block linears.
+            num_threads (`int`, *optional*, defaults to None):
+                Number of intra-op threads. None uses all CPU cores.
+            verify_texts (`list[str]`, *optional*, defaults to None):
+                If given, these prompts are encoded before and after the
+                conversion and the embedding error is reported.
+
+        Returns:
+            dict or None:
+                `max_abs_err` and `min_cos_sim` against the original
+                embeddings when `verify_texts` is given.
+        """
+        assert next(self.model.parameters()).device.type == 'cpu', \
+            'optimize_for_cpu requires the T5 model to be placed on CPU'
+        torch.set_num_threads(num_threads or os.cpu_count())
+        reference = self.encode_batch(
+            verify_texts, 'cpu') if verify_texts else None
+
+        # convert block by block to keep the float32 peak small
+        model = self.model
+        if self._embedding_hook is None:
+            # once, a repeated call would stack the hook
+            self._embedding_hook = model.token_embedding.register_forward_hook(
+                lambda module, args, output: output.float())
+        for block in model.blocks:
+            block.float()
+            block.attn.use_sdpa = True
+            if quantize:
+                torch.ao.quantization.quantize_dynamic(
+                    block, {nn.Linear}, dtype=torch.qint8, inplace=True)
+        model.norm.float()
+        if model.pos_embedding is not None:
+            model.pos_embedding.float()
+        logging.info(f'T5 optimized for CPU inference, quantize={quantize}, '
+                     f'threads={torch.get_num_threads()}')
+
+        if reference is None:
+            return None
+        candidate = self.encode_batch(verify_texts, 'cpu')
+        max_abs_err, min_cos_sim = 0.0, 1.0
+        for u, v in zip(reference, candidate):
+            u, v = u.float(), v.float()
+            max_abs_err = max(max_abs_err, (u - v).abs().max().item())
+            min_cos_sim = min(min_cos_sim,
+                              F.cosine_similarity(u, v, dim=-1).min().item())
+        logging.info(f'T5 CPU embeddings vs original: max_abs_err='
+                     f'{max_abs_err:.4f}, min_cos_sim={min_cos_sim:.5f}')
+        if min_cos_sim < 0.99:
+            logging.warning(
+                'The CPU T5 embeddings deviate from the original ones, '
+                'consider running without int8 quantization.')
+        return dict(max_abs_err=max_abs_err, min_cos_sim=min_cos_sim)
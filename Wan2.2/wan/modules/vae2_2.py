@@ -7,12 +7,13 @@ import torch.nn as nn
 import torch.nn.functional as F
 from einops import rearrange
 
+from .vae_cache import CausalCache
+from .vae_runtime import VAERuntimeMixin
+
 __all__ = [
     "Wan2_2_VAE",
 ]
 
-CACHE_T = 2
-
 
 class CausalConv3d(nn.Conv3d):
     """
@@ -31,13 +32,11 @@ class CausalConv3d(nn.Conv3d):
         )
         self.padding = (0, 0, 0)
 
-    def forward(self, x, cache_x=None):
-        padding = list(self._padding)
-        if cache_x is not None and self._padding[4] > 0:
-            cache_x = cache_x.to(x.device)
-            x = torch.cat([cache_x, x], dim=2)
-            padding[4] -= cache_x.shape[2]
-        x = F.pad(x, padding)
+    def forward(self, x, cache=None):
+        if cache is not None:
+            # the window supplies both the cached frames and the padding
+            return super().forward(cache.extend(x, self._padding))
+        x = F.pad(x, self._padding)
 
         return super().forward(x)
 
@@ -55,8 +54,18 @@ class RMS_norm(nn.Module):
         self.bias = nn.Parameter(torch.zeros(shape)) if bias else 0.0
 
     def forward(self, x):
-        return (F.normalize(x, dim=(1 if self.channel_first else -1)) *
-                self.scale * self.gamma + self.bias)
+        dim = 1 if self.channel_first else -1
+        if x.dtype == torch.float32:
+            return F.normalize(x, dim=dim) * self.scale * self.gamma + self.bias
+        # reduced precision: accumulate the norm in float32 but keep x and the
+        # output in its own dtype instead of upcasting the whole activation
+        norm = torch.linalg.vector_norm(
+            x, dim=dim, keepdim=True, dtype=torch.float32)
+        x = x * (self.scale / norm.clamp_min(1e-12)).to(x.dtype)
+        x = x * self.gamma.to(x.dtype)
+        if isinstance(self.bias, torch.Tensor):
+            x = x + self.bias.to(x.dtype)
+        return x
 
 
 class Upsample(nn.Upsample):
@@ -109,42 +118,16 @@ class Resample(nn.Module):
         else:
             self.resample = nn.Identity()
 
-    def forward(self, x, feat_cache=None, feat_idx=[0]):
+    def forward(self, x, feat_cache=None):
         b, c, t, h, w = x.size()
         if self.mode == "upsample3d":
             if feat_cache is not None:
-                idx = feat_idx[0]
-                if feat_cache[idx] is None:
-                    feat_cache[idx] = "Rep"
-                    feat_idx[0] += 1
+                window = feat_cache.next()
+                if not window.primed:
+                    # the first chunk is not upsampled in time
+                    window.primed = True
                 else:
-                    cache_x = x[:, :, -CACHE_T:, :, :].clone()
-                    if (cache_x.shape[2] < 2 and feat_cache[idx] is not None and
-                            feat_cache[idx] != "Rep"):
-                        # cache last frame of last two chunk
-                        cache_x = torch.cat(
-                            [
-                                feat_cache[idx][:, :, -1, :, :].unsqueeze(2).to(
-                                    cache_x.device),
-                                cache_x,
-                            ],
-                            dim=2,
-                        )
-                    if (cache_x.shape[2] < 2 and feat_cache[idx] is not None and
-                            feat_cache[idx] == "Rep"):
-                        cache_x = torch.cat(
-                            [
-                                torch.zeros_like(cache_x).to(cache_x.device),
-                                cache_x
-                            ],
-                            dim=2,
-                        )
-                    if feat_cache[idx] == "Rep":
-                        x = self.time_conv(x)
-                    else:
-                        x = self.time_conv(x, feat_cache[idx])
-                    feat_cache[idx] = cache_x
-                    feat_idx[0] += 1
+                    x = self.time_conv(x, window)
                     x = x.reshape(b, 2, c, t, h, w)
                     x = torch.stack((x[:, 0, :, :, :, :], x[:, 1, :, :, :, :]),
                                     3)
@@ -156,16 +139,14 @@ class Resample(nn.Module):
 
         if self.mode == "downsample3d":
             if feat_cache is not None:
-                idx = feat_idx[0]
-                if feat_cache[idx] is None:
-                    feat_cache[idx] = x.clone()
-                    feat_idx[0] += 1
+                # the first chunk passes through, later ones are strided
+                # together with the last frame of the previous chunk
+                window = feat_cache.next()
+                x_ = window.extend(x, (0, 0, 0, 0, 1, 0))
+                if not window.primed:
+                    window.primed = True
                 else:
-                    cache_x = x[:, :, -1:, :, :].clone()
-                    x = self.time_conv(
-                        torch.cat([feat_cache[idx][:, :, -1:, :, :], x], 2))
-                    feat_cache[idx] = cache_x
-                    feat_idx[0] += 1
+                    x = self.time_conv(x_)
         return x
 
     def init_weight(self, conv):
@@ -211,25 +192,11 @@ class ResidualBlock(nn.Module):
             CausalConv3d(in_dim, out_dim, 1)
             if in_dim != out_dim else nn.Identity())
 
-    def forward(self, x, feat_cache=None, feat_idx=[0]):
+    def forward(self, x, feat_cache=None):
         h = self.shortcut(x)
         for layer in self.residual:
             if isinstance(layer, CausalConv3d) and feat_cache is not None:
-                idx = feat_idx[0]
-                cache_x = x[:, :, -CACHE_T:, :, :].clone()
-                if cache_x.shape[2] < 2 and feat_cache[idx] is not None:
-                    # cache last frame of last two chunk
-                    cache_x = torch.cat(
-                        [
-                            feat_cache[idx][:, :, -1, :, :].unsqueeze(2).to(
-                                cache_x.device),
-                            cache_x,
-                        ],
-                        dim=2,
-                    )
-                x = layer(x, feat_cache[idx])
-                feat_cache[idx] = cache_x
-                feat_idx[0] += 1
+                x = layer(x, feat_cache.next())
             else:
                 x = layer(x)
         return x + h
@@ -444,10 +411,10 @@ class Down_ResidualBlock(nn.Module):
 
         self.downsamples = nn.Sequential(*downsamples)
 
-    def forward(self, x, feat_cache=None, feat_idx=[0]):
+    def forward(self, x, feat_cache=None):
         x_copy = x.clone()
         for module in self.downsamples:
-            x = module(x, feat_cache, feat_idx)
+            x = module(x, feat_cache)
 
         return x + self.avg_shortcut(x_copy)
 
@@ -486,10 +453,10 @@ class Up_ResidualBlock(nn.Module):
 
         self.upsamples = nn.Sequential(*upsamples)
 
-    def forward(self, x, feat_cache=None, feat_idx=[0], first_chunk=False):
+    def forward(self, x, feat_cache=None, first_chunk=False):
         x_main = x.clone()
         for module in self.upsamples:
-            x_main = module(x_main, feat_cache, feat_idx)
+            x_main = module(x_main, feat_cache)
         if self.avg_shortcut is not None:
             x_shortcut = self.avg_shortcut(x, first_chunk)
             return x_main + x_shortcut
@@ -556,57 +523,31 @@ class Encoder3d(nn.Module):
             CausalConv3d(out_dim, z_dim, 3, padding=1),
         )
 
-    def forward(self, x, feat_cache=None, feat_idx=[0]):
+    def forward(self, x, feat_cache=None):
 
         if feat_cache is not None:
-            idx = feat_idx[0]
-            cache_x = x[:, :, -CACHE_T:, :, :].clone()
-            if cache_x.shape[2] < 2 and feat_cache[idx] is not None:
-                cache_x = torch.cat(
-                    [
-                        feat_cache[idx][:, :, -1, :, :].unsqueeze(2).to(
-                            cache_x.device),
-                        cache_x,
-                    ],
-                    dim=2,
-                )
-            x = self.conv1(x, feat_cache[idx])
-            feat_cache[idx] = cache_x
-            feat_idx[0] += 1
+            x = self.conv1(x, feat_cache.next())
         else:
             x = self.conv1(x)
 
         ## downsamples
         for layer in self.downsamples:
             if feat_cache is not None:
-                x = layer(x, feat_cache, feat_idx)
+                x = layer(x, feat_cache)
             else:
                 x = layer(x)
 
         ## middle
         for layer in self.middle:
             if isinstance(layer, ResidualBlock) and feat_cache is not None:
-                x = layer(x, feat_cache, feat_idx)
+                x = layer(x, feat_cache)
             else:
                 x = layer(x)
 
         ## head
         for layer in self.head:
             if isinstance(layer, CausalConv3d) and feat_cache is not None:
-                idx = feat_idx[0]
-                cache_x = x[:, :, -CACHE_T:, :, :].clone()
-                if cache_x.shape[2] < 2 and feat_cache[idx] is not None:
-                    cache_x = torch.cat(
-                        [
-                            feat_cache[idx][:, :, -1, :, :].unsqueeze(2).to(
-                                cache_x.device),
-                            cache_x,
-                        ],
-                        dim=2,
-                    )
-                x = layer(x, feat_cache[idx])
-                feat_cache[idx] = cache_x
-                feat_idx[0] += 1
+                x = layer(x, feat_cache.next())
             else:
                 x = layer(x)
 
@@ -669,68 +610,34 @@ class Decoder3d(nn.Module):
             CausalConv3d(out_dim, 12, 3, padding=1),
         )
 
-    def forward(self, x, feat_cache=None, feat_idx=[0], first_chunk=False):
+    def forward(self, x, feat_cache=None, first_chunk=False):
         if feat_cache is not None:
-            idx = feat_idx[0]
-            cache_x = x[:, :, -CACHE_T:, :, :].clone()
-            if cache_x.shape[2] < 2 and feat_cache[idx] is not None:
-                cache_x = torch.cat(
-                    [
-                        feat_cache[idx][:, :, -1, :, :].unsqueeze(2).to(
-                            cache_x.device),
-                        cache_x,
-                    ],
-                    dim=2,
-                )
-            x = self.conv1(x, feat_cache[idx])
-            feat_cache[idx] = cache_x
-            feat_idx[0] += 1
+            x = self.conv1(x, feat_cache.next())
         else:
             x = self.conv1(x)
 
         for layer in self.middle:
             if isinstance(layer, ResidualBlock) and feat_cache is not None:
-                x = layer(x, feat_cache, feat_idx)
+                x = layer(x, feat_cache)
             else:
                 x = layer(x)
 
         ## upsamples
         for layer in self.upsamples:
             if feat_cache is not None:
-                x = layer(x, feat_cache, feat_idx, first_chunk)
+                x = layer(x, feat_cache, first_chunk)
             else:
                 x = layer(x)
 
         ## head
         for layer in self.head:
             if isinstance(layer, CausalConv3d) and feat_cache is not None:
-                idx = feat_idx[0]
-                cache_x = x[:, :, -CACHE_T:, :, :].clone()
-                if cache_x.shape[2] < 2 and feat_cache[idx] is not None:
-                    cache_x = torch.cat(
-                        [
-                            feat_cache[idx][:, :, -1, :, :].unsqueeze(2).to(
-                                cache_x.device),
-                            cache_x,
-                        ],
-                        dim=2,
-                    )
-                x = layer(x, feat_cache[idx])
-                feat_cache[idx] = cache_x
-                feat_idx[0] += 1
+                x = layer(x, feat_cache.next())
             else:
                 x = layer(x)
         return x
 
 
-def count_conv3d(model):
-    count = 0
-    for m in model.modules():
-        if isinstance(m, CausalConv3d):
-            count += 1
-    return count
-
-
 class WanVAE_(nn.Module):
 
     def __init__(
@@ -781,62 +688,67 @@ class WanVAE_(nn.Module):
         return x_recon, mu
 
     def encode(self, x, scale):
-        self.clear_cache()
+        cache = CausalCache()
         x = patchify(x, patch_size=2)
         t = x.shape[2]
-        iter_ = 1 + (t - 1) // 4
+        t_down = 2**sum(self.temperal_downsample)
+        iter_ = 1 + (t - 1) // t_down
+        # each chunk yields one latent frame, written into a preallocated output
+        out = None
         for i in range(iter_):
-            self._enc_conv_idx = [0]
+            cache.rewind()
             if i == 0:
-                out = self.encoder(
-                    x[:, :, :1, :, :],
-                    feat_cache=self._enc_feat_map,
-                    feat_idx=self._enc_conv_idx,
-                )
+                chunk = x[:, :, :1, :, :]
             else:
-                out_ = self.encoder(
-                    x[:, :, 1 + 4 * (i - 1):1 + 4 * i, :, :],
-                    feat_cache=self._enc_feat_map,
-                    feat_idx=self._enc_conv_idx,
-                )
-                out = torch.cat([out, out_], 2)
+                chunk = x[:, :, 1 + t_down * (i - 1):1 + t_down * i, :, :]
+            out_ = self.encoder(
+                chunk,
+                feat_cache=cache,
+            )
+            if out is None:
+                out = out_.new_empty(*out_.shape[:2], iter_, *out_.shape[3:])
+            out[:, :, i:i + 1] = out_
         mu, log_var = self.conv1(out).chunk(2, dim=1)
         if isinstance(scale[0], torch.Tensor):
             mu = (mu - scale[0].view(1, self.z_dim, 1, 1, 1)) * scale[1].view(
                 1, self.z_dim, 1, 1, 1)
         else:
             mu = (mu - scale[0]) * scale[1]
-        self.clear_cache()
         return mu
 
     def decode(self, z, scale):
-        self.clear_cache()
+        iter_ = z.shape[2]
+        t_up = 2**sum(self.temperal_upsample)
+        # the first latent frame decodes to 1 frame, every later one to t_up
+        out, pos = None, 0
+        for out_ in self.decode_stream(z, scale):
+            if out is None:
+                out = out_.new_empty(*out_.shape[:2], 1 + t_up * (iter_ - 1),
+                                     *out_.shape[3:])
+            out[:, :, pos:pos + out_.shape[2]] = out_
+            pos += out_.shape[2]
+        return out
+
+    def decode_stream(self, z, scale):
+        """
+        Generator version of `decode` that yields the frames of every latent
+        frame ([b, 3, n, H, W]) as soon as they are decoded.
+        """
+        cache = CausalCache()
         if isinstance(scale[0], torch.Tensor):
             z = z / scale[1].view(1, self.z_dim, 1, 1, 1) + scale[0].view(
                 1, self.z_dim, 1, 1, 1)
         else:
             z = z / scale[1] + scale[0]
-        iter_ = z.shape[2]
         x = self.conv2(z)
-        for i in range(iter_):
-            self._conv_idx = [0]
-            if i == 0:
-                out = self.decoder(
-                    x[:, :, i:i + 1, :, :],
-                    feat_cache=self._feat_map,
-                    feat_idx=self._conv_idx,
-                    first_chunk=True,
-                )
-            else:
-                out_ = self.decoder(
-                    x[:, :, i:i + 1, :, :],
-                    feat_cache=self._feat_map,
-                    feat_idx=self._conv_idx,
-                )
-                out = torch.cat([out, out_], 2)
-        out = unpatchify(out, patch_size=2)
-        self.clear_cache()
-        return out
+        for i in range(z.shape[2]):
+            cache.rewind()
+            out_ = self.decoder(
+                x[:, :, i:i + 1, :, :],
+                feat_cache=cache,
+                first_chunk=i == 0,
+            )
+            yield unpatchify(out_, patch_size=2)
 
     def reparameterize(self, mu, log_var):
         std = torch.exp(0.5 * log_var)
@@ -850,15 +762,6 @@ class WanVAE_(nn.Module):
         std = torch.exp(0.5 * log_var.clamp(-30.0, 20.0))
         return mu + std * torch.randn_like(std)
 
-    def clear_cache(self):
-        self._conv_num = count_conv3d(self.decoder)
-        self._conv_idx = [0]
-        self._feat_map = [None] * self._conv_num
-        # cache encode
-        self._enc_conv_num = count_conv3d(self.encoder)
-        self._enc_conv_idx = [0]
-        self._enc_feat_map = [None] * self._enc_conv_num
-
 
 def _video_vae(pretrained_path=None, z_dim=16, dim=160, device="cpu", **kwargs):
     # params
@@ -885,7 +788,10 @@ def _video_vae(pretrained_path=None, z_dim=16, dim=160, device="cpu", **kwargs):
     return model
 
 
-class Wan2_2_VAE:
+class Wan2_2_VAE(VAERuntimeMixin):
+
+    spatial_stride = 16
+    decode_bytes_per_px = 1.6e6
 
     def __init__(
         self,
@@ -898,6 +804,7 @@ class Wan2_2_VAE:
         device="cuda",
     ):
 
+        self.vae_pth = vae_pth
         self.dtype = dtype
         self.device = device
 
@@ -1021,31 +928,29 @@ class Wan2_2_VAE:
                 temperal_downsample=temperal_downsample,
             ).eval().requires_grad_(False).to(device))
 
-    def encode(self, videos):
+    def encode(self, videos, batch_size=None):
+        """
+        videos: A list of videos each with shape [C, T, H, W]. Videos of the
+        same shape are encoded together, at most `batch_size` per pass.
+        """
         try:
             if not isinstance(videos, list):
                 raise TypeError("videos should be a list")
             with amp.autocast(dtype=self.dtype):
-                return [
-                    self.model.encode(u.unsqueeze(0),
-                                      self.scale).float().squeeze(0)
-                    for u in videos
-                ]
+                return self._batched(lambda x: self._encode_one(x).float(),
+                                     videos, batch_size)
         except TypeError as e:
             logging.info(e)
             return None
 
-    def decode(self, zs):
+    def decode(self, zs, batch_size=None):
         try:
             if not isinstance(zs, list):
                 raise TypeError("zs should be a list")
             with amp.autocast(dtype=self.dtype):
-                return [
-                    self.model.decode(u.unsqueeze(0),
-                                      self.scale).float().clamp_(-1,
-                                                                 1).squeeze(0)
-                    for u in zs
-                ]
+                return self._batched(
+                    lambda z: self._decode_one(z).float().clamp_(-1, 1), zs,
+                    batch_size)
         except TypeError as e:
             logging.info(e)
             return None
@@ -0,0 +1,112 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import math
+
+import torch
+
+__all__ = [
+    'CausalCache',
+    'CausalWindow',
+]
+
+
+class CausalWindow:
+    """
+    Temporal state of one causal layer: a ring buffer holding the last `keep`
+    input frames seen over all previous chunks, zeros before the first one.
+    This is exactly the causal zero padding of the layer, so the first chunk
+    needs no special case.
+    """
+
+    def __init__(self, workspace):
+        self.workspace = workspace
+        self.ring = None
+        self.head = 0
+        # set by layers whose first chunk bypasses the temporal conv
+        self.primed = False
+
+    def extend(self, x, padding):
+        r"""
+        Prepends the kept frames to `x`, pads it spatially with zeros and
+        pushes the last frames of `x` into the ring.
+
+        Args:
+            x (Tensor):
+                Chunk of shape `[B, C, T, H, W]`.
+            padding (`tuple[int]`):
+                `(w0, w1, h0, h1, keep, 0)` in the `F.pad` order of the conv.
+
+        Returns:
+            Tensor:
+                View of shape `[B, C, keep + T, H + h0 + h1, W + w0 + w1]`
+                into the workspace shared by all windows of the cache. It is
+                only valid until the next `extend` on the same cache.
+        """
+        w0, w1, h0, h1, keep, _ = padding
+        b, c, t, h, w = x.shape
+        if self.ring is None:
+            self.ring = x.new_zeros(b, c, keep, h, w)
+        out = self.workspace(x, (b, c, keep + t, h + h0 + h1, w + w0 + w1))
+
+        # the workspace is reused across layers, so borders are reset here
+        if h0:
+            out[..., :h0, :].zero_()
+        if h1:
+            out[..., -h1:, :].zero_()
+        if w0:
+            out[..., :w0].zero_()
+        if w1:
+            out[..., -w1:].zero_()
+        inner = out[..., h0:h0 + h, w0:w0 + w]
+        for i in range(keep):
+            inner[:, :, i].copy_(self.ring[:, :, (self.head + i) % keep])
+        inner[:, :, keep:].copy_(x)
+
+        for i in range(max(t - keep, 0), t):
+            self.ring[:, :, self.head].copy_(x[:, :, i])
+            self.head = (self.head + 1) % keep
+        return out
+
+
+class CausalCache:
+    """
+    Causal feature cache for one chunked pass through a VAE encoder or
+    decoder.
+
+    Layers take their `CausalWindow` with `next()` in call order; windows are
+    created during the first chunk, so the module tree never has to be
+    counted, and `rewind()` starts the next chunk. All windows assemble their
+    conv inputs in one scratch buffer per dtype and device, so after the
+    first chunks no frames are concatenated or allocated. Inference only: the
+    scratch buffer is overwritten by the next layer.
+    """
+
+    def __init__(self):
+        self.windows = []
+        self.index = 0
+        self._scratch = {}
+
+    def rewind(self):
+        self.index = 0
+
+    def next(self):
+        if self.index == len(self.windows):
+            self.windows.append(CausalWindow(self._workspace))
+        window = self.windows[self.index]
+        self.index += 1
+        return window
+
+    def _workspace(self, x, shape):
+        numel = math.prod(shape)
+        key = (x.dtype, x.device)
+        buf = self._scratch.get(key)
+        if buf is None or buf.numel() < numel:
+            # release the old buffer before allocating the larger one
+            self._scratch.pop(key, None)
+            del buf
+            buf = self._scratch[key] = x.new_empty(numel)
+        if x.dim() == 5 and not x.is_contiguous() and x.is_contiguous(
+                memory_format=torch.channels_last_3d):
+            # keep the layout of channels_last_3d activations
+            b, c, t, h, w = shape
+            return buf[:numel].view(b, t, h, w, c).permute(0, 4, 1, 2, 3)
+        return buf[:numel].view(shape)
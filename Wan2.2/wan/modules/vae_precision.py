@@ -0,0 +1,98 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import logging
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+__all__ = ['VAEPrecisionMixin']
+
+
+class VAEPrecisionMixin:
+    """
+    Reduced-precision and channels_last execution for the
+    `Wan2_1_VAE`/`Wan2_2_VAE` wrappers, see `VAERuntimeMixin`. Inputs of
+    the model go through `_prepare` to match its dtype and memory format.
+    The first switch keeps a float32 copy of the weights on the CPU, so every
+    mode is cast from full precision and torch.float restores it exactly.
+    """
+
+    channels_last = False
+
+    def set_precision(self, dtype=torch.bfloat16, channels_last=False,
+                      min_psnr=35.0):
+        r"""
+        Switches the VAE to `dtype` weights and autocast, optionally with
+        channels_last_3d convolutions, after checking the decoded output
+        against float32 on a synthetic video.
+
+        Args:
+            dtype (`torch.dtype`, *optional*, defaults to torch.bfloat16):
+                Weight and autocast dtype. torch.float restores full precision.
+            channels_last (`bool`, *optional*, defaults to False):
+                Store conv weights and activations in channels_last_3d layout.
+            min_psnr (`float`, *optional*, defaults to 35.0):
+                Minimum PSNR in dB of the new mode against float32. Below it,
+                the VAE stays in its previous mode. If None, nothing is checked.
+
+        Returns:
+            `float` or None:
+                The measured PSNR, or None if nothing was checked.
+        """
+        if min_psnr is None:
+            self._set_mode(dtype, channels_last)
+            return None
+
+        mode = (self.dtype, self.channels_last)
+
+        # float32 reference on a smooth random video
+        self._set_mode(torch.float, False)
+        g = torch.Generator().manual_seed(0)
+        video = F.interpolate(
+            torch.rand(1, 3, 5, 8, 8, generator=g) * 2 - 1,
+            size=(17, 256, 256),
+            mode='trilinear')[0].to(self.device)
+        z = self.encode([video])[0]
+        ref = self.decode([z])[0]
+
+        self._set_mode(dtype, channels_last)
+        out = self.decode([z])[0]
+        mse = (out - ref).square().mean().item()
+        # the video range [-1, 1] has a peak-to-peak of 2
+        psnr = 10 * math.log10(4 / mse) if mse > 0 else float('inf')
+        if psnr < min_psnr:
+            logging.info(f'VAE {dtype} (channels_last={channels_last}) gives '
+                         f'{psnr:.2f} dB < {min_psnr} dB, keeping {mode[0]}.')
+            self._set_mode(*mode)
+        else:
+            logging.info(f'VAE {dtype} (channels_last={channels_last}) gives '
+                         f'{psnr:.2f} dB against float32.')
+        return psnr
+
+    def _set_mode(self, dtype, channels_last):
+        if '_master' not in self.__dict__:
+            self._master = {
+                k: v.detach().cpu().clone().float()
+                if v.is_floating_point() else v.detach().cpu().clone()
+                for k, v in self.model.state_dict().items()
+            }
+        self.dtype = dtype
+        self.channels_last = channels_last
+        # cast from the float32 master, not from the weights of the old mode
+        self.model.to(torch.float)
+        self.model.load_state_dict(self._master)
+        self.model.to(dtype)
+        fmt = torch.channels_last_3d if channels_last else \
+            torch.contiguous_format
+        for m in self.model.modules():
+            if isinstance(m, nn.Conv3d):
+                m.weight.data = m.weight.data.contiguous(memory_format=fmt)
+        # the decoder copies of segment decode are of the old mode
+        self.__dict__.pop('_replicas', None)
+
+    def _prepare(self, x):
+        x = x.to(next(self.model.parameters()).dtype)
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last_3d)
+        return x
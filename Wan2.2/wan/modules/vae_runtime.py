@@ -0,0 +1,41 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import torch
+
+from .vae_precision import VAEPrecisionMixin
+from .vae_segments import VAESegmentMixin
+from .vae_streaming import VAEStreamingMixin
+from .vae_tiling import VAETilingMixin
+
+__all__ = ['VAERuntimeMixin']
+
+
+class VAERuntimeMixin(VAEStreamingMixin, VAESegmentMixin, VAETilingMixin,
+                      VAEPrecisionMixin):
+    """
+    Execution features of the `Wan2_1_VAE`/`Wan2_2_VAE` wrappers: batching
+    of same-shape videos, spatial tiling, temporal-segment decode, streaming
+    decode and reduced precision.
+
+    A latent video is decoded by `_decode_one`: segment decode, if enabled,
+    splits it and decodes every segment through the tiling mixin, which runs
+    the model on `_prepare`d inputs of the precision mixin.
+    """
+
+    def _batched(self, fn, xs, batch_size=None):
+        """
+        Applies `fn` to the items of `xs` stacked into batches of equal shape,
+        at most `batch_size` items each, and returns the per-item outputs in
+        the input order.
+        """
+        groups = {}
+        for i, x in enumerate(xs):
+            groups.setdefault((tuple(x.shape), x.dtype, x.device), []).append(i)
+        out = [None] * len(xs)
+        for idx in groups.values():
+            step = batch_size or len(idx)
+            for k in range(0, len(idx), step):
+                chunk = idx[k:k + step]
+                ys = fn(torch.stack([xs[i] for i in chunk]))
+                for i, y in zip(chunk, ys.unbind(0)):
+                    out[i] = y
+        return out
@@ -0,0 +1,187 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import copy
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+import torch.cuda.amp as amp
+
+__all__ = [
+    'VAESegmentMixin',
+    'segment_spans',
+    'segment_decode',
+]
+
+
+def segment_spans(num_latents, num_segments, warmup):
+    """
+    Splits `num_latents` latent frames into `(start, end, warm_start)`
+    segments of near-equal length, each decoded from `warm_start` so that
+    `start - warm_start` extra frames rebuild its causal cache.
+    """
+    num_segments = max(1, min(num_segments, num_latents))
+    bounds = [
+        round(i * num_latents / num_segments)
+        for i in range(num_segments + 1)
+    ]
+    return [(s, e, max(0, s - warmup))
+            for s, e in zip(bounds[:-1], bounds[1:])]
+
+
+def segment_decode(decode, z, t_up, num_segments, warmup=4, executor=None):
+    r"""
+    Decodes a latent video as independent temporal segments and stitches the
+    frames back together, dropping the frames of the warm-up latents.
+
+    The decoder is causal with a receptive field longer than a few latent
+    frames, so the result approximates sequential decoding; the error shrinks
+    as `warmup` grows.
+
+    Args:
+        decode (callable):
+            `decode(u, i)` decodes latent segment `u` `[B, C, t, h, w]` as the
+            `i`-th job and returns `[B, 3, 1 + t_up * (t - 1), H, W]`.
+        z (Tensor):
+            Latent video of shape `[B, C, T, h, w]`.
+        t_up (`int`):
+            Frames per latent frame after the first.
+        num_segments (`int`):
+            Number of segments.
+        warmup (`int`, *optional*, defaults to 4):
+            Latent frames decoded before every segment but the first.
+        executor (`concurrent.futures.Executor`, *optional*, defaults to None):
+            Runs the segments concurrently. If None, they run in order.
+
+    Returns:
+        Tensor:
+            The stitched video of shape `[B, 3, 1 + t_up * (T - 1), H, W]`.
+    """
+    assert warmup >= 1, 'segments need at least one warm-up latent frame'
+
+    def run(i, span):
+        start, end, warm_start = span
+        video = decode(z[:, :, warm_start:end], i)
+        # the first decoded latent yields 1 frame, every later one t_up
+        skip = 1 + t_up * (start - warm_start - 1) if start > warm_start else 0
+        return video[:, :, skip:]
+
+    spans = segment_spans(z.shape[2], num_segments, warmup)
+    if executor is None:
+        parts = [run(i, span) for i, span in enumerate(spans)]
+    else:
+        futures = [
+            executor.submit(run, i, span) for i, span in enumerate(spans)
+        ]
+        parts = [f.result() for f in futures]
+    return torch.cat(parts, dim=2)
+
+
+class VAESegmentMixin:
+    """
+    Temporal-segment parallel decode for the `Wan2_1_VAE`/`Wan2_2_VAE`
+    wrappers, see `VAERuntimeMixin`. Every segment is decoded like a whole
+    video, tiled if tiling is enabled.
+    """
+
+    segments = None
+
+    def enable_segment_decode(self,
+                              num_segments=4,
+                              warmup=4,
+                              devices=None,
+                              check=False):
+        r"""
+        Enables decoding temporal segments of the latent concurrently, each
+        warmed up with a few overlapping latent frames that are decoded and
+        then discarded. See `segment_decode`.
+
+        Args:
+            num_segments (`int`, *optional*, defaults to 4):
+                Number of segments, all decoded at the same time.
+            warmup (`int`, *optional*, defaults to 4):
+                Overlapping latent frames decoded before every segment.
+            devices (`list`, *optional*, defaults to None):
+                Devices to spread the segments over, round robin. A copy of
+                the decoder is kept on every device other than the VAE's own.
+                If None, all segments run on the VAE device.
+            check (`bool`, *optional*, defaults to False):
+                Also decode every video sequentially and log the largest
+                difference, see `segment_decode_error`. This doubles the
+                decode cost.
+        """
+        assert num_segments >= 1, 'segment decode needs at least one segment'
+        assert warmup >= 1, 'segments need at least one warm-up latent frame'
+        self.segments = dict(
+            num_segments=num_segments,
+            warmup=warmup,
+            check=check,
+            devices=[torch.device(d) for d in devices]
+            if devices else [next(self.model.parameters()).device])
+
+    def disable_segment_decode(self):
+        self.segments = None
+
+    def _replica(self, device):
+        """
+        Model and scale on `device`, copied there on first use.
+        """
+        if device == next(self.model.parameters()).device:
+            return self.model, self.scale
+        replicas = self.__dict__.setdefault('_replicas', {})
+        if device not in replicas:
+            replicas[device] = (copy.deepcopy(self.model).to(device), [
+                u.to(device) if isinstance(u, torch.Tensor) else u
+                for u in self.scale
+            ])
+        return replicas[device]
+
+    def _decode_one(self, z):
+        """
+        z: [B, C, T, h, w].
+        """
+        if self.segments is None:
+            return super()._decode_one(z)
+        out = self._decode_segments(z)
+        if self.segments['check']:
+            self._segment_error(z, out)
+        return out
+
+    def _decode_segments(self, z):
+        devices = self.segments['devices']
+        replicas = [self._replica(d) for d in devices]
+
+        def decode(u, i):
+            model, scale = replicas[i % len(devices)]
+            # autocast is thread-local, so every worker enters it again
+            with amp.autocast(dtype=self.dtype), torch.no_grad():
+                out = self._decode_tiles(u.to(devices[i % len(devices)]),
+                                         model, scale)
+            return out.to(z.device)
+
+        num_segments = self.segments['num_segments']
+        with ThreadPoolExecutor(max_workers=num_segments) as executor:
+            return segment_decode(
+                decode,
+                z,
+                t_up=2**sum(self.model.temperal_upsample),
+                num_segments=num_segments,
+                warmup=self.segments['warmup'],
+                executor=executor)
+
+    def _segment_error(self, z, out):
+        ref = self._decode_tiles(z, self.model, self.scale).float().clamp(
+            -1, 1)
+        err = (out.float().clamp(-1, 1) - ref).abs().max().item()
+        logging.info(f'Segment decode with {self.segments} differs from '
+                     f'sequential decode by at most {err:.4g}.')
+        return err
+
+    def segment_decode_error(self, z):
+        """
+        Max absolute difference between segmented and sequential decoding of
+        one latent video `z` ([C, T, h, w]), for choosing `warmup`.
+        """
+        assert self.segments is not None, 'segment decode is not enabled'
+        with amp.autocast(dtype=self.dtype), torch.no_grad():
+            z = z.unsqueeze(0)
+            return self._segment_error(z, self._decode_segments(z))
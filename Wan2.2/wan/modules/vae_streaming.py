@@ -0,0 +1,52 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import torch
+import torch.cuda.amp as amp
+
+__all__ = ['VAEStreamingMixin']
+
+
+class VAEStreamingMixin:
+    """
+    Streaming decode for the `Wan2_1_VAE`/`Wan2_2_VAE` wrappers, see
+    `VAERuntimeMixin`.
+    """
+
+    def decode_stream(self, z):
+        r"""
+        Decodes one latent video and yields its frames group by group, so a
+        consumer (video writer, preview, network stream) can start before
+        the whole video is decoded and only one group is held at a time.
+
+        With tiling or segment decode enabled the video is decoded in one go
+        and then yielded in the same groups.
+
+        Args:
+            z (Tensor):
+                Latent video of shape `[C, T, h, w]`.
+
+        Yields:
+            Tensor:
+                Float frames in `[-1, 1]` of shape `[3, n, H, W]`, with
+                `n = 1` for the first latent frame and the temporal stride
+                afterwards.
+        """
+        if self.tiling is not None or self.segments is not None:
+            with amp.autocast(dtype=self.dtype), torch.no_grad():
+                video = self._decode_one(z.unsqueeze(0)).float().clamp_(
+                    -1, 1).squeeze(0)
+            t_up = 2**sum(self.model.temperal_upsample)
+            yield video[:, :1]
+            for i in range(1, video.shape[1], t_up):
+                yield video[:, i:i + t_up]
+            return
+
+        frames = self.model.decode_stream(z.unsqueeze(0), self.scale)
+        while True:
+            # autocast is thread-local state that would stay enabled in the
+            # consumer's code between two groups, so it is only held while a
+            # group is computed and never across a `yield`
+            with amp.autocast(dtype=self.dtype), torch.no_grad():
+                out = next(frames, None)
+            if out is None:
+                return
+            yield out.float().clamp_(-1, 1).squeeze(0)
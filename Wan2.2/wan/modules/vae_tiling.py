@@ -0,0 +1,194 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import math
+
+import torch
+
+__all__ = [
+    'VAETilingMixin',
+    'tile_spans',
+    'tile_size_for_budget',
+    'tiled_apply',
+]
+
+
+def tile_spans(size, tile, overlap):
+    """
+    Splits `[0, size)` into overlapping `(start, end)` spans of length `tile`.
+    The last span is shifted back so that it ends exactly at `size`.
+    """
+    if size <= tile:
+        return [(0, size)]
+    assert 0 <= overlap < tile
+    stride = tile - overlap
+    num = math.ceil((size - overlap) / stride)
+    starts = sorted({min(i * stride, size - tile) for i in range(num)})
+    return [(s, s + tile) for s in starts]
+
+
+def tile_size_for_budget(budget, bytes_per_px, minimum=16):
+    """
+    Largest square tile (in latent pixels) whose estimated peak memory
+    `tile**2 * bytes_per_px` stays within `budget` bytes.
+    """
+    return max(minimum, int(math.sqrt(budget / bytes_per_px)))
+
+
+def _feather(spans, i, scale, device):
+    """
+    1D blending weights for the `i`-th span, ramping linearly over the
+    regions shared with its neighbours and flat everywhere else.
+    """
+    start, end = spans[i]
+    w = torch.ones((end - start) * scale, device=device)
+    if i > 0:
+        n = (spans[i - 1][1] - start) * scale
+        w[:n] = torch.arange(1, n + 1, device=device) / (n + 1)
+    if i < len(spans) - 1 and end > spans[i + 1][0]:
+        n = (end - spans[i + 1][0]) * scale
+        ramp = torch.arange(n, 0, -1, device=device) / (n + 1)
+        w[-n:] = torch.minimum(w[-n:], ramp)
+    return w
+
+
+def tiled_apply(fn, x, grid, tile_size, tile_overlap, in_scale=1,
+                out_scale=1):
+    """
+    Runs `fn` over overlapping spatial tiles of `x` and blends the outputs
+    with feathered weights, so there are no seams between tiles.
+
+    Tiles are laid out on a `grid` of `(H, W)` cells, where one cell covers
+    `in_scale` pixels of `x` and `out_scale` pixels of the output (e.g. one
+    latent pixel is 8 or 16 video pixels). Every tile is processed
+    independently, so each call of `fn` builds its own causal cache.
+
+    Args:
+        fn (callable):
+            Maps `[B, C, T, h * in_scale, w * in_scale]` to
+            `[B, C', T', h * out_scale, w * out_scale]`.
+        x (Tensor):
+            Input of shape `[B, C, T, H * in_scale, W * in_scale]`.
+        grid (`tuple[int]`):
+            Grid size `(H, W)`.
+        tile_size (`int` or `tuple[int]`):
+            Tile size in grid cells.
+        tile_overlap (`int`):
+            Overlap between neighbouring tiles in grid cells.
+
+    Returns:
+        Tensor:
+            The blended output in float32.
+    """
+    if isinstance(tile_size, int):
+        tile_size = (tile_size, tile_size)
+    h_spans = tile_spans(grid[0], tile_size[0], tile_overlap)
+    w_spans = tile_spans(grid[1], tile_size[1], tile_overlap)
+
+    out = weight = None
+    for i, (h0, h1) in enumerate(h_spans):
+        for j, (w0, w1) in enumerate(w_spans):
+            tile = fn(x[..., h0 * in_scale:h1 * in_scale,
+                        w0 * in_scale:w1 * in_scale]).float()
+            if out is None:
+                out = tile.new_zeros(*tile.shape[:3], grid[0] * out_scale,
+                                     grid[1] * out_scale)
+                weight = tile.new_zeros(grid[0] * out_scale,
+                                        grid[1] * out_scale)
+            w = _feather(h_spans, i, out_scale, tile.device)[:, None] * \
+                _feather(w_spans, j, out_scale, tile.device)[None, :]
+            hs = slice(h0 * out_scale, h1 * out_scale)
+            ws = slice(w0 * out_scale, w1 * out_scale)
+            out[..., hs, ws] += tile * w
+            weight[hs, ws] += w
+            del tile
+    return out / weight
+
+
+class VAETilingMixin:
+    """
+    Spatially tiled encode/decode for the `Wan2_1_VAE`/`Wan2_2_VAE`
+    wrappers, see `VAERuntimeMixin`.
+
+    Subclasses define `spatial_stride` (video pixels per latent pixel) and
+    `decode_bytes_per_px`, a rough float32 estimate of the decoder's peak
+    memory per latent pixel that is used to derive the tile size from a
+    memory budget.
+    """
+
+    spatial_stride = 8
+    decode_bytes_per_px = 6e5
+    tiling = None
+
+    def enable_tiling(self, tile_size=None, tile_overlap=8,
+                      memory_budget=None):
+        r"""
+        Enables spatially tiled encoding and decoding.
+
+        Args:
+            tile_size (`int` or `tuple[int]`, *optional*, defaults to None):
+                Tile size in latent pixels. If None, it is derived from
+                `memory_budget`.
+            tile_overlap (`int`, *optional*, defaults to 8):
+                Overlap between neighbouring tiles in latent pixels.
+            memory_budget (`int`, *optional*, defaults to None):
+                Peak memory budget in bytes for one tile. If None, 80% of the
+                free device memory at the time of the call is used.
+        """
+        assert tile_size is None or min(
+            (tile_size,) if isinstance(tile_size, int) else tile_size
+        ) > tile_overlap, \
+            f'tile size {tile_size} must exceed the overlap {tile_overlap}'
+        self.tiling = dict(
+            tile_size=tile_size,
+            tile_overlap=tile_overlap,
+            memory_budget=memory_budget)
+
+    def disable_tiling(self):
+        self.tiling = None
+
+    def tile_size(self):
+        if self.tiling['tile_size'] is not None:
+            return self.tiling['tile_size']
+        budget = self.tiling['memory_budget']
+        if budget is None:
+            device = torch.device(self.device)
+            if device.type == 'cuda':
+                budget = 0.8 * torch.cuda.mem_get_info(device)[0]
+            else:
+                budget = 8 * 1024**3
+        bytes_per_px = self.decode_bytes_per_px * torch.finfo(
+            self.dtype).bits / 32
+        return tile_size_for_budget(budget, bytes_per_px)
+
+    def _encode_one(self, x):
+        """
+        x: [B, 3, T, H, W].
+        """
+        x = self._prepare(x)
+        if self.tiling is None:
+            return self.model.encode(x, self.scale)
+        s = self.spatial_stride
+        return tiled_apply(
+            lambda u: self.model.encode(u, self.scale),
+            x,
+            grid=(x.shape[3] // s, x.shape[4] // s),
+            tile_size=self.tile_size(),
+            tile_overlap=self.tiling['tile_overlap'],
+            in_scale=s)
+
+    def _decode_tiles(self, z, model, scale):
+        z = self._prepare(z)
+        if self.tiling is None:
+            return model.decode(z, scale)
+        return tiled_apply(
+            lambda u: model.decode(u, scale),
+            z,
+            grid=z.shape[3:],
+            tile_size=self.tile_size(),
+            tile_overlap=self.tiling['tile_overlap'],
+            out_scale=self.spatial_stride)
+
+    def _decode_one(self, z):
+        """
+        z: [B, C, T, h, w].
+        """
+        return self._decode_tiles(z, self.model, self.scale)
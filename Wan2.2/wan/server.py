@@ -0,0 +1,503 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import itertools
+import json
+import logging
+import queue
+import threading
+import time
+import urllib.request
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+__all__ = [
+    'Job', 'JobSuspended', 'JobCancelled', 'InferenceWorker', 'serve',
+    'submit', 'cancel'
+]
+
+_TERMINAL = ('done', 'error', 'cancelled')
+
+
+class JobSuspended(Exception):
+    """
+    Raised by a runner that left a job between two steps to resume it later.
+    """
+
+
+class JobCancelled(Exception):
+    """
+    Raised by a runner that stopped a job on its cancellation.
+    """
+
+
+class Job:
+    r"""
+    A generation request and the events of its progress.
+
+    Events are dicts with an `event` name ('queued', 'started', 'loading',
+    'progress', 'suspended', 'resumed', 'done', 'error' or 'cancelled'), the
+    job id and a timestamp, plus fields of the event, e.g. `step` and
+    `steps` for 'progress' or `result` for 'done'.
+
+    Jobs run in order of priority, then of deadline, then of submission.
+
+    Args:
+        spec (`dict`):
+            Job arguments, named like the arguments of generate.py.
+        priority (`int`, *optional*, defaults to 0):
+            Jobs of a higher priority run first.
+        deadline (`float`, *optional*, defaults to None):
+            Seconds after the submission by which the job should be done.
+            Among jobs of the same priority the earliest deadline runs
+            first, and jobs without one last.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, spec, priority=0, deadline=None):
+        self.id = str(next(Job._ids))
+        self.spec = spec
+        self.priority = priority
+        self.status = 'queued'
+        self.result = None
+        self.error = None
+        self.submit_time = time.time()
+        self.deadline = None if deadline is None else \
+            self.submit_time + deadline
+        self.start_time = None
+        self.end_time = None
+        # time on the device, summed over the runs between suspensions
+        self.run_time = 0.0
+        self.run_start = None
+        self.cancel_requested = False
+        self.events = queue.Queue()
+
+    def emit(self, event, **fields):
+        self.events.put(
+            dict(event=event, job=self.id, time=time.time(), **fields))
+
+    def poll(self):
+        r"""
+        Called by the runner between two sampling steps of the job. Returns
+        None to go on, 'suspend' to leave the job so that a more urgent one
+        can run, or 'cancel'. The worker replaces it on submission.
+        """
+        return None
+
+    def order(self):
+        return (-self.priority,
+                float('inf') if self.deadline is None else self.deadline,
+                self.submit_time)
+
+    def times(self):
+        """
+        Seconds spent queued or suspended, and seconds spent running.
+        """
+        now = time.time()
+        run_time = self.run_time
+        if self.run_start is not None:
+            run_time += now - self.run_start
+        return (self.end_time or now) - self.submit_time - run_time, run_time
+
+    def info(self):
+        """
+        JSON-serializable status of the job.
+        """
+        queue_time, run_time = self.times()
+        return {
+            'job': self.id,
+            'status': self.status,
+            'priority': self.priority,
+            'result': self.result,
+            'error': self.error,
+            'queue_time': queue_time,
+            'run_time': run_time,
+        }
+
+
+class InferenceWorker:
+    r"""
+    Runs jobs on a resident thread, so whatever the runner loads, models in
+    particular, stays in memory from one job to the next.
+
+    The next job to run is the most urgent one, see `Job`. A running job
+    whose runner polls `job.poll()` between sampling steps is preempted: it
+    is suspended at the first step it can be resumed from once a more
+    urgent job waits, and resumes once no more urgent job is left. A runner
+    may be unable to suspend some jobs, e.g. generate.py cannot suspend
+    speech-to-video jobs or the draft steps of the cascade. Cancelling a
+    running job stops it at the end of its current step.
+
+    Jobs run one at a time unless the runner batches: the most urgent job
+    then runs together with the other queued jobs of the same batch key, up
+    to the batch size of the key. A job waits at most `max_wait` seconds
+    after its submission for others to join it. Batches are not preempted;
+    a batch stops once all its jobs are cancelled, and a cancelled job of a
+    batch that runs on finishes as cancelled, without its result.
+
+    Args:
+        runner (`callable`):
+            Called as `runner(job)` on the worker thread for every job run
+            alone; it may emit 'progress' events and returns the
+            JSON-serializable result of the job, e.g. the path of the saved
+            video. An exception fails the job, not the worker; a runner that
+            stops the job on `job.poll()` raises `JobSuspended`, keeping
+            what it needs to resume the job on its next call, or
+            `JobCancelled`. If it has a `discard(job)` method, it is called
+            for a suspended job that is cancelled.
+            If it has `batch_key(job)` and `run_batch(jobs)` methods, jobs
+            are batched: `batch_key` returns `(key, batch_size)`, or None if
+            the job runs alone, and `run_batch` returns the result of every
+            job of a batch; an exception fails the whole batch.
+        history (`int`, *optional*, defaults to 100):
+            Number of finished jobs kept for status queries.
+        max_wait (`float`, *optional*, defaults to 0.):
+            Longest time in seconds a job is held back after its submission
+            to fill its batch.
+    """
+
+    def __init__(self, runner, history=100, max_wait=0.):
+        self.runner = runner
+        self.history = history
+        self.max_wait = max_wait
+        self.batching = hasattr(runner, 'batch_key') and hasattr(
+            runner, 'run_batch')
+        self.jobs = OrderedDict()
+        # queued and suspended jobs
+        self.ready = []
+        self.running = []
+        self.batch_keys = {}
+        self.stopping = False
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.stopping = False
+            self.thread = threading.Thread(
+                target=self._loop, name='wan-worker', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """
+        Stops the worker once the running job is done; the other jobs stay
+        queued.
+        """
+        if self.thread is not None:
+            with self.lock:
+                self.stopping = True
+                self.changed.notify_all()
+            self.thread.join()
+            self.thread = None
+
+    def submit(self, spec, priority=0, deadline=None):
+        job = Job(spec, priority=priority, deadline=deadline)
+        job.poll = lambda: self._poll(job)
+        with self.lock:
+            self.jobs[job.id] = job
+            finished = [
+                j for j in self.jobs.values() if j.status in _TERMINAL
+            ]
+            for old in finished[:max(0, len(finished) - self.history)]:
+                del self.jobs[old.id]
+            job.emit(
+                'queued',
+                position=sum(j.order() < job.order() for j in self.ready))
+            self.ready.append(job)
+            self.changed.notify_all()
+        return job
+
+    def cancel(self, job_id):
+        """
+        Cancels a job: a waiting job at once, a running one at the end of
+        its current step. Returns the job, None if unknown.
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.status in _TERMINAL:
+                return job
+            job.cancel_requested = True
+            waiting = job in self.ready
+            if waiting:
+                self.ready.remove(job)
+                self.batch_keys.pop(job.id, None)
+                self._finish(job, 'cancelled')
+                self.changed.notify_all()
+        if waiting and job.start_time is not None and hasattr(
+                self.runner, 'discard'):
+            self.runner.discard(job)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def num_queued(self):
+        with self.lock:
+            return len(self.ready)
+
+    def _poll(self, job):
+        with self.lock:
+            if job.cancel_requested:
+                return 'cancel'
+            if len(self.running) == 1 and any(
+                    j.order() < job.order() for j in self.ready):
+                return 'suspend'
+            return None
+
+    def _finish(self, job, status):
+        now = time.time()
+        if job.run_start is not None:
+            job.run_time += now - job.run_start
+            job.run_start = None
+        job.status = status
+        if status == 'suspended':
+            job.emit('suspended', run_time=job.run_time)
+            return
+        job.end_time = now
+        queue_time, run_time = job.times()
+        if status == 'done':
+            job.emit(
+                'done',
+                result=job.result,
+                queue_time=queue_time,
+                run_time=run_time)
+        elif status == 'cancelled':
+            job.emit('cancelled', queue_time=queue_time, run_time=run_time)
+        else:
+            job.emit(
+                'error',
+                message=job.error,
+                queue_time=queue_time,
+                run_time=run_time)
+
+    def _batch_key(self, job):
+        if job.id not in self.batch_keys:
+            try:
+                self.batch_keys[job.id] = self.runner.batch_key(job)
+            except Exception:
+                # invalid jobs run alone, and fail there
+                self.batch_keys[job.id] = None
+        return self.batch_keys[job.id]
+
+    def _joins(self, job, key):
+        return job.status == 'queued' and self._batch_key(
+            job) is not None and self._batch_key(job)[0] == key
+
+    def _next_batch(self):
+        """
+        Blocks for the next jobs to run, an empty list to stop.
+        """
+        with self.lock:
+            while True:
+                while not self.ready and not self.stopping:
+                    self.changed.wait()
+                if self.stopping:
+                    return []
+                head = min(self.ready, key=Job.order)
+                batch = [head]
+                if self.batching and head.status == 'queued' and \
+                        self._batch_key(head) is not None:
+                    key, batch_size = self._batch_key(head)
+                    batch += [
+                        j for j in sorted(self.ready, key=Job.order)
+                        if j is not head and self._joins(j, key)
+                    ][:batch_size - 1]
+                    timeout = head.submit_time + self.max_wait - time.time()
+                    if len(batch) < batch_size and timeout > 0:
+                        # wait for more jobs, or a more urgent one
+                        self.changed.wait(timeout)
+                        continue
+                for job in batch:
+                    self.ready.remove(job)
+                    self.batch_keys.pop(job.id, None)
+                self.running = batch
+                return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                return
+            for job in batch:
+                job.run_start = time.time()
+                if job.start_time is None:
+                    job.start_time = job.run_start
+                    job.emit(
+                        'started',
+                        queue_time=job.times()[0],
+                        batch_size=len(batch))
+                else:
+                    job.emit('resumed', queue_time=job.times()[0])
+                job.status = 'running'
+            status = 'done'
+            try:
+                if len(batch) == 1:
+                    results = [self.runner(batch[0])]
+                else:
+                    results = self.runner.run_batch(batch)
+                for job, result in zip(batch, results):
+                    job.result = result
+            except JobSuspended:
+                status = 'suspended'
+            except JobCancelled:
+                status = 'cancelled'
+            except Exception as e:
+                logging.exception(
+                    f'Job {", ".join(job.id for job in batch)} failed.')
+                status = 'error'
+                for job in batch:
+                    job.error = f'{type(e).__name__}: {e}'
+            with self.lock:
+                self.running = []
+                for job in batch:
+                    if status == 'done' and job.cancel_requested:
+                        job.result = None
+                        self._finish(job, 'cancelled')
+                        continue
+                    self._finish(job, status)
+                    if status == 'suspended':
+                        self.ready.append(job)
+                self.changed.notify_all()
+
+
+def serve(worker, host='127.0.0.1', port=8765):
+    r"""
+    Serves `worker` over HTTP until interrupted.
+
+    - `POST /jobs` with a JSON job spec queues the job and streams its
+      events back as JSON lines, until 'done', 'error' or 'cancelled'. The
+      optional `priority` and `deadline` keys of the spec are those of
+      `Job`. A client that disconnects early does not cancel the job.
+    - `GET /jobs/<id>` returns the status of a job.
+    - `DELETE /jobs/<id>` cancels a job and returns its status.
+    - `GET /health` returns the number of queued jobs.
+
+    Args:
+        worker (`InferenceWorker`):
+            The worker running the jobs.
+        host (`str`, *optional*, defaults to '127.0.0.1'):
+            Interface to listen on; keep it local, jobs read and write
+            arbitrary paths.
+        port (`int`, *optional*, defaults to 8765):
+            Port to listen on.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def _send_json(self, code, obj):
+            body = json.dumps(obj).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/health':
+                self._send_json(200, {
+                    'status': 'ok',
+                    'queued': worker.num_queued()
+                })
+                return
+            if self.path.startswith('/jobs/'):
+                job = worker.get(self.path[len('/jobs/'):])
+                if job is not None:
+                    self._send_json(200, job.info())
+                    return
+            self._send_json(404, {'error': f'not found: {self.path}'})
+
+        def do_POST(self):
+            if self.path != '/jobs':
+                self._send_json(404, {'error': f'not found: {self.path}'})
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                spec = json.loads(self.rfile.read(length) or b'{}')
+                assert isinstance(spec, dict), 'a job is a JSON object'
+                priority = int(spec.pop('priority', 0))
+                deadline = spec.pop('deadline', None)
+                deadline = None if deadline is None else float(deadline)
+            except (ValueError, TypeError, AssertionError) as e:
+                self._send_json(400, {'error': str(e)})
+                return
+
+            job = worker.submit(spec, priority=priority, deadline=deadline)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.end_headers()
+            try:
+                while True:
+                    event = job.events.get()
+                    self.wfile.write(json.dumps(event).encode() + b'\n')
+                    self.wfile.flush()
+                    if event['event'] in _TERMINAL:
+                        break
+            except (BrokenPipeError, ConnectionResetError):
+                logging.info(f'Client of job {job.id} disconnected.')
+
+        def do_DELETE(self):
+            if self.path.startswith('/jobs/'):
+                job = worker.cancel(self.path[len('/jobs/'):])
+                if job is not None:
+                    self._send_json(200, job.info())
+                    return
+            self._send_json(404, {'error': f'not found: {self.path}'})
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    worker.start()
+    logging.info(f'Serving on http://{host}:{port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        worker.stop()
+
+
+def submit(address, spec, timeout=None):
+    r"""
+    Sends a job to the server at `address` and yields its events, the last
+    one being 'done', 'error' or 'cancelled'.
+
+    Args:
+        address (`str`):
+            'host:port' of the server.
+        spec (`dict`):
+            Job arguments, named like the arguments of generate.py, plus
+            the optional `priority` and `deadline` of `Job`.
+        timeout (`float`, *optional*, defaults to None):
+            Socket timeout in seconds; None waits for the job however long
+            it takes.
+    """
+    request = urllib.request.Request(
+        f'http://{address}/jobs',
+        data=json.dumps(spec).encode(),
+        headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        for line in response:
+            if line.strip():
+                yield json.loads(line)
+
+
+def cancel(address, job_id, timeout=None):
+    r"""
+    Cancels a job of the server at `address` and returns its status.
+
+    Args:
+        address (`str`):
+            'host:port' of the server.
+        job_id (`str`):
+            Id of the job, from its events.
+        timeout (`float`, *optional*, defaults to None):
+            Socket timeout in seconds.
+    """
+    request = urllib.request.Request(
+        f'http://{address}/jobs/{job_id}', method='DELETE')
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read())
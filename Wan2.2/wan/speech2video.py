@@ -24,16 +24,22 @@ from tqdm import tqdm
 from .distributed.fsdp import shard_model
 from .distributed.sequence_parallel import sp_attn_forward, sp_dit_forward
 from .distributed.util import get_world_size
+from .distributed.vae_parallel import parallel_decode
+from .modules.lora import LoraMerger
 from .modules.s2v.audio_encoder import AudioEncoder
 from .modules.s2v.model_s2v import WanModel_S2V, sp_attn_forward_s2v
-from .modules.t5 import T5EncoderModel
+from .modules.t5 import VERIFY_TEXTS, T5EncoderModel
 from .modules.vae2_1 import Wan2_1_VAE
 from .utils.fm_solvers import (
     FlowDPMSolverMultistepScheduler,
     get_sampling_sigmas,
     retrieve_timesteps,
 )
+from .utils.fm_solvers_adaptive import FlowAdaptiveScheduler
 from .utils.fm_solvers_unipc import FlowUniPCMultistepScheduler
+from .utils.guidance import is_guided
+from .utils.preview import LatentPreviewer, flow_x0
+from .utils.step_callback import StepReporter
 
 
 def load_safetensors(path):
@@ -56,8 +62,11 @@ class WanS2V:
         dit_fsdp=False,
         use_sp=False,
         t5_cpu=False,
+        t5_int8=False,
+        t5_verify=False,
         init_on_cpu=True,
         convert_model_dtype=False,
+        vae_parallel=False,
     ):
         r"""
         Initializes the image-to-video generation model components.
@@ -79,16 +88,27 @@ class WanS2V:
                 Enable distribution strategy of sequence parallel.
             t5_cpu (`bool`, *optional*, defaults to False):
                 Whether to place T5 model on CPU. Only works without t5_fsdp.
+            t5_int8 (`bool`, *optional*, defaults to False):
+                Quantize the CPU T5 model to int8 for faster text encoding. Only works with t5_cpu.
+            t5_verify (`bool`, *optional*, defaults to False):
+                Log the embedding error of the int8 T5 model against the
+                original one on a few fixed prompts. Only works with t5_int8.
             init_on_cpu (`bool`, *optional*, defaults to True):
                 Enable initializing Transformer Model on CPU. Only works without FSDP or USP.
             convert_model_dtype (`bool`, *optional*, defaults to False):
                 Convert DiT model parameters dtype to 'config.param_dtype'.
                 Only works without FSDP.
+            vae_parallel (`bool`, *optional*, defaults to False):
+                Decode the VAE on all ranks, each rank decoding a strip of the
+                latent, instead of on rank 0 only. Only works in distributed mode.
         """
         self.device = torch.device(f"cuda:{device_id}")
         self.config = config
         self.rank = rank
         self.t5_cpu = t5_cpu
+        self.vae_parallel = (
+            vae_parallel and dist.is_initialized() and
+            dist.get_world_size() > 1)
         self.init_on_cpu = init_on_cpu
 
         self.num_train_timesteps = config.num_train_timesteps
@@ -106,6 +126,10 @@ class WanS2V:
             tokenizer_path=os.path.join(checkpoint_dir, config.t5_tokenizer),
             shard_fn=shard_fn if t5_fsdp else None,
         )
+        if t5_cpu and t5_int8:
+            self.text_encoder.optimize_for_cpu(
+                verify_texts=[*VERIFY_TEXTS, config.sample_neg_prompt]
+                if t5_verify else None)
 
         self.vae = Wan2_1_VAE(
             vae_pth=os.path.join(checkpoint_dir, config.vae_checkpoint),
@@ -389,6 +413,17 @@ class WanS2V:
             HEIGHT, WIDTH, target_area=max_area)
         return (HEIGHT, WIDTH)
 
+    def set_lora(self, adapters=None):
+        r"""
+        Merges LoRA adapters into the DiT, replacing the ones merged before.
+        See `wan.modules.lora.LoraMerger`.
+
+        Args:
+            adapters (`list[tuple[str, float]]`, *optional*, defaults to None):
+                `(path, scale)` of every adapter.
+        """
+        LoraMerger.of(self.noise_model).set_adapters(adapters or [])
+
     def generate(
         self,
         input_prompt,
@@ -401,11 +436,16 @@ class WanS2V:
         shift=5.0,
         sample_solver='unipc',
         sampling_steps=40,
+        sample_tolerance=0.05,
         guide_scale=5.0,
+        guide_interval=None,
         n_prompt="",
         seed=-1,
         offload_model=True,
         init_first_frame=False,
+        preview_callback=None,
+        preview_interval=5,
+        step_callback=None,
     ):
         r"""
         Generates video frames from input image and text prompt using diffusion process.
@@ -432,10 +472,17 @@ class WanS2V:
                 Solver used to sample the video.
             sampling_steps (`int`, *optional*, defaults to 40):
                 Number of diffusion sampling steps. Higher values improve quality but slow generation
+            sample_tolerance (`float`, *optional*, defaults to 0.05):
+                Local error tolerance of the 'adaptive' solver, which then takes
+                at most `sampling_steps` steps.
             guide_scale (`float` or tuple[`float`], *optional*, defaults 5.0):
                 Classifier-free guidance scale. Controls prompt adherence vs. creativity.
                 If tuple, the first guide_scale will be used for low noise model and
                 the second guide_scale will be used for high noise model.
+            guide_interval (`GuidanceInterval`, *optional*, defaults to None):
+                Steps that run the unconditional forward for classifier-free
+                guidance; the others only run the conditional one. If None,
+                every step is guided.
             n_prompt (`str`, *optional*, defaults to ""):
                 Negative prompt for content exclusion. If not given, use `config.sample_neg_prompt`
             seed (`int`, *optional*, defaults to -1):
@@ -444,6 +491,21 @@ class WanS2V:
                 If True, offloads models to CPU during generation to save VRAM
             init_first_frame (`bool`, *optional*, defaults to False):
                 Whether to use the reference image as the first frame (i.e., standard image-to-video generation)
+            preview_callback (`callable`, *optional*, defaults to None):
+                Called on rank 0 every `preview_interval` steps of each clip as
+                `preview_callback(step, frames)` with a latent-resolution RGB
+                preview ([3, T, h, w] in [-1, 1]) of the clip's current
+                clean-video estimate. See `wan.utils.preview.LatentPreviewer`.
+            preview_interval (`int`, *optional*, defaults to 5):
+                Sampling steps between two previews.
+            step_callback (`callable`, *optional*, defaults to None):
+                Called on rank 0 after every sampling step as
+                `step_callback(info)` with a `StepInfo` of the step, its
+                timestep, expert and elapsed time and the clean-video estimate.
+                A truthy return stops sampling early and decodes that estimate.
+                Under torchrun, give it on every rank. See
+                `wan.utils.step_callback.StepReporter`. Stopping also skips
+                the remaining clips.
 
         Returns:
             torch.Tensor:
@@ -453,6 +515,17 @@ class WanS2V:
                 - H: Frame height (from max_area)
                 - W: Frame width from max_area)
         """
+        if n_prompt == "":
+            n_prompt = self.sample_neg_prompt
+
+        # text encoding overlaps with audio and VAE encoding when T5 is on CPU
+        if not self.t5_cpu:
+            self.text_encoder.model.to(self.device)
+        text_future = self.text_encoder.encode_async([input_prompt, n_prompt],
+                                                     self.device)
+        if offload_model and not self.t5_cpu:
+            self.text_encoder.model.cpu()
+
         # preprocess
         size = self.get_gen_size(
             size=None,
@@ -509,23 +582,18 @@ class WanS2V:
 
         seed = seed if seed >= 0 else random.randint(0, sys.maxsize)
 
-        if n_prompt == "":
-            n_prompt = self.sample_neg_prompt
-
-        # preprocess
-        if not self.t5_cpu:
-            self.text_encoder.model.to(self.device)
-            context = self.text_encoder([input_prompt], self.device)
-            context_null = self.text_encoder([n_prompt], self.device)
-            if offload_model:
-                self.text_encoder.model.cpu()
-        else:
-            context = self.text_encoder([input_prompt], torch.device('cpu'))
-            context_null = self.text_encoder([n_prompt], torch.device('cpu'))
-            context = [t.to(self.device) for t in context]
-            context_null = [t.to(self.device) for t in context_null]
+        context, context_null = text_future.result()
+        context, context_null = [context], [context_null]
 
         out = []
+        reporter = None
+        if step_callback is not None:
+            reporter = StepReporter(step_callback, sampling_steps,
+                                    self.num_train_timesteps, self.rank)
+        if preview_callback is not None and self.rank == 0:
+            # a first fit encodes calibration images, not inside the loop
+            previewer = LatentPreviewer.for_vae(self.vae)
+        stopped = False
         # evaluation mode
         with (
                 torch.amp.autocast('cuda', dtype=self.param_dtype),
@@ -568,6 +636,15 @@ class WanS2V:
                         sample_scheduler,
                         device=self.device,
                         sigmas=sampling_sigmas)
+                elif sample_solver == 'adaptive':
+                    sample_scheduler = FlowAdaptiveScheduler(
+                        num_train_timesteps=self.num_train_timesteps,
+                        tolerance=sample_tolerance)
+                    sample_scheduler.set_timesteps(
+                        sampling_steps,
+                        device=self.device,
+                        shift=shift)
+                    timesteps = sample_scheduler.timesteps
                 else:
                     raise NotImplementedError("Unsupported solver.")
 
@@ -608,6 +685,7 @@ class WanS2V:
                     self.noise_model.to(self.device)
                     torch.cuda.empty_cache()
 
+                num_unguided = 0
                 for i, t in enumerate(tqdm(timesteps)):
                     latent_model_input = latents[0:1]
                     timestep = [t]
@@ -617,7 +695,9 @@ class WanS2V:
                     noise_pred_cond = self.noise_model(
                         latent_model_input, t=timestep, **arg_c)
 
-                    if guide_scale > 1:
+                    if guide_scale > 1 and is_guided(
+                            guide_interval, t, i, len(timesteps),
+                            self.num_train_timesteps):
                         noise_pred_uncond = self.noise_model(
                             latent_model_input, t=timestep, **arg_null)
                         noise_pred = [
@@ -626,6 +706,13 @@ class WanS2V:
                         ]
                     else:
                         noise_pred = noise_pred_cond
+                        num_unguided += int(guide_scale > 1)
+
+                    if (preview_callback is not None and self.rank == 0 and
+                            (i + 1) % preview_interval == 0):
+                        x0_pred = flow_x0(latents[0], noise_pred[0], t,
+                                          self.num_train_timesteps)
+                        preview_callback(i + 1, previewer(x0_pred))
 
                     temp_x0 = sample_scheduler.step(
                         noise_pred[0].unsqueeze(0),
@@ -633,8 +720,24 @@ class WanS2V:
                         latents[0].unsqueeze(0),
                         return_dict=False,
                         generator=seed_g)[0]
-                    latents[0] = temp_x0.squeeze(0)
-
+                    latent, latents[0] = latents[0], temp_x0.squeeze(0)
+
+                    if reporter is not None:
+                        reporter.clip = r
+                        if reporter(i + 1, t, latent, noise_pred[0]):
+                            logging.info(f'Stopped early after step {i + 1} '
+                                         f'of clip {r}.')
+                            latents[0] = reporter.x0
+                            stopped = True
+                            break
+
+                if sample_solver == 'adaptive':
+                    logging.info(
+                        f'Adaptive solver used {sample_scheduler.nfe} function '
+                        f'evaluations of at most {sampling_steps}.')
+                if num_unguided:
+                    logging.info(f'Guidance interval skipped {num_unguided} '
+                                 f'unconditional forwards.')
                 if offload_model:
                     self.noise_model.cpu()
                     torch.cuda.synchronize()
@@ -644,7 +747,14 @@ class WanS2V:
                     decode_latents = torch.cat([motion_latents, latents], dim=2)
                 else:
                     decode_latents = torch.cat([ref_latents, latents], dim=2)
-                image = torch.stack(self.vae.decode(decode_latents))
+                if self.vae_parallel:
+                    # every rank needs the clip for the next motion latents
+                    image = torch.stack([
+                        parallel_decode(self.vae, u, dst=None)
+                        for u in decode_latents
+                    ])
+                else:
+                    image = torch.stack(self.vae.decode(decode_latents))
                 image = image[:, :, -(infer_frames):]
                 if (drop_first_motion and r == 0):
                     image = image[:, :, 3:]
@@ -660,6 +770,8 @@ class WanS2V:
                 motion_latents = torch.stack(
                     self.vae.encode(videos_last_frames))
                 out.append(image.cpu())
+                if stopped:
+                    break
 
         videos = torch.cat(out, dim=2)
         del noise, latents
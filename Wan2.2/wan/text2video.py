@@ -1,5 +1,6 @@
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
 import gc
+import hashlib
 import logging
 import math
 import os
@@ -17,15 +18,27 @@ from tqdm import tqdm
 from .distributed.fsdp import shard_model
 from .distributed.sequence_parallel import sp_attn_forward, sp_dit_forward
 from .distributed.util import get_world_size
+from .distributed.vae_parallel import parallel_decode
+from .modules.lora import LoraMerger
 from .modules.model import WanModel
-from .modules.t5 import T5EncoderModel
+from .modules.t5 import VERIFY_TEXTS, T5EncoderModel
 from .modules.vae2_1 import Wan2_1_VAE
+from .utils.cascade import draft_shape, reset_solver_history, upscale_latent
 from .utils.fm_solvers import (
     FlowDPMSolverMultistepScheduler,
     get_sampling_sigmas,
     retrieve_timesteps,
 )
+from .utils.fm_solvers_adaptive import FlowAdaptiveScheduler
+from .utils.fm_solvers_batched import (
+    BatchedFlowDPMSolverScheduler,
+    BatchedFlowUniPCScheduler,
+)
 from .utils.fm_solvers_unipc import FlowUniPCMultistepScheduler
+from .utils.guidance import expert_intervals, is_guided
+from .utils.preview import LatentPreviewer, flow_x0
+from .utils.sampling_checkpoint import remaining_timesteps
+from .utils.step_callback import StepReporter
 
 
 class WanT2V:
@@ -40,8 +53,11 @@ class WanT2V:
         dit_fsdp=False,
         use_sp=False,
         t5_cpu=False,
+        t5_int8=False,
+        t5_verify=False,
         init_on_cpu=True,
         convert_model_dtype=False,
+        vae_parallel=False,
     ):
         r"""
         Initializes the Wan text-to-video generation model components.
@@ -63,16 +79,27 @@ class WanT2V:
                 Enable distribution strategy of sequence parallel.
             t5_cpu (`bool`, *optional*, defaults to False):
                 Whether to place T5 model on CPU. Only works without t5_fsdp.
+            t5_int8 (`bool`, *optional*, defaults to False):
+                Quantize the CPU T5 model to int8 for faster text encoding. Only works with t5_cpu.
+            t5_verify (`bool`, *optional*, defaults to False):
+                Log the embedding error of the int8 T5 model against the
+                original one on a few fixed prompts. Only works with t5_int8.
             init_on_cpu (`bool`, *optional*, defaults to True):
                 Enable initializing Transformer Model on CPU. Only works without FSDP or USP.
             convert_model_dtype (`bool`, *optional*, defaults to False):
                 Convert DiT model parameters dtype to 'config.param_dtype'.
                 Only works without FSDP.
+            vae_parallel (`bool`, *optional*, defaults to False):
+                Decode the VAE on all ranks, each rank decoding a strip of the
+                latent, instead of on rank 0 only. Only works in distributed mode.
         """
         self.device = torch.device(f"cuda:{device_id}")
         self.config = config
         self.rank = rank
         self.t5_cpu = t5_cpu
+        self.vae_parallel = (
+            vae_parallel and dist.is_initialized() and
+            dist.get_world_size() > 1)
         self.init_on_cpu = init_on_cpu
 
         self.num_train_timesteps = config.num_train_timesteps
@@ -90,6 +117,10 @@ class WanT2V:
             checkpoint_path=os.path.join(checkpoint_dir, config.t5_checkpoint),
             tokenizer_path=os.path.join(checkpoint_dir, config.t5_tokenizer),
             shard_fn=shard_fn if t5_fsdp else None)
+        if t5_cpu and t5_int8:
+            self.text_encoder.optimize_for_cpu(
+                verify_texts=[*VERIFY_TEXTS, config.sample_neg_prompt]
+                if t5_verify else None)
 
         self.vae_stride = config.vae_stride
         self.patch_size = config.patch_size
@@ -200,6 +231,22 @@ class WanT2V:
                 getattr(self, required_model_name).to(self.device)
         return getattr(self, required_model_name)
 
+    def set_lora(self, low_noise=None, high_noise=None):
+        r"""
+        Merges LoRA adapters into the experts, replacing the ones merged
+        before. See `wan.modules.lora.LoraMerger`.
+
+        Args:
+            low_noise (`list[tuple[str, float]]`, *optional*, defaults to None):
+                `(path, scale)` of the adapters of the low noise model.
+            high_noise (`list[tuple[str, float]]`, *optional*, defaults to None):
+                Adapters of the high noise model. If None, `low_noise` is used.
+        """
+        low_noise = low_noise or []
+        high_noise = low_noise if high_noise is None else high_noise
+        LoraMerger.of(self.low_noise_model).set_adapters(low_noise)
+        LoraMerger.of(self.high_noise_model).set_adapters(high_noise)
+
     def generate(self,
                  input_prompt,
                  size=(1280, 720),
@@ -207,10 +254,22 @@ class WanT2V:
                  shift=5.0,
                  sample_solver='unipc',
                  sampling_steps=50,
+                 sample_tolerance=0.05,
                  guide_scale=5.0,
+                 guide_interval=None,
                  n_prompt="",
                  seed=-1,
-                 offload_model=True):
+                 offload_model=True,
+                 stream_output=False,
+                 preview_callback=None,
+                 preview_interval=5,
+                 step_callback=None,
+                 sampling_checkpoint=None,
+                 cascade_scale=None,
+                 cascade_switch=None,
+                 init_video=None,
+                 strength=0.8,
+                 num_variants=1):
         r"""
         Generates video frames from text prompt using diffusion process.
 
@@ -227,16 +286,71 @@ class WanT2V:
                 Solver used to sample the video.
             sampling_steps (`int`, *optional*, defaults to 50):
                 Number of diffusion sampling steps. Higher values improve quality but slow generation
+            sample_tolerance (`float`, *optional*, defaults to 0.05):
+                Local error tolerance of the 'adaptive' solver, which then takes
+                at most `sampling_steps` steps.
             guide_scale (`float` or tuple[`float`], *optional*, defaults 5.0):
                 Classifier-free guidance scale. Controls prompt adherence vs. creativity.
                 If tuple, the first guide_scale will be used for low noise model and
                 the second guide_scale will be used for high noise model.
+            guide_interval (`GuidanceInterval` or tuple, *optional*, defaults to None):
+                Steps that run the unconditional forward for classifier-free
+                guidance; the others only run the conditional one. If tuple,
+                the first interval is used for low noise model and the second
+                for high noise model. If None, every step is guided.
             n_prompt (`str`, *optional*, defaults to ""):
                 Negative prompt for content exclusion. If not given, use `config.sample_neg_prompt`
             seed (`int`, *optional*, defaults to -1):
                 Random seed for noise generation. If -1, use random seed.
             offload_model (`bool`, *optional*, defaults to True):
                 If True, offloads models to CPU during generation to save VRAM
+            stream_output (`bool`, *optional*, defaults to False):
+                If True, return a generator that decodes the video lazily and
+                yields float frame groups of shape (C, n, H, W), instead of the
+                whole video tensor. See `decode_stream` of the VAE.
+            preview_callback (`callable`, *optional*, defaults to None):
+                Called on rank 0 every `preview_interval` steps as
+                `preview_callback(step, frames)` with a latent-resolution RGB
+                preview ([3, T, h, w] in [-1, 1]) of the current clean-video
+                estimate. See `wan.utils.preview.LatentPreviewer`.
+            preview_interval (`int`, *optional*, defaults to 5):
+                Sampling steps between two previews.
+            step_callback (`callable`, *optional*, defaults to None):
+                Called on rank 0 after every sampling step as
+                `step_callback(info)` with a `StepInfo` of the step, its
+                timestep, expert and elapsed time and the clean-video estimate.
+                A truthy return stops sampling early and decodes that estimate.
+                Under torchrun, give it on every rank. See
+                `wan.utils.step_callback.StepReporter`.
+            sampling_checkpoint (`SamplingCheckpoint`, *optional*, defaults to None):
+                If given, the sampling state is saved to it periodically and
+                the run resumes from its snapshot of the same job, if any.
+                See `wan.utils.sampling_checkpoint.SamplingCheckpoint`.
+            cascade_scale (`float`, *optional*, defaults to None):
+                If given, the steps above `cascade_switch` draft the video at
+                this fraction of the latent height and width, where attention
+                is much cheaper. The clean estimate of the draft is then
+                upsampled, re-noised to the current sigma and finished at
+                full resolution.
+            cascade_switch (`float`, *optional*, defaults to None):
+                Sigma below which the cascade samples at full resolution. If
+                None, the expert boundary, so the high noise model drafts and
+                the low noise model refines.
+            init_video (`torch.Tensor`, *optional*, defaults to None):
+                Video to start from, [3, N, H, W] in [-1, 1] with at least
+                `frame_num` frames; it is resized to `size`. Its latent is
+                noised to the sigma `strength` of the way up the schedule,
+                and only the remaining steps run.
+            strength (`float`, *optional*, defaults to 0.8):
+                Fraction of the schedule run on `init_video`, in (0, 1]:
+                lower keeps more of the video and costs fewer steps.
+            num_variants (`int`, *optional*, defaults to 1):
+                If above 1, this many videos of the seeds `seed`, `seed + 1`,
+                ... are generated in one batched trajectory that encodes the
+                prompts once, see `generate_batch`, and their list is
+                returned. Not supported with the 'adaptive' solver,
+                `stream_output`, `sampling_checkpoint`, the cascade or
+                `init_video`.
 
         Returns:
             torch.Tensor:
@@ -246,9 +360,31 @@ class WanT2V:
                 - H: Frame height (from size)
                 - W: Frame width from size)
         """
+        if num_variants > 1:
+            assert not (stream_output or sampling_checkpoint is not None or
+                        cascade_scale is not None or init_video is not None), \
+                'variants are sampled without these options'
+            seed = seed if seed >= 0 else random.randint(0, sys.maxsize)
+            return self.generate_batch(
+                [input_prompt] * num_variants,
+                [seed + k for k in range(num_variants)],
+                size=size,
+                frame_num=frame_num,
+                shift=shift,
+                sample_solver=sample_solver,
+                sampling_steps=sampling_steps,
+                guide_scale=guide_scale,
+                guide_interval=guide_interval,
+                n_prompts=[n_prompt] * num_variants,
+                offload_model=offload_model,
+                preview_callback=preview_callback,
+                preview_interval=preview_interval,
+                step_callback=step_callback)
+
         # preprocess
         guide_scale = (guide_scale, guide_scale) if isinstance(
             guide_scale, float) else guide_scale
+        guide_interval = expert_intervals(guide_interval)
         F = frame_num
         target_shape = (self.vae.model.z_dim, (F - 1) // self.vae_stride[0] + 1,
                         size[1] // self.vae_stride[1],
@@ -260,21 +396,44 @@ class WanT2V:
 
         if n_prompt == "":
             n_prompt = self.sample_neg_prompt
+        if init_video is None:
+            strength = 1.0
+        else:
+            assert 0 < strength <= 1, 'strength must be in (0, 1]'
+            assert cascade_scale is None, \
+                'the cascade is not supported for video-to-video'
+            assert init_video.shape[1] >= F, \
+                f'init_video has fewer than {F} frames'
+            init_video = init_video[:, :F].float().cpu()
+            video_hash = hashlib.sha1(init_video.numpy().tobytes()).hexdigest()
+        job = dict(
+            task='t2v',
+            prompt=input_prompt,
+            n_prompt=n_prompt,
+            seed=seed,
+            shape=target_shape,
+            solver=sample_solver,
+            steps=sampling_steps,
+            tolerance=sample_tolerance,
+            shift=shift,
+            guide_scale=guide_scale,
+            guide_interval=repr(guide_interval),
+            cascade_scale=cascade_scale,
+            cascade_switch=cascade_switch,
+            video=None if init_video is None else video_hash,
+            strength=strength,
+            lora=(LoraMerger.adapters_of(self.low_noise_model),
+                  LoraMerger.adapters_of(self.high_noise_model)))
         seed = seed if seed >= 0 else random.randint(0, sys.maxsize)
         seed_g = torch.Generator(device=self.device)
         seed_g.manual_seed(seed)
 
         if not self.t5_cpu:
             self.text_encoder.model.to(self.device)
-            context = self.text_encoder([input_prompt], self.device)
-            context_null = self.text_encoder([n_prompt], self.device)
-            if offload_model:
-                self.text_encoder.model.cpu()
-        else:
-            context = self.text_encoder([input_prompt], torch.device('cpu'))
-            context_null = self.text_encoder([n_prompt], torch.device('cpu'))
-            context = [t.to(self.device) for t in context]
-            context_null = [t.to(self.device) for t in context_null]
+        text_future = self.text_encoder.encode_async([input_prompt, n_prompt],
+                                                     self.device)
+        if offload_model and not self.t5_cpu:
+            self.text_encoder.model.cpu()
 
         noise = [
             torch.randn(
@@ -286,6 +445,28 @@ class WanT2V:
                 device=self.device,
                 generator=seed_g)
         ]
+        drafting = cascade_scale is not None
+        if drafting:
+            if cascade_switch is None:
+                cascade_switch = self.boundary
+            assert 0 < cascade_switch < 1, 'cascade_switch is a sigma in (0, 1)'
+            shape = draft_shape(target_shape, cascade_scale, self.patch_size)
+            draft_seq_len = math.ceil(
+                (shape[2] * shape[3]) /
+                (self.patch_size[1] * self.patch_size[2]) * shape[1] /
+                self.sp_size) * self.sp_size
+            draft_noise = torch.randn(
+                *shape,
+                dtype=torch.float32,
+                device=self.device,
+                generator=seed_g)
+
+        if init_video is not None:
+            init_video = torch.nn.functional.interpolate(
+                init_video.transpose(0, 1),
+                size=(size[1], size[0]),
+                mode='bicubic').transpose(0, 1).clamp_(-1, 1)
+            z = self.vae.encode([init_video.to(self.device)])[0]
 
         @contextmanager
         def noop_no_sync():
@@ -323,16 +504,82 @@ class WanT2V:
                     sample_scheduler,
                     device=self.device,
                     sigmas=sampling_sigmas)
+            elif sample_solver == 'adaptive':
+                sample_scheduler = FlowAdaptiveScheduler(
+                    num_train_timesteps=self.num_train_timesteps,
+                    tolerance=sample_tolerance)
+                sample_scheduler.set_timesteps(
+                    sampling_steps,
+                    device=self.device,
+                    shift=shift,
+                    boundary=boundary,
+                    strength=strength)
+                timesteps = sample_scheduler.timesteps
             else:
                 raise NotImplementedError("Unsupported solver.")
 
             # sample videos
-            latents = noise
-
-            arg_c = {'context': context, 'seq_len': seq_len}
-            arg_null = {'context': context_null, 'seq_len': seq_len}
-
-            for _, t in enumerate(tqdm(timesteps)):
+            latents = [draft_noise] if drafting else noise
+            start_step = 0
+            if init_video is not None:
+                if sample_solver == 'adaptive':
+                    sigma = sample_scheduler.sigma
+                else:
+                    start_step = sampling_steps - max(
+                        1, round(strength * sampling_steps))
+                    sample_scheduler.set_begin_index(start_step)
+                    sigma = sample_scheduler.sigmas[start_step].item()
+                latents = [(1. - sigma) * z + sigma * noise[0]]
+                logging.info(f'Denoising the video from sigma {sigma:.3f}.')
+            if sampling_checkpoint is not None:
+                resumed = sampling_checkpoint.restore(job, sample_scheduler,
+                                                      seed_g, self.device)
+                if resumed is not None:
+                    start_step, latents = resumed[0], [resumed[1]]
+                    # snapshots are only taken at full resolution
+                    drafting = False
+            if drafting:
+                first_sigma = (
+                    sample_scheduler.sigma if sample_solver == 'adaptive' else
+                    timesteps[start_step].item() / self.num_train_timesteps)
+                # the switch upscales the clean estimate of a draft step
+                assert cascade_switch <= first_sigma, \
+                    f'cascade_switch {cascade_switch} leaves no draft step, ' \
+                    f'the first sigma is {first_sigma:.3f}'
+                draft_x0 = None
+
+            context, context_null = text_future.result()
+            context, context_null = [context], [context_null]
+            arg_c = {
+                'context': context,
+                'seq_len': draft_seq_len if drafting else seq_len
+            }
+            arg_null = {'context': context_null, 'seq_len': arg_c['seq_len']}
+
+            reporter = None
+            if step_callback is not None:
+                reporter = StepReporter(step_callback, len(timesteps),
+                                        self.num_train_timesteps, self.rank)
+            if preview_callback is not None and self.rank == 0:
+                # a first fit encodes calibration images, not inside the loop
+                previewer = LatentPreviewer.for_vae(self.vae)
+
+            num_unguided = 0
+            for i, t in enumerate(
+                    tqdm(remaining_timesteps(timesteps, start_step)),
+                    start_step):
+                if drafting and t.item(
+                ) < cascade_switch * self.num_train_timesteps:
+                    # finish at full resolution from the layout of the draft
+                    latents = [
+                        upscale_latent(draft_x0, noise[0],
+                                       t.item() / self.num_train_timesteps)
+                    ]
+                    reset_solver_history(sample_scheduler)
+                    arg_c['seq_len'] = arg_null['seq_len'] = seq_len
+                    drafting = False
+                    logging.info(f'Drafted {i} steps at {shape[2]}x{shape[3]} '
+                                 f'latents.')
                 latent_model_input = latents
                 timestep = [t]
 
@@ -342,14 +589,31 @@ class WanT2V:
                     t, boundary, offload_model)
                 sample_guide_scale = guide_scale[1] if t.item(
                 ) >= boundary else guide_scale[0]
+                sample_guide_interval = guide_interval[1] if t.item(
+                ) >= boundary else guide_interval[0]
 
                 noise_pred_cond = model(
                     latent_model_input, t=timestep, **arg_c)[0]
-                noise_pred_uncond = model(
-                    latent_model_input, t=timestep, **arg_null)[0]
-
-                noise_pred = noise_pred_uncond + sample_guide_scale * (
-                    noise_pred_cond - noise_pred_uncond)
+                if is_guided(sample_guide_interval, t, i, len(timesteps),
+                             self.num_train_timesteps, sample_guide_scale):
+                    noise_pred_uncond = model(
+                        latent_model_input, t=timestep, **arg_null)[0]
+
+                    noise_pred = noise_pred_uncond + sample_guide_scale * (
+                        noise_pred_cond - noise_pred_uncond)
+                else:
+                    noise_pred = noise_pred_cond
+                    num_unguided += 1
+
+                if drafting:
+                    draft_x0 = flow_x0(latents[0], noise_pred, t,
+                                       self.num_train_timesteps)
+
+                if (preview_callback is not None and self.rank == 0 and
+                        (i + 1) % preview_interval == 0):
+                    x0_pred = flow_x0(latents[0], noise_pred, t,
+                                      self.num_train_timesteps)
+                    preview_callback(i + 1, previewer(x0_pred))
 
                 temp_x0 = sample_scheduler.step(
                     noise_pred.unsqueeze(0),
@@ -357,15 +621,59 @@ class WanT2V:
                     latents[0].unsqueeze(0),
                     return_dict=False,
                     generator=seed_g)[0]
-                latents = [temp_x0.squeeze(0)]
-
+                latent, latents = latents[0], [temp_x0.squeeze(0)]
+
+                if (sampling_checkpoint is not None and self.rank == 0 and
+                        not drafting):
+                    sampling_checkpoint.save(
+                        job,
+                        i + 1,
+                        latents[0],
+                        sample_scheduler,
+                        seed_g,
+                        expert='high_noise'
+                        if t.item() >= boundary else 'low_noise')
+
+                if reporter is not None and reporter(
+                        i + 1,
+                        t,
+                        latent,
+                        noise_pred,
+                        expert='high_noise'
+                        if t.item() >= boundary else 'low_noise'):
+                    logging.info(f'Stopped early after step {i + 1}.')
+                    latents = [reporter.x0]
+                    break
+
+            if drafting:
+                latents = [upscale_latent(latents[0], noise[0], 0.)]
             x0 = latents
+            if sampling_checkpoint is not None and self.rank == 0:
+                sampling_checkpoint.save(
+                    job,
+                    len(timesteps),
+                    x0[0],
+                    sample_scheduler,
+                    seed_g,
+                    final=True)
+            if sample_solver == 'adaptive':
+                logging.info(
+                    f'Adaptive solver used {sample_scheduler.nfe} function '
+                    f'evaluations of at most {sampling_steps}.')
+            if num_unguided:
+                logging.info(f'Guidance interval skipped {num_unguided} '
+                             f'unconditional forwards.')
             if offload_model:
                 self.low_noise_model.cpu()
                 self.high_noise_model.cpu()
                 torch.cuda.empty_cache()
-            if self.rank == 0:
-                videos = self.vae.decode(x0)
+            if self.vae_parallel:
+                videos = [parallel_decode(self.vae, x0[0])]
+            elif self.rank == 0:
+                if stream_output:
+                    videos = [self.vae.decode_stream(x0[0])]
+                else:
+                    videos = self.vae.decode(x0)
 
         del noise, latents
         del sample_scheduler
@@ -376,3 +684,201 @@ class WanT2V:
             dist.barrier()
 
         return videos[0] if self.rank == 0 else None
+
+    def generate_batch(self,
+                       input_prompts,
+                       seeds,
+                       size=(1280, 720),
+                       frame_num=81,
+                       shift=5.0,
+                       sample_solver='unipc',
+                       sampling_steps=50,
+                       guide_scale=5.0,
+                       guide_interval=None,
+                       n_prompts=None,
+                       offload_model=True,
+                       preview_callback=None,
+                       preview_interval=5,
+                       step_callback=None):
+        r"""
+        Generates several videos of the same size and schedule with shared
+        DiT forwards: every row has its own prompt and seed, and a batched
+        scheduler steps all rows together. A row matches the video of
+        `generate` with the same prompt and seed, up to batched-kernel
+        numerics. The arguments not listed are those of `generate`;
+        `sample_solver` is 'unipc' or 'dpm++'.
+
+        Args:
+            input_prompts (`list[str]`):
+                Text prompt of every video.
+            seeds (`list[int]`):
+                Seed of every video. -1 draws a random seed.
+            n_prompts (`list[str]`, *optional*, defaults to None):
+                Negative prompt of every video. Empty or None uses
+                `config.sample_neg_prompt`.
+            preview_callback (`callable`, *optional*, defaults to None):
+                Called on rank 0 every `preview_interval` steps as
+                `preview_callback(step, frames)` with the list of previews of
+                all rows, as in `generate`.
+
+        Returns:
+            list[torch.Tensor]:
+                Generated video of every row, (C, N, H, W), on rank 0.
+        """
+        assert len(input_prompts) == len(seeds), \
+            'every prompt needs a seed'
+        batch_size = len(input_prompts)
+        # preprocess
+        guide_scale = (guide_scale, guide_scale) if isinstance(
+            guide_scale, float) else guide_scale
+        guide_interval = expert_intervals(guide_interval)
+        F = frame_num
+        target_shape = (self.vae.model.z_dim, (F - 1) // self.vae_stride[0] + 1,
+                        size[1] // self.vae_stride[1],
+                        size[0] // self.vae_stride[2])
+
+        seq_len = math.ceil((target_shape[2] * target_shape[3]) /
+                            (self.patch_size[1] * self.patch_size[2]) *
+                            target_shape[1] / self.sp_size) * self.sp_size
+
+        n_prompts = [p or self.sample_neg_prompt
+                     for p in (n_prompts or [''] * batch_size)]
+
+        if not self.t5_cpu:
+            self.text_encoder.model.to(self.device)
+        # duplicate prompts, typically the negative ones, are encoded once
+        text_future = self.text_encoder.encode_async(
+            list(input_prompts) + n_prompts, self.device)
+        if offload_model and not self.t5_cpu:
+            self.text_encoder.model.cpu()
+
+        noise = []
+        for seed in seeds:
+            seed = seed if seed >= 0 else random.randint(0, sys.maxsize)
+            seed_g = torch.Generator(device=self.device)
+            seed_g.manual_seed(seed)
+            noise.append(
+                torch.randn(
+                    *target_shape,
+                    dtype=torch.float32,
+                    device=self.device,
+                    generator=seed_g))
+
+        @contextmanager
+        def noop_no_sync():
+            yield
+
+        no_sync_low_noise = getattr(self.low_noise_model, 'no_sync',
+                                    noop_no_sync)
+        no_sync_high_noise = getattr(self.high_noise_model, 'no_sync',
+                                     noop_no_sync)
+
+        # evaluation mode
+        with (
+                torch.amp.autocast('cuda', dtype=self.param_dtype),
+                torch.no_grad(),
+                no_sync_low_noise(),
+                no_sync_high_noise(),
+        ):
+            boundary = self.boundary * self.num_train_timesteps
+
+            if sample_solver == 'unipc':
+                sample_scheduler = BatchedFlowUniPCScheduler(
+                    num_train_timesteps=self.num_train_timesteps)
+            elif sample_solver == 'dpm++':
+                sample_scheduler = BatchedFlowDPMSolverScheduler(
+                    num_train_timesteps=self.num_train_timesteps)
+            else:
+                raise NotImplementedError(
+                    "Unsupported solver for batched sampling.")
+            slots = [
+                sample_scheduler.add_request(sampling_steps, shift=shift)
+                for _ in range(batch_size)
+            ]
+
+            # sample videos
+            latents = torch.stack(noise)
+
+            contexts = text_future.result()
+            arg_c = {'context': contexts[:batch_size], 'seq_len': seq_len}
+            arg_null = {'context': contexts[batch_size:], 'seq_len': seq_len}
+
+            reporter = None
+            if step_callback is not None:
+                reporter = StepReporter(step_callback, sampling_steps,
+                                        self.num_train_timesteps, self.rank)
+            if preview_callback is not None and self.rank == 0:
+                # a first fit encodes calibration images, not inside the loop
+                previewer = LatentPreviewer.for_vae(self.vae)
+
+            num_unguided = 0
+            for i in tqdm(range(sampling_steps)):
+                timestep = sample_scheduler.timesteps(slots, self.device)
+                # the rows share the schedule, so the step and the expert
+                t = timestep[0]
+
+                model = self._prepare_model_for_timestep(
+                    t, boundary, offload_model)
+                sample_guide_scale = guide_scale[1] if t.item(
+                ) >= boundary else guide_scale[0]
+                sample_guide_interval = guide_interval[1] if t.item(
+                ) >= boundary else guide_interval[0]
+
+                latent_model_input = list(latents.unbind(0))
+                noise_pred_cond = torch.stack(
+                    model(latent_model_input, t=timestep, **arg_c))
+                if is_guided(sample_guide_interval, t, i, sampling_steps,
+                             self.num_train_timesteps, sample_guide_scale):
+                    noise_pred_uncond = torch.stack(
+                        model(latent_model_input, t=timestep, **arg_null))
+
+                    noise_pred = noise_pred_uncond + sample_guide_scale * (
+                        noise_pred_cond - noise_pred_uncond)
+                else:
+                    noise_pred = noise_pred_cond
+                    num_unguided += 1
+
+                if (preview_callback is not None and self.rank == 0 and
+                        (i + 1) % preview_interval == 0):
+                    preview_callback(i + 1, [
+                        previewer(
+                            flow_x0(u, v, t, self.num_train_timesteps))
+                        for u, v in zip(latents, noise_pred)
+                    ])
+
+                latent, latents = latents, sample_scheduler.step(
+                    noise_pred, slots, latents, return_dict=False)[0]
+
+                if reporter is not None and reporter(
+                        i + 1,
+                        t,
+                        latent,
+                        noise_pred,
+                        expert='high_noise'
+                        if t.item() >= boundary else 'low_noise'):
+                    logging.info(f'Stopped early after step {i + 1}.')
+                    latents = reporter.x0
+                    break
+
+            x0 = list(latents.unbind(0))
+            if num_unguided:
+                logging.info(f'Guidance interval skipped {num_unguided} '
+                             f'unconditional forwards.')
+            if offload_model:
+                self.low_noise_model.cpu()
+                self.high_noise_model.cpu()
+                torch.cuda.empty_cache()
+            if self.vae_parallel:
+                videos = [parallel_decode(self.vae, u) for u in x0]
+            elif self.rank == 0:
+                videos = self.vae.decode(x0)
+
+        del noise, latents
+        del sample_scheduler
+        if offload_model:
+            gc.collect()
+            torch.cuda.synchronize()
+        if dist.is_initialized():
+            dist.barrier()
+
+        return videos if self.rank == 0 else None
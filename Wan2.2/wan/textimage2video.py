@@ -1,5 +1,6 @@
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
 import gc
+import hashlib
 import logging
 import math
 import os
@@ -19,15 +20,27 @@ from tqdm import tqdm
 from .distributed.fsdp import shard_model
 from .distributed.sequence_parallel import sp_attn_forward, sp_dit_forward
 from .distributed.util import get_world_size
+from .distributed.vae_parallel import parallel_decode
+from .modules.lora import LoraMerger
 from .modules.model import WanModel
-from .modules.t5 import T5EncoderModel
+from .modules.t5 import VERIFY_TEXTS, T5EncoderModel
 from .modules.vae2_2 import Wan2_2_VAE
+from .utils.cascade import draft_shape, reset_solver_history, upscale_latent
 from .utils.fm_solvers import (
     FlowDPMSolverMultistepScheduler,
     get_sampling_sigmas,
     retrieve_timesteps,
 )
+from .utils.fm_solvers_adaptive import FlowAdaptiveScheduler
+from .utils.fm_solvers_batched import (
+    BatchedFlowDPMSolverScheduler,
+    BatchedFlowUniPCScheduler,
+)
 from .utils.fm_solvers_unipc import FlowUniPCMultistepScheduler
+from .utils.guidance import is_guided
+from .utils.preview import LatentPreviewer, flow_x0
+from .utils.sampling_checkpoint import remaining_timesteps
+from .utils.step_callback import StepReporter
 from .utils.utils import best_output_size, masks_like
 
 
@@ -43,8 +56,11 @@ class WanTI2V:
         dit_fsdp=False,
         use_sp=False,
         t5_cpu=False,
+        t5_int8=False,
+        t5_verify=False,
         init_on_cpu=True,
         convert_model_dtype=False,
+        vae_parallel=False,
     ):
         r"""
         Initializes the Wan text-to-video generation model components.
@@ -66,16 +82,27 @@ class WanTI2V:
                 Enable distribution strategy of sequence parallel.
             t5_cpu (`bool`, *optional*, defaults to False):
                 Whether to place T5 model on CPU. Only works without t5_fsdp.
+            t5_int8 (`bool`, *optional*, defaults to False):
+                Quantize the CPU T5 model to int8 for faster text encoding. Only works with t5_cpu.
+            t5_verify (`bool`, *optional*, defaults to False):
+                Log the embedding error of the int8 T5 model against the
+                original one on a few fixed prompts. Only works with t5_int8.
             init_on_cpu (`bool`, *optional*, defaults to True):
                 Enable initializing Transformer Model on CPU. Only works without FSDP or USP.
             convert_model_dtype (`bool`, *optional*, defaults to False):
                 Convert DiT model parameters dtype to 'config.param_dtype'.
                 Only works without FSDP.
+            vae_parallel (`bool`, *optional*, defaults to False):
+                Decode the VAE on all ranks, each rank decoding a strip of the
+                latent, instead of on rank 0 only. Only works in distributed mode.
         """
         self.device = torch.device(f"cuda:{device_id}")
         self.config = config
         self.rank = rank
         self.t5_cpu = t5_cpu
+        self.vae_parallel = (
+            vae_parallel and dist.is_initialized() and
+            dist.get_world_size() > 1)
         self.init_on_cpu = init_on_cpu
 
         self.num_train_timesteps = config.num_train_timesteps
@@ -92,6 +119,10 @@ class WanTI2V:
             checkpoint_path=os.path.join(checkpoint_dir, config.t5_checkpoint),
             tokenizer_path=os.path.join(checkpoint_dir, config.t5_tokenizer),
             shard_fn=shard_fn if t5_fsdp else None)
+        if t5_cpu and t5_int8:
+            self.text_encoder.optimize_for_cpu(
+                verify_texts=[*VERIFY_TEXTS, config.sample_neg_prompt]
+                if t5_verify else None)
 
         self.vae_stride = config.vae_stride
         self.patch_size = config.patch_size
@@ -159,6 +190,17 @@ class WanTI2V:
 
         return model
 
+    def set_lora(self, adapters=None):
+        r"""
+        Merges LoRA adapters into the DiT, replacing the ones merged before.
+        See `wan.modules.lora.LoraMerger`.
+
+        Args:
+            adapters (`list[tuple[str, float]]`, *optional*, defaults to None):
+                `(path, scale)` of every adapter.
+        """
+        LoraMerger.of(self.model).set_adapters(adapters or [])
+
     def generate(self,
                  input_prompt,
                  img=None,
@@ -168,10 +210,22 @@ class WanTI2V:
                  shift=5.0,
                  sample_solver='unipc',
                  sampling_steps=50,
+                 sample_tolerance=0.05,
                  guide_scale=5.0,
+                 guide_interval=None,
                  n_prompt="",
                  seed=-1,
-                 offload_model=False):  # WELL optimization: Changed to False
+                 offload_model=False,  # WELL optimization: Changed to False
+                 stream_output=False,
+                 preview_callback=None,
+                 preview_interval=5,
+                 step_callback=None,
+                 sampling_checkpoint=None,
+                 cascade_scale=None,
+                 cascade_switch=None,
+                 init_video=None,
+                 strength=0.8,
+                 num_variants=1):
         r"""
         Generates video frames from text prompt using diffusion process.
 
@@ -192,14 +246,67 @@ class WanTI2V:
                 Solver used to sample the video.
             sampling_steps (`int`, *optional*, defaults to 50):
                 Number of diffusion sampling steps. Higher values improve quality but slow generation
+            sample_tolerance (`float`, *optional*, defaults to 0.05):
+                Local error tolerance of the 'adaptive' solver, which then takes
+                at most `sampling_steps` steps.
             guide_scale (`float`, *optional*, defaults 5.0):
                 Classifier-free guidance scale. Controls prompt adherence vs. creativity.
+            guide_interval (`GuidanceInterval`, *optional*, defaults to None):
+                Steps that run the unconditional forward for classifier-free
+                guidance; the others only run the conditional one. If None,
+                every step is guided.
             n_prompt (`str`, *optional*, defaults to ""):
                 Negative prompt for content exclusion. If not given, use `config.sample_neg_prompt`
             seed (`int`, *optional*, defaults to -1):
                 Random seed for noise generation. If -1, use random seed.
             offload_model (`bool`, *optional*, defaults to False):
                 If True, offloads models to CPU during generation to save VRAM. False is faster on Windows
+            stream_output (`bool`, *optional*, defaults to False):
+                If True, return a generator that decodes the video lazily and
+                yields float frame groups of shape (C, n, H, W), instead of the
+                whole video tensor. See `decode_stream` of the VAE.
+            preview_callback (`callable`, *optional*, defaults to None):
+                Called on rank 0 every `preview_interval` steps as
+                `preview_callback(step, frames)` with a latent-resolution RGB
+                preview ([3, T, h, w] in [-1, 1]) of the current clean-video
+                estimate. See `wan.utils.preview.LatentPreviewer`.
+            preview_interval (`int`, *optional*, defaults to 5):
+                Sampling steps between two previews.
+            step_callback (`callable`, *optional*, defaults to None):
+                Called on rank 0 after every sampling step as
+                `step_callback(info)` with a `StepInfo` of the step, its
+                timestep, expert and elapsed time and the clean-video estimate.
+                A truthy return stops sampling early and decodes that estimate.
+                Under torchrun, give it on every rank. See
+                `wan.utils.step_callback.StepReporter`.
+            sampling_checkpoint (`SamplingCheckpoint`, *optional*, defaults to None):
+                If given, the sampling state is saved to it periodically and
+                the run resumes from its snapshot of the same job, if any.
+                See `wan.utils.sampling_checkpoint.SamplingCheckpoint`.
+            cascade_scale (`float`, *optional*, defaults to None):
+                If given, the steps above `cascade_switch` draft the video at
+                this fraction of the latent height and width, where attention
+                is much cheaper. The clean estimate of the draft is then
+                upsampled, re-noised to the current sigma and finished at
+                full resolution. Text-to-video only.
+            cascade_switch (`float`, *optional*, defaults to 0.875):
+                Sigma below which the cascade samples at full resolution. The
+                default is the expert boundary of T2V-A14B.
+            init_video (`torch.Tensor`, *optional*, defaults to None):
+                Video to start from, [3, N, H, W] in [-1, 1] with at least
+                `frame_num` frames; it is resized to `size`. Its latent is
+                noised to the sigma `strength` of the way up the schedule,
+                and only the remaining steps run. Text-to-video only.
+            strength (`float`, *optional*, defaults to 0.8):
+                Fraction of the schedule run on `init_video`, in (0, 1]:
+                lower keeps more of the video and costs fewer steps.
+            num_variants (`int`, *optional*, defaults to 1):
+                If above 1, this many videos of the seeds `seed`, `seed + 1`,
+                ... are generated in one batched trajectory that encodes the
+                prompts and the image once, see `generate_batch`, and their
+                list is returned. Not supported with the 'adaptive' solver,
+                `stream_output`, `sampling_checkpoint`, the cascade or
+                `init_video`.
 
         Returns:
             torch.Tensor:
@@ -211,6 +318,8 @@ class WanTI2V:
         """
         # i2v
         if img is not None:
+            assert cascade_scale is None and init_video is None, \
+                'the cascade and init_video are text-to-video only'
             return self.i2v(
                 input_prompt=input_prompt,
                 img=img,
@@ -219,10 +328,18 @@ class WanTI2V:
                 shift=shift,
                 sample_solver=sample_solver,
                 sampling_steps=sampling_steps,
+                sample_tolerance=sample_tolerance,
                 guide_scale=guide_scale,
+                guide_interval=guide_interval,
                 n_prompt=n_prompt,
                 seed=seed,
-                offload_model=offload_model)
+                offload_model=offload_model,
+                stream_output=stream_output,
+                preview_callback=preview_callback,
+                preview_interval=preview_interval,
+                step_callback=step_callback,
+                sampling_checkpoint=sampling_checkpoint,
+                num_variants=num_variants)
         # t2v
         return self.t2v(
             input_prompt=input_prompt,
@@ -231,10 +348,22 @@ class WanTI2V:
             shift=shift,
             sample_solver=sample_solver,
             sampling_steps=sampling_steps,
+            sample_tolerance=sample_tolerance,
             guide_scale=guide_scale,
+            guide_interval=guide_interval,
             n_prompt=n_prompt,
             seed=seed,
-            offload_model=offload_model)
+            offload_model=offload_model,
+            stream_output=stream_output,
+            preview_callback=preview_callback,
+            preview_interval=preview_interval,
+            step_callback=step_callback,
+            sampling_checkpoint=sampling_checkpoint,
+            cascade_scale=cascade_scale,
+            cascade_switch=cascade_switch,
+            init_video=init_video,
+            strength=strength,
+            num_variants=num_variants)
 
     def t2v(self,
             input_prompt,
@@ -243,10 +372,22 @@ class WanTI2V:
             shift=5.0,
             sample_solver='unipc',
             sampling_steps=50,
+            sample_tolerance=0.05,
             guide_scale=5.0,
+            guide_interval=None,
             n_prompt="",
             seed=-1,
-            offload_model=False):  # WELL optimization: Changed to False
+            offload_model=False,  # WELL optimization: Changed to False
+            stream_output=False,
+            preview_callback=None,
+            preview_interval=5,
+            step_callback=None,
+            sampling_checkpoint=None,
+            cascade_scale=None,
+            cascade_switch=None,
+            init_video=None,
+            strength=0.8,
+            num_variants=1):
         r"""
         Generates video frames from text prompt using diffusion process.
 
@@ -263,14 +404,67 @@ class WanTI2V:
                 Solver used to sample the video.
             sampling_steps (`int`, *optional*, defaults to 50):
                 Number of diffusion sampling steps. Higher values improve quality but slow generation
+            sample_tolerance (`float`, *optional*, defaults to 0.05):
+                Local error tolerance of the 'adaptive' solver, which then takes
+                at most `sampling_steps` steps.
             guide_scale (`float`, *optional*, defaults 5.0):
                 Classifier-free guidance scale. Controls prompt adherence vs. creativity.
+            guide_interval (`GuidanceInterval`, *optional*, defaults to None):
+                Steps that run the unconditional forward for classifier-free
+                guidance; the others only run the conditional one. If None,
+                every step is guided.
             n_prompt (`str`, *optional*, defaults to ""):
                 Negative prompt for content exclusion. If not given, use `config.sample_neg_prompt`
             seed (`int`, *optional*, defaults to -1):
                 Random seed for noise generation. If -1, use random seed.
             offload_model (`bool`, *optional*, defaults to False):
                 If True, offloads models to CPU during generation to save VRAM. False is faster on Windows
+            stream_output (`bool`, *optional*, defaults to False):
+                If True, return a generator that decodes the video lazily and
+                yields float frame groups of shape (C, n, H, W), instead of the
+                whole video tensor. See `decode_stream` of the VAE.
+            preview_callback (`callable`, *optional*, defaults to None):
+                Called on rank 0 every `preview_interval` steps as
+                `preview_callback(step, frames)` with a latent-resolution RGB
+                preview ([3, T, h, w] in [-1, 1]) of the current clean-video
+                estimate. See `wan.utils.preview.LatentPreviewer`.
+            preview_interval (`int`, *optional*, defaults to 5):
+                Sampling steps between two previews.
+            step_callback (`callable`, *optional*, defaults to None):
+                Called on rank 0 after every sampling step as
+                `step_callback(info)` with a `StepInfo` of the step, its
+                timestep, expert and elapsed time and the clean-video estimate.
+                A truthy return stops sampling early and decodes that estimate.
+                Under torchrun, give it on every rank. See
+                `wan.utils.step_callback.StepReporter`.
+            sampling_checkpoint (`SamplingCheckpoint`, *optional*, defaults to None):
+                If given, the sampling state is saved to it periodically and
+                the run resumes from its snapshot of the same job, if any.
+                See `wan.utils.sampling_checkpoint.SamplingCheckpoint`.
+            cascade_scale (`float`, *optional*, defaults to None):
+                If given, the steps above `cascade_switch` draft the video at
+                this fraction of the latent height and width, where attention
+                is much cheaper. The clean estimate of the draft is then
+                upsampled, re-noised to the current sigma and finished at
+                full resolution.
+            cascade_switch (`float`, *optional*, defaults to 0.875):
+                Sigma below which the cascade samples at full resolution. The
+                default is the expert boundary of T2V-A14B.
+            init_video (`torch.Tensor`, *optional*, defaults to None):
+                Video to start from, [3, N, H, W] in [-1, 1] with at least
+                `frame_num` frames; it is resized to `size`. Its latent is
+                noised to the sigma `strength` of the way up the schedule,
+                and only the remaining steps run.
+            strength (`float`, *optional*, defaults to 0.8):
+                Fraction of the schedule run on `init_video`, in (0, 1]:
+                lower keeps more of the video and costs fewer steps.
+            num_variants (`int`, *optional*, defaults to 1):
+                If above 1, this many videos of the seeds `seed`, `seed + 1`,
+                ... are generated in one batched trajectory that encodes the
+                prompts once, see `generate_batch`, and their list is
+                returned. Not supported with the 'adaptive' solver,
+                `stream_output`, `sampling_checkpoint`, the cascade or
+                `init_video`.
 
         Returns:
             torch.Tensor:
@@ -280,6 +474,27 @@ class WanTI2V:
                 - H: Frame height (from size)
                 - W: Frame width from size)
         """
+        if num_variants > 1:
+            assert not (stream_output or sampling_checkpoint is not None or
+                        cascade_scale is not None or init_video is not None), \
+                'variants are sampled without these options'
+            seed = seed if seed >= 0 else random.randint(0, sys.maxsize)
+            return self.generate_batch(
+                [input_prompt] * num_variants,
+                [seed + k for k in range(num_variants)],
+                size=size,
+                frame_num=frame_num,
+                shift=shift,
+                sample_solver=sample_solver,
+                sampling_steps=sampling_steps,
+                guide_scale=guide_scale,
+                guide_interval=guide_interval,
+                n_prompts=[n_prompt] * num_variants,
+                offload_model=offload_model,
+                preview_callback=preview_callback,
+                preview_interval=preview_interval,
+                step_callback=step_callback)
+
         # preprocess
         F = frame_num
         target_shape = (self.vae.model.z_dim, (F - 1) // self.vae_stride[0] + 1,
@@ -292,21 +507,43 @@ class WanTI2V:
 
         if n_prompt == "":
             n_prompt = self.sample_neg_prompt
+        if init_video is None:
+            strength = 1.0
+        else:
+            assert 0 < strength <= 1, 'strength must be in (0, 1]'
+            assert cascade_scale is None, \
+                'the cascade is not supported for video-to-video'
+            assert init_video.shape[1] >= F, \
+                f'init_video has fewer than {F} frames'
+            init_video = init_video[:, :F].float().cpu()
+            video_hash = hashlib.sha1(init_video.numpy().tobytes()).hexdigest()
+        job = dict(
+            task='ti2v-t2v',
+            prompt=input_prompt,
+            n_prompt=n_prompt,
+            shape=target_shape,
+            seed=seed,
+            solver=sample_solver,
+            steps=sampling_steps,
+            tolerance=sample_tolerance,
+            shift=shift,
+            guide_scale=guide_scale,
+            guide_interval=repr(guide_interval),
+            cascade_scale=cascade_scale,
+            cascade_switch=cascade_switch,
+            video=None if init_video is None else video_hash,
+            strength=strength,
+            lora=LoraMerger.adapters_of(self.model))
         seed = seed if seed >= 0 else random.randint(0, sys.maxsize)
         seed_g = torch.Generator(device=self.device)
         seed_g.manual_seed(seed)
 
         if not self.t5_cpu:
             self.text_encoder.model.to(self.device)
-            context = self.text_encoder([input_prompt], self.device)
-            context_null = self.text_encoder([n_prompt], self.device)
-            if offload_model:
-                self.text_encoder.model.cpu()
-        else:
-            context = self.text_encoder([input_prompt], torch.device('cpu'))
-            context_null = self.text_encoder([n_prompt], torch.device('cpu'))
-            context = [t.to(self.device) for t in context]
-            context_null = [t.to(self.device) for t in context_null]
+        text_future = self.text_encoder.encode_async([input_prompt, n_prompt],
+                                                     self.device)
+        if offload_model and not self.t5_cpu:
+            self.text_encoder.model.cpu()
 
         noise = [
             torch.randn(
@@ -318,6 +555,28 @@ class WanTI2V:
                 device=self.device,
                 generator=seed_g)
         ]
+        drafting = cascade_scale is not None
+        if drafting:
+            if cascade_switch is None:
+                cascade_switch = 0.875
+            assert 0 < cascade_switch < 1, 'cascade_switch is a sigma in (0, 1)'
+            shape = draft_shape(target_shape, cascade_scale, self.patch_size)
+            draft_seq_len = math.ceil(
+                (shape[2] * shape[3]) /
+                (self.patch_size[1] * self.patch_size[2]) * shape[1] /
+                self.sp_size) * self.sp_size
+            draft_noise = torch.randn(
+                *shape,
+                dtype=torch.float32,
+                device=self.device,
+                generator=seed_g)
+
+        if init_video is not None:
+            init_video = torch.nn.functional.interpolate(
+                init_video.transpose(0, 1),
+                size=(size[1], size[0]),
+                mode='bicubic').transpose(0, 1).clamp_(-1, 1)
+            z = self.vae.encode([init_video.to(self.device)])[0]
 
         @contextmanager
         def noop_no_sync():
@@ -350,21 +609,87 @@ class WanTI2V:
                     sample_scheduler,
                     device=self.device,
                     sigmas=sampling_sigmas)
+            elif sample_solver == 'adaptive':
+                sample_scheduler = FlowAdaptiveScheduler(
+                    num_train_timesteps=self.num_train_timesteps,
+                    tolerance=sample_tolerance)
+                sample_scheduler.set_timesteps(
+                    sampling_steps,
+                    device=self.device,
+                    shift=shift,
+                    strength=strength)
+                timesteps = sample_scheduler.timesteps
             else:
                 raise NotImplementedError("Unsupported solver.")
 
             # sample videos
-            latents = noise
-            mask1, mask2 = masks_like(noise, zero=False)
-
-            arg_c = {'context': context, 'seq_len': seq_len}
-            arg_null = {'context': context_null, 'seq_len': seq_len}
+            latents = [draft_noise] if drafting else noise
+            start_step = 0
+            if init_video is not None:
+                if sample_solver == 'adaptive':
+                    sigma = sample_scheduler.sigma
+                else:
+                    start_step = sampling_steps - max(
+                        1, round(strength * sampling_steps))
+                    sample_scheduler.set_begin_index(start_step)
+                    sigma = sample_scheduler.sigmas[start_step].item()
+                latents = [(1. - sigma) * z + sigma * noise[0]]
+                logging.info(f'Denoising the video from sigma {sigma:.3f}.')
+            if sampling_checkpoint is not None:
+                resumed = sampling_checkpoint.restore(job, sample_scheduler,
+                                                      seed_g, self.device)
+                if resumed is not None:
+                    start_step, latents = resumed[0], [resumed[1]]
+                    # snapshots are only taken at full resolution
+                    drafting = False
+            if drafting:
+                first_sigma = (
+                    sample_scheduler.sigma if sample_solver == 'adaptive' else
+                    timesteps[start_step].item() / self.num_train_timesteps)
+                # the switch upscales the clean estimate of a draft step
+                assert cascade_switch <= first_sigma, \
+                    f'cascade_switch {cascade_switch} leaves no draft step, ' \
+                    f'the first sigma is {first_sigma:.3f}'
+                draft_x0 = None
+            mask1, mask2 = masks_like(latents, zero=False)
 
             if offload_model or self.init_on_cpu:
                 self.model.to(self.device)
                 torch.cuda.empty_cache()
 
-            for _, t in enumerate(tqdm(timesteps)):
+            context, context_null = text_future.result()
+            context, context_null = [context], [context_null]
+            arg_c = {
+                'context': context,
+                'seq_len': draft_seq_len if drafting else seq_len
+            }
+            arg_null = {'context': context_null, 'seq_len': arg_c['seq_len']}
+
+            reporter = None
+            if step_callback is not None:
+                reporter = StepReporter(step_callback, len(timesteps),
+                                        self.num_train_timesteps, self.rank)
+            if preview_callback is not None and self.rank == 0:
+                # a first fit encodes calibration images, not inside the loop
+                previewer = LatentPreviewer.for_vae(self.vae)
+
+            num_unguided = 0
+            for i, t in enumerate(
+                    tqdm(remaining_timesteps(timesteps, start_step)),
+                    start_step):
+                if drafting and t.item(
+                ) < cascade_switch * self.num_train_timesteps:
+                    # finish at full resolution from the layout of the draft
+                    latents = [
+                        upscale_latent(draft_x0, noise[0],
+                                       t.item() / self.num_train_timesteps)
+                    ]
+                    mask1, mask2 = masks_like(latents, zero=False)
+                    reset_solver_history(sample_scheduler)
+                    arg_c['seq_len'] = arg_null['seq_len'] = seq_len
+                    drafting = False
+                    logging.info(f'Drafted {i} steps at {shape[2]}x{shape[3]} '
+                                 f'latents.')
                 latent_model_input = latents
                 timestep = [t]
 
@@ -373,17 +698,33 @@ class WanTI2V:
                 temp_ts = (mask2[0][0][:, ::2, ::2] * timestep).flatten()
                 temp_ts = torch.cat([
                     temp_ts,
-                    temp_ts.new_ones(seq_len - temp_ts.size(0)) * timestep
+                    temp_ts.new_ones(arg_c['seq_len'] - temp_ts.size(0)) *
+                    timestep
                 ])
                 timestep = temp_ts.unsqueeze(0)
 
                 noise_pred_cond = self.model(
                     latent_model_input, t=timestep, **arg_c)[0]
-                noise_pred_uncond = self.model(
-                    latent_model_input, t=timestep, **arg_null)[0]
-
-                noise_pred = noise_pred_uncond + guide_scale * (
-                    noise_pred_cond - noise_pred_uncond)
+                if is_guided(guide_interval, t, i, len(timesteps),
+                             self.num_train_timesteps, guide_scale):
+                    noise_pred_uncond = self.model(
+                        latent_model_input, t=timestep, **arg_null)[0]
+
+                    noise_pred = noise_pred_uncond + guide_scale * (
+                        noise_pred_cond - noise_pred_uncond)
+                else:
+                    noise_pred = noise_pred_cond
+                    num_unguided += 1
+
+                if drafting:
+                    draft_x0 = flow_x0(latents[0], noise_pred, t,
+                                       self.num_train_timesteps)
+
+                if (preview_callback is not None and self.rank == 0 and
+                        (i + 1) % preview_interval == 0):
+                    x0_pred = flow_x0(latents[0], noise_pred, t,
+                                      self.num_train_timesteps)
+                    preview_callback(i + 1, previewer(x0_pred))
 
                 temp_x0 = sample_scheduler.step(
                     noise_pred.unsqueeze(0),
@@ -391,14 +732,48 @@ class WanTI2V:
                     latents[0].unsqueeze(0),
                     return_dict=False,
                     generator=seed_g)[0]
-                latents = [temp_x0.squeeze(0)]
+                latent, latents = latents[0], [temp_x0.squeeze(0)]
+
+                if (sampling_checkpoint is not None and self.rank == 0 and
+                        not drafting):
+                    sampling_checkpoint.save(job, i + 1, latents[0],
+                                             sample_scheduler, seed_g)
+
+                if reporter is not None and reporter(i + 1, t, latent,
+                                                     noise_pred):
+                    logging.info(f'Stopped early after step {i + 1}.')
+                    latents = [reporter.x0]
+                    break
+
+            if drafting:
+                latents = [upscale_latent(latents[0], noise[0], 0.)]
             x0 = latents
+            if sampling_checkpoint is not None and self.rank == 0:
+                sampling_checkpoint.save(
+                    job,
+                    len(timesteps),
+                    x0[0],
+                    sample_scheduler,
+                    seed_g,
+                    final=True)
+            if sample_solver == 'adaptive':
+                logging.info(
+                    f'Adaptive solver used {sample_scheduler.nfe} function '
+                    f'evaluations of at most {sampling_steps}.')
+            if num_unguided:
+                logging.info(f'Guidance interval skipped {num_unguided} '
+                             f'unconditional forwards.')
             if offload_model:
                 self.model.cpu()
                 torch.cuda.synchronize()
                 torch.cuda.empty_cache()
-            if self.rank == 0:
-                videos = self.vae.decode(x0)
+            if self.vae_parallel:
+                videos = [parallel_decode(self.vae, x0[0])]
+            elif self.rank == 0:
+                if stream_output:
+                    videos = [self.vae.decode_stream(x0[0])]
+                else:
+                    videos = self.vae.decode(x0)
 
         del noise, latents
         del sample_scheduler
@@ -410,6 +785,236 @@ class WanTI2V:
 
         return videos[0] if self.rank == 0 else None
 
+    def generate_batch(self,
+                       input_prompts,
+                       seeds,
+                       img=None,
+                       size=(1280, 704),
+                       max_area=704 * 1280,
+                       frame_num=121,
+                       shift=5.0,
+                       sample_solver='unipc',
+                       sampling_steps=50,
+                       guide_scale=5.0,
+                       guide_interval=None,
+                       n_prompts=None,
+                       offload_model=False,
+                       preview_callback=None,
+                       preview_interval=5,
+                       step_callback=None):
+        r"""
+        Generates several videos of the same size and schedule with shared
+        DiT forwards: every row has its own prompt and seed, and a batched
+        scheduler steps all rows together. With `img`, all rows start from
+        that first frame, encoded once. A row matches the video of `t2v`, or
+        `i2v`, with the same prompt and seed, up to batched-kernel numerics.
+        The arguments not listed are those of `generate`; `sample_solver` is
+        'unipc' or 'dpm++'.
+
+        Args:
+            input_prompts (`list[str]`):
+                Text prompt of every video.
+            seeds (`list[int]`):
+                Seed of every video. -1 draws a random seed.
+            img (PIL.Image.Image, *optional*, defaults to None):
+                First frame shared by all videos. If None, text-to-video of
+                `size`; otherwise the size follows the image and `max_area`.
+            n_prompts (`list[str]`, *optional*, defaults to None):
+                Negative prompt of every video. Empty or None uses
+                `config.sample_neg_prompt`.
+            preview_callback (`callable`, *optional*, defaults to None):
+                Called on rank 0 every `preview_interval` steps as
+                `preview_callback(step, frames)` with the list of previews of
+                all rows, as in `generate`.
+
+        Returns:
+            list[torch.Tensor]:
+                Generated video of every row, (C, N, H, W), on rank 0.
+        """
+        assert len(input_prompts) == len(seeds), \
+            'every prompt needs a seed'
+        batch_size = len(input_prompts)
+        # preprocess
+        if img is not None:
+            ih, iw = img.height, img.width
+            dh, dw = self.patch_size[1] * self.vae_stride[1], self.patch_size[
+                2] * self.vae_stride[2]
+            ow, oh = best_output_size(iw, ih, dw, dh, max_area)
+
+            scale = max(ow / iw, oh / ih)
+            img = img.resize((round(iw * scale), round(ih * scale)),
+                             Image.LANCZOS)
+
+            # center-crop
+            x1 = (img.width - ow) // 2
+            y1 = (img.height - oh) // 2
+            img = img.crop((x1, y1, x1 + ow, y1 + oh))
+            assert img.width == ow and img.height == oh
+            size = (ow, oh)
+
+            # to tensor
+            img = TF.to_tensor(img).sub_(0.5).div_(0.5).to(
+                self.device).unsqueeze(1)
+
+        F = frame_num
+        target_shape = (self.vae.model.z_dim, (F - 1) // self.vae_stride[0] + 1,
+                        size[1] // self.vae_stride[1],
+                        size[0] // self.vae_stride[2])
+
+        seq_len = math.ceil((target_shape[2] * target_shape[3]) /
+                            (self.patch_size[1] * self.patch_size[2]) *
+                            target_shape[1] / self.sp_size) * self.sp_size
+
+        n_prompts = [p or self.sample_neg_prompt
+                     for p in (n_prompts or [''] * batch_size)]
+
+        if not self.t5_cpu:
+            self.text_encoder.model.to(self.device)
+        # duplicate prompts, typically the negative ones, are encoded once
+        text_future = self.text_encoder.encode_async(
+            list(input_prompts) + n_prompts, self.device)
+        if offload_model and not self.t5_cpu:
+            self.text_encoder.model.cpu()
+
+        noise = []
+        for seed in seeds:
+            seed = seed if seed >= 0 else random.randint(0, sys.maxsize)
+            seed_g = torch.Generator(device=self.device)
+            seed_g.manual_seed(seed)
+            noise.append(
+                torch.randn(
+                    *target_shape,
+                    dtype=torch.float32,
+                    device=self.device,
+                    generator=seed_g))
+        if img is not None:
+            # the rows share the latent of the first frame
+            z = self.vae.encode([img])[0]
+            _, mask2 = masks_like(noise[:1], zero=True)
+            mask2 = mask2[0]
+
+        @contextmanager
+        def noop_no_sync():
+            yield
+
+        no_sync = getattr(self.model, 'no_sync', noop_no_sync)
+
+        # evaluation mode
+        with (
+                torch.amp.autocast('cuda', dtype=self.param_dtype),
+                torch.no_grad(),
+                no_sync(),
+        ):
+
+            if sample_solver == 'unipc':
+                sample_scheduler = BatchedFlowUniPCScheduler(
+                    num_train_timesteps=self.num_train_timesteps)
+            elif sample_solver == 'dpm++':
+                sample_scheduler = BatchedFlowDPMSolverScheduler(
+                    num_train_timesteps=self.num_train_timesteps)
+            else:
+                raise NotImplementedError(
+                    "Unsupported solver for batched sampling.")
+            slots = [
+                sample_scheduler.add_request(sampling_steps, shift=shift)
+                for _ in range(batch_size)
+            ]
+
+            # sample videos
+            latents = torch.stack(noise)
+            if img is not None:
+                latents = (1. - mask2) * z + mask2 * latents
+
+            if offload_model or self.init_on_cpu:
+                self.model.to(self.device)
+                torch.cuda.empty_cache()
+
+            contexts = text_future.result()
+            arg_c = {'context': contexts[:batch_size], 'seq_len': seq_len}
+            arg_null = {'context': contexts[batch_size:], 'seq_len': seq_len}
+
+            reporter = None
+            if step_callback is not None:
+                reporter = StepReporter(step_callback, sampling_steps,
+                                        self.num_train_timesteps, self.rank)
+            if preview_callback is not None and self.rank == 0:
+                # a first fit encodes calibration images, not inside the loop
+                previewer = LatentPreviewer.for_vae(self.vae)
+
+            num_unguided = 0
+            for i in tqdm(range(sampling_steps)):
+                # without an image every token shares the timestep of its row
+                timestep = sample_scheduler.timesteps(slots, self.device)
+                t = timestep[0]
+                if img is not None:
+                    # the tokens of the first frame are clean
+                    temp_ts = (mask2[0][:, ::2, ::2] * t).flatten()
+                    temp_ts = torch.cat([
+                        temp_ts,
+                        temp_ts.new_ones(seq_len - temp_ts.size(0)) * t
+                    ])
+                    timestep = temp_ts.unsqueeze(0).expand(batch_size, -1)
+
+                latent_model_input = list(latents.unbind(0))
+                noise_pred_cond = torch.stack(
+                    self.model(latent_model_input, t=timestep, **arg_c))
+                if is_guided(guide_interval, t, i, sampling_steps,
+                             self.num_train_timesteps, guide_scale):
+                    noise_pred_uncond = torch.stack(
+                        self.model(latent_model_input, t=timestep, **arg_null))
+
+                    noise_pred = noise_pred_uncond + guide_scale * (
+                        noise_pred_cond - noise_pred_uncond)
+                else:
+                    noise_pred = noise_pred_cond
+                    num_unguided += 1
+
+                if (preview_callback is not None and self.rank == 0 and
+                        (i + 1) % preview_interval == 0):
+                    preview_callback(i + 1, [
+                        previewer(
+                            flow_x0(u, v, t, self.num_train_timesteps))
+                        for u, v in zip(latents, noise_pred)
+                    ])
+
+                latent, latents = latents, sample_scheduler.step(
+                    noise_pred, slots, latents, return_dict=False)[0]
+                if img is not None:
+                    latents = (1. - mask2) * z + mask2 * latents
+
+                if reporter is not None and reporter(
+                        i + 1,
+                        t,
+                        latent,
+                        noise_pred,
+                        blend=None if img is None else
+                        lambda u: (1. - mask2) * z + mask2 * u):
+                    logging.info(f'Stopped early after step {i + 1}.')
+                    latents = reporter.x0
+                    break
+
+            x0 = list(latents.unbind(0))
+            if num_unguided:
+                logging.info(f'Guidance interval skipped {num_unguided} '
+                             f'unconditional forwards.')
+            if offload_model:
+                self.model.cpu()
+                torch.cuda.empty_cache()
+            if self.vae_parallel:
+                videos = [parallel_decode(self.vae, u) for u in x0]
+            elif self.rank == 0:
+                videos = self.vae.decode(x0)
+
+        del noise, latents
+        del sample_scheduler
+        if offload_model:
+            gc.collect()
+            torch.cuda.synchronize()
+        if dist.is_initialized():
+            dist.barrier()
+
+        return videos if self.rank == 0 else None
+
     def i2v(self,
             input_prompt,
             img,
@@ -418,10 +1023,18 @@ class WanTI2V:
             shift=5.0,
             sample_solver='unipc',
             sampling_steps=40,
+            sample_tolerance=0.05,
             guide_scale=5.0,
+            guide_interval=None,
             n_prompt="",
             seed=-1,
-            offload_model=False):  # WELL optimization: Changed to False
+            offload_model=False,  # WELL optimization: Changed to False
+            stream_output=False,
+            preview_callback=None,
+            preview_interval=5,
+            step_callback=None,
+            sampling_checkpoint=None,
+            num_variants=1):
         r"""
         Generates video frames from input image and text prompt using diffusion process.
 
@@ -441,14 +1054,49 @@ class WanTI2V:
                 Solver used to sample the video.
             sampling_steps (`int`, *optional*, defaults to 40):
                 Number of diffusion sampling steps. Higher values improve quality but slow generation
+            sample_tolerance (`float`, *optional*, defaults to 0.05):
+                Local error tolerance of the 'adaptive' solver, which then takes
+                at most `sampling_steps` steps.
             guide_scale (`float`, *optional*, defaults 5.0):
                 Classifier-free guidance scale. Controls prompt adherence vs. creativity.
+            guide_interval (`GuidanceInterval`, *optional*, defaults to None):
+                Steps that run the unconditional forward for classifier-free
+                guidance; the others only run the conditional one. If None,
+                every step is guided.
             n_prompt (`str`, *optional*, defaults to ""):
                 Negative prompt for content exclusion. If not given, use `config.sample_neg_prompt`
             seed (`int`, *optional*, defaults to -1):
                 Random seed for noise generation. If -1, use random seed
             offload_model (`bool`, *optional*, defaults to False):
                 If True, offloads models to CPU during generation to save VRAM. False is faster on Windows
+            stream_output (`bool`, *optional*, defaults to False):
+                If True, return a generator that decodes the video lazily and
+                yields float frame groups of shape (C, n, H, W), instead of the
+                whole video tensor. See `decode_stream` of the VAE.
+            preview_callback (`callable`, *optional*, defaults to None):
+                Called on rank 0 every `preview_interval` steps as
+                `preview_callback(step, frames)` with a latent-resolution RGB
+                preview ([3, T, h, w] in [-1, 1]) of the current clean-video
+                estimate. See `wan.utils.preview.LatentPreviewer`.
+            preview_interval (`int`, *optional*, defaults to 5):
+                Sampling steps between two previews.
+            step_callback (`callable`, *optional*, defaults to None):
+                Called on rank 0 after every sampling step as
+                `step_callback(info)` with a `StepInfo` of the step, its
+                timestep, expert and elapsed time and the clean-video estimate.
+                A truthy return stops sampling early and decodes that estimate.
+                Under torchrun, give it on every rank. See
+                `wan.utils.step_callback.StepReporter`.
+            sampling_checkpoint (`SamplingCheckpoint`, *optional*, defaults to None):
+                If given, the sampling state is saved to it periodically and
+                the run resumes from its snapshot of the same job, if any.
+                See `wan.utils.sampling_checkpoint.SamplingCheckpoint`.
+            num_variants (`int`, *optional*, defaults to 1):
+                If above 1, this many videos of the seeds `seed`, `seed + 1`,
+                ... are generated in one batched trajectory that encodes the
+                prompts and the image once, see `generate_batch`, and their
+                list is returned. Not supported with the 'adaptive' solver,
+                `stream_output` or `sampling_checkpoint`.
 
         Returns:
             torch.Tensor:
@@ -458,6 +1106,27 @@ class WanTI2V:
                 - H: Frame height (from max_area)
                 - W: Frame width (from max_area)
         """
+        if num_variants > 1:
+            assert not (stream_output or sampling_checkpoint is not None), \
+                'variants are sampled without these options'
+            seed = seed if seed >= 0 else random.randint(0, sys.maxsize)
+            return self.generate_batch(
+                [input_prompt] * num_variants,
+                [seed + k for k in range(num_variants)],
+                img=img,
+                max_area=max_area,
+                frame_num=frame_num,
+                shift=shift,
+                sample_solver=sample_solver,
+                sampling_steps=sampling_steps,
+                guide_scale=guide_scale,
+                guide_interval=guide_interval,
+                n_prompts=[n_prompt] * num_variants,
+                offload_model=offload_model,
+                preview_callback=preview_callback,
+                preview_interval=preview_interval,
+                step_callback=step_callback)
+
         # preprocess
         ih, iw = img.height, img.width
         dh, dw = self.patch_size[1] * self.vae_stride[1], self.patch_size[
@@ -472,6 +1141,7 @@ class WanTI2V:
         y1 = (img.height - oh) // 2
         img = img.crop((x1, y1, x1 + ow, y1 + oh))
         assert img.width == ow and img.height == oh
+        img_hash = hashlib.sha1(img.tobytes()).hexdigest()
 
         # to tensor
         img = TF.to_tensor(img).sub_(0.5).div_(0.5).to(self.device).unsqueeze(1)
@@ -482,6 +1152,20 @@ class WanTI2V:
                 self.patch_size[1] * self.patch_size[2])
         seq_len = int(math.ceil(seq_len / self.sp_size)) * self.sp_size
 
+        job = dict(
+            task='ti2v-i2v',
+            prompt=input_prompt,
+            n_prompt=n_prompt,
+            image=img_hash,
+            frame_num=F,
+            seed=seed,
+            solver=sample_solver,
+            steps=sampling_steps,
+            tolerance=sample_tolerance,
+            shift=shift,
+            guide_scale=guide_scale,
+            guide_interval=repr(guide_interval),
+            lora=LoraMerger.adapters_of(self.model))
         seed = seed if seed >= 0 else random.randint(0, sys.maxsize)
         seed_g = torch.Generator(device=self.device)
         seed_g.manual_seed(seed)
@@ -499,15 +1183,10 @@ class WanTI2V:
         # preprocess
         if not self.t5_cpu:
             self.text_encoder.model.to(self.device)
-            context = self.text_encoder([input_prompt], self.device)
-            context_null = self.text_encoder([n_prompt], self.device)
-            if offload_model:
-                self.text_encoder.model.cpu()
-        else:
-            context = self.text_encoder([input_prompt], torch.device('cpu'))
-            context_null = self.text_encoder([n_prompt], torch.device('cpu'))
-            context = [t.to(self.device) for t in context]
-            context_null = [t.to(self.device) for t in context_null]
+        text_future = self.text_encoder.encode_async([input_prompt, n_prompt],
+                                                     self.device)
+        if offload_model and not self.t5_cpu:
+            self.text_encoder.model.cpu()
 
         z = self.vae.encode([img])
 
@@ -542,6 +1221,15 @@ class WanTI2V:
                     sample_scheduler,
                     device=self.device,
                     sigmas=sampling_sigmas)
+            elif sample_solver == 'adaptive':
+                sample_scheduler = FlowAdaptiveScheduler(
+                    num_train_timesteps=self.num_train_timesteps,
+                    tolerance=sample_tolerance)
+                sample_scheduler.set_timesteps(
+                    sampling_steps,
+                    device=self.device,
+                    shift=shift)
+                timesteps = sample_scheduler.timesteps
             else:
                 raise NotImplementedError("Unsupported solver.")
 
@@ -549,7 +1237,20 @@ class WanTI2V:
             latent = noise
             mask1, mask2 = masks_like([noise], zero=True)
             latent = (1. - mask2[0]) * z[0] + mask2[0] * latent
+            start_step = 0
+            if sampling_checkpoint is not None:
+                resumed = sampling_checkpoint.restore(job, sample_scheduler,
+                                                      seed_g, self.device)
+                if resumed is not None:
+                    start_step, latent = resumed
+                    x0 = [latent]
+
+            if offload_model or self.init_on_cpu:
+                self.model.to(self.device)
+                torch.cuda.empty_cache()
 
+            context, context_null = text_future.result()
+            context, context_null = [context], [context_null]
             arg_c = {
                 'context': [context[0]],
                 'seq_len': seq_len,
@@ -560,11 +1261,18 @@ class WanTI2V:
                 'seq_len': seq_len,
             }
 
-            if offload_model or self.init_on_cpu:
-                self.model.to(self.device)
-                torch.cuda.empty_cache()
-
-            for _, t in enumerate(tqdm(timesteps)):
+            reporter = None
+            if step_callback is not None:
+                reporter = StepReporter(step_callback, len(timesteps),
+                                        self.num_train_timesteps, self.rank)
+            if preview_callback is not None and self.rank == 0:
+                # a first fit encodes calibration images, not inside the loop
+                previewer = LatentPreviewer.for_vae(self.vae)
+
+            num_unguided = 0
+            for i, t in enumerate(
+                    tqdm(remaining_timesteps(timesteps, start_step)),
+                    start_step):
                 latent_model_input = [latent.to(self.device)]
                 timestep = [t]
 
@@ -581,12 +1289,23 @@ class WanTI2V:
                     latent_model_input, t=timestep, **arg_c)[0]
                 if offload_model:
                     torch.cuda.empty_cache()
-                noise_pred_uncond = self.model(
-                    latent_model_input, t=timestep, **arg_null)[0]
-                if offload_model:
-                    torch.cuda.empty_cache()
-                noise_pred = noise_pred_uncond + guide_scale * (
-                    noise_pred_cond - noise_pred_uncond)
+                if is_guided(guide_interval, t, i, len(timesteps),
+                             self.num_train_timesteps, guide_scale):
+                    noise_pred_uncond = self.model(
+                        latent_model_input, t=timestep, **arg_null)[0]
+                    if offload_model:
+                        torch.cuda.empty_cache()
+                    noise_pred = noise_pred_uncond + guide_scale * (
+                        noise_pred_cond - noise_pred_uncond)
+                else:
+                    noise_pred = noise_pred_cond
+                    num_unguided += 1
+
+                if (preview_callback is not None and self.rank == 0 and
+                        (i + 1) % preview_interval == 0):
+                    x0_pred = flow_x0(latent, noise_pred, t,
+                                      self.num_train_timesteps)
+                    preview_callback(i + 1, previewer(x0_pred))
 
                 temp_x0 = sample_scheduler.step(
                     noise_pred.unsqueeze(0),
@@ -594,19 +1313,54 @@ class WanTI2V:
                     latent.unsqueeze(0),
                     return_dict=False,
                     generator=seed_g)[0]
-                latent = temp_x0.squeeze(0)
+                prev_latent, latent = latent, temp_x0.squeeze(0)
                 latent = (1. - mask2[0]) * z[0] + mask2[0] * latent
 
                 x0 = [latent]
                 del latent_model_input, timestep
 
+                if sampling_checkpoint is not None and self.rank == 0:
+                    sampling_checkpoint.save(job, i + 1, latent,
+                                             sample_scheduler, seed_g)
+
+                if reporter is not None and reporter(
+                        i + 1,
+                        t,
+                        prev_latent,
+                        noise_pred,
+                        blend=lambda u: (1. - mask2[0]) * z[0] + mask2[0] * u):
+                    logging.info(f'Stopped early after step {i + 1}.')
+                    x0 = [reporter.x0]
+                    break
+
+            if sampling_checkpoint is not None and self.rank == 0:
+                sampling_checkpoint.save(
+                    job,
+                    len(timesteps),
+                    x0[0],
+                    sample_scheduler,
+                    seed_g,
+                    final=True)
+
+            if sample_solver == 'adaptive':
+                logging.info(
+                    f'Adaptive solver used {sample_scheduler.nfe} function '
+                    f'evaluations of at most {sampling_steps}.')
+            if num_unguided:
+                logging.info(f'Guidance interval skipped {num_unguided} '
+                             f'unconditional forwards.')
             if offload_model:
                 self.model.cpu()
                 torch.cuda.synchronize()
                 torch.cuda.empty_cache()
 
-            if self.rank == 0:
-                videos = self.vae.decode(x0)
+            if self.vae_parallel:
+                videos = [parallel_decode(self.vae, x0[0])]
+            elif self.rank == 0:
+                if stream_output:
+                    videos = [self.vae.decode_stream(x0[0])]
+                else:
+                    videos = self.vae.decode(x0)
 
         del noise, latent, x0
         del sample_scheduler
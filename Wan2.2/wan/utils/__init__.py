@@ -4,9 +4,23 @@ from .fm_solvers import (
     get_sampling_sigmas,
     retrieve_timesteps,
 )
+from .fm_solvers_adaptive import FlowAdaptiveScheduler
+from .fm_solvers_batched import (
+    BatchedFlowDPMSolverScheduler,
+    BatchedFlowUniPCScheduler,
+)
 from .fm_solvers_unipc import FlowUniPCMultistepScheduler
+from .sampling_checkpoint import (
+    PreemptibleSampling,
+    SamplingCheckpoint,
+    SamplingInterrupted,
+)
+from .step_callback import StepInfo, StepReporter
 
 __all__ = [
     'HuggingfaceTokenizer', 'get_sampling_sigmas', 'retrieve_timesteps',
-    'FlowDPMSolverMultistepScheduler', 'FlowUniPCMultistepScheduler'
+    'FlowDPMSolverMultistepScheduler', 'FlowUniPCMultistepScheduler',
+    'BatchedFlowDPMSolverScheduler', 'BatchedFlowUniPCScheduler',
+    'FlowAdaptiveScheduler', 'SamplingCheckpoint', 'PreemptibleSampling',
+    'SamplingInterrupted', 'StepInfo', 'StepReporter'
 ]
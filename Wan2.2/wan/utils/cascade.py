@@ -0,0 +1,59 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import torch.nn.functional as F
+
+from .fm_solvers_adaptive import FlowAdaptiveScheduler
+
+__all__ = ['draft_shape', 'upscale_latent', 'reset_solver_history']
+
+
+def draft_shape(shape, scale, patch_size):
+    """
+    Latent shape of a draft at `scale` times the height and width of the
+    latent `shape` [C, T, H, W], rounded to whole patches.
+    """
+    c, t, h, w = shape
+    ph, pw = patch_size[1], patch_size[2]
+    return (c, t, max(ph, round(h * scale / ph) * ph),
+            max(pw, round(w * scale / pw) * pw))
+
+
+def upscale_latent(x0, noise, sigma):
+    r"""
+    Full resolution latent at `sigma` from the clean estimate of a draft.
+
+    The estimate is upsampled to the size of `noise` and re-noised with it,
+    `x = (1 - sigma) * x0 + sigma * noise`. Upsampling the noisy latent
+    itself would smooth its noise out of the distribution the model expects.
+
+    Args:
+        x0 (`torch.Tensor`):
+            Clean estimate of the draft, [C, T, h, w].
+        noise (`torch.Tensor`):
+            Gaussian noise at full resolution, [C, T, H, W].
+        sigma (`float`):
+            Noise level of the next step.
+    """
+    up = F.interpolate(
+        x0.float().transpose(0, 1),
+        size=noise.shape[-2:],
+        mode='bilinear',
+        align_corners=False).transpose(0, 1)
+    return (1 - sigma) * up + sigma * noise.float()
+
+
+def reset_solver_history(scheduler):
+    """
+    Drops the multistep history of `scheduler`, so its next step starts over
+    at first order; the history of another resolution cannot be reused.
+    """
+    if isinstance(scheduler, FlowAdaptiveScheduler):
+        scheduler.prev_v = None
+        scheduler.dsigma = scheduler._grid_step(scheduler.sigma)
+        return
+    order = scheduler.config.solver_order
+    scheduler.model_outputs = [None] * order
+    scheduler.lower_order_nums = 0
+    # UniPC only: the corrector uses the previous sample
+    if hasattr(scheduler, 'timestep_list'):
+        scheduler.timestep_list = [None] * order
+        scheduler.last_sample = None
@@ -0,0 +1,203 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import math
+from typing import Tuple, Union
+
+import torch
+from diffusers.schedulers.scheduling_utils import SchedulerOutput
+
+__all__ = ['FlowAdaptiveScheduler']
+
+
+class _AdaptiveTimesteps:
+    """
+    Timesteps of an adaptive run, produced one at a time as the scheduler
+    steps. Its length is the step budget, an upper bound.
+    """
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+
+    def __len__(self):
+        return self.scheduler.max_steps
+
+    def __iter__(self):
+        s = self.scheduler
+        while s.sigma > 0 and s.num_steps < s.max_steps:
+            yield torch.tensor(
+                s.sigma * s.num_train_timesteps,
+                dtype=torch.float32,
+                device=s.device)
+
+
+class FlowAdaptiveScheduler:
+    r"""
+    Adaptive step-size solver for the flow-matching ODE `dx/dsigma = v`.
+
+    Every step takes an Euler step and embeds it in the variable-step
+    second-order Adams-Bashforth step built from the previous velocity; their
+    difference estimates the local error at no extra model evaluation. The
+    second-order result is kept, and the step size follows the error: a step
+    whose error would exceed the tolerance is shortened before it is taken
+    (the error scales with the squared step, so this is exact and costs no
+    evaluation either), and the next step grows while the flow stays smooth.
+
+    Steps never cross the expert `boundary`: they land on it, and the
+    velocity history is dropped where the expert changes, so the error
+    estimate never mixes the two experts and sampling restarts with a short
+    step after the switch. Only the last step of the budget may cross it, to
+    reach `sigma = 0` instead of ending on the boundary.
+
+    Args:
+        num_train_timesteps (`int`, *optional*, defaults to 1000):
+            The number of diffusion steps to train the model.
+        tolerance (`float`, *optional*, defaults to 0.05):
+            Local error tolerance, relative to `1 + |x|` per element.
+        safety (`float`, *optional*, defaults to 0.9):
+            Safety factor of the step-size controller.
+        max_growth (`float`, *optional*, defaults to 2.0):
+            Largest growth of the step size from one step to the next.
+    """
+
+    def __init__(self,
+                 num_train_timesteps=1000,
+                 tolerance=0.05,
+                 safety=0.9,
+                 max_growth=2.0):
+        self.num_train_timesteps = num_train_timesteps
+        self.tolerance = tolerance
+        self.safety = safety
+        self.max_growth = max_growth
+        self.max_steps = None
+
+    def set_timesteps(self,
+                      num_inference_steps,
+                      device=None,
+                      shift=1.0,
+                      boundary=None,
+                      strength=1.0):
+        r"""
+        Starts a run at `sigma = 1`, or lower for a partial run.
+
+        Args:
+            num_inference_steps (`int`):
+                Step budget. The first step, and the first after the expert
+                switch, are as long as on the shifted uniform grid of this
+                many steps, and the run never takes more.
+            device (`str` or `torch.device`, *optional*, defaults to None):
+                Device of the timesteps.
+            shift (`float`, *optional*, defaults to 1.0):
+                Noise schedule shift of the reference grid.
+            boundary (`float`, *optional*, defaults to None):
+                Timestep at which the expert changes, if any.
+            strength (`float`, *optional*, defaults to 1.0):
+                Fraction of the reference grid to run, from the sigma it
+                reaches, e.g. to denoise a noised video. The budget shrinks
+                in proportion.
+        """
+        self.grid_steps = num_inference_steps
+        self.max_steps = max(1, round(strength * num_inference_steps))
+        self.device = device
+        self.shift = shift
+        self.boundary = None if boundary is None else \
+            boundary / self.num_train_timesteps
+        self.sigma = shift * strength / (1 + (shift - 1) * strength)
+        self.dsigma = self._grid_step(self.sigma)
+        self.prev_v = None
+        self.prev_dsigma = None
+        self.num_steps = 0
+        self.num_shortened = 0
+
+    @property
+    def timesteps(self):
+        return _AdaptiveTimesteps(self)
+
+    @property
+    def nfe(self):
+        """
+        Number of model (velocity) evaluations so far, one per step.
+        """
+        return self.num_steps
+
+    def _grid_step(self, sigma):
+        # step at `sigma` of the shifted uniform grid of `grid_steps` steps
+        s = self.shift
+        u = sigma / (s - (s - 1) * sigma)
+        u = max(u - 1.0 / self.grid_steps, 0.0)
+        return sigma - s * u / (1 + (s - 1) * u)
+
+    def step(self,
+             model_output: torch.Tensor,
+             timestep: Union[int, torch.Tensor],
+             sample: torch.Tensor,
+             return_dict: bool = True,
+             generator=None) -> Union[SchedulerOutput, Tuple]:
+        r"""
+        Takes one adaptive step from the current sigma; `timestep` is only
+        accepted for interchangeability with the other schedulers.
+
+        Args:
+            model_output (`torch.Tensor`):
+                The flow predicted by the model at the current sigma.
+            timestep (`int` or `torch.Tensor`):
+                Unused, the scheduler tracks its own sigma.
+            sample (`torch.Tensor`):
+                The current sample.
+            return_dict (`bool`):
+                Whether to return a `SchedulerOutput` or a tuple.
+
+        Returns:
+            `SchedulerOutput` or `tuple`:
+                The sample at the next sigma.
+        """
+        if self.max_steps is None:
+            raise ValueError(
+                "Number of inference steps is 'None', you need to run 'set_timesteps' after creating the scheduler"
+            )
+        sigma = self.sigma
+        v = model_output.float()
+        x = sample.float()
+
+        # the budget bounds the number of steps whatever the tolerance
+        remaining = self.max_steps - self.num_steps
+        floor = sigma if remaining <= 1 else sigma / remaining
+        ds = max(self.dsigma, floor)
+
+        if self.prev_v is None:
+            limit = None
+        else:
+            # the Euler/AB2 difference is e * ds^2 in the tolerance norm
+            scale = self.tolerance * (1 + x.abs())
+            e = ((v - self.prev_v) / (2 * self.prev_dsigma * scale)).square()
+            e = math.sqrt(e.mean().item())
+            limit = self.safety / math.sqrt(e) if e > 0 else math.inf
+            if ds > max(limit, floor):
+                ds = max(limit, floor)
+                self.num_shortened += 1
+
+        b = self.boundary
+        # landing on the boundary needs a step left to go on from it
+        if b is not None and sigma > b and sigma - ds < b and remaining > 1:
+            ds = sigma - b
+        ds = min(ds, sigma)
+
+        x_next = x - ds * v
+        if self.prev_v is not None:
+            r = ds / self.prev_dsigma
+            x_next = x_next - (0.5 * r * ds) * (v - self.prev_v)
+
+        if b is not None and sigma >= b > sigma - ds:
+            # the next evaluation uses the other expert
+            self.prev_v = None
+            self.dsigma = self._grid_step(sigma - ds)
+        else:
+            self.prev_v = v
+            self.dsigma = ds * self.max_growth if limit is None else \
+                min(ds * self.max_growth, limit)
+        self.prev_dsigma = ds
+        self.sigma = sigma - ds
+        self.num_steps += 1
+
+        prev_sample = x_next.to(sample.dtype)
+        if not return_dict:
+            return (prev_sample,)
+        return SchedulerOutput(prev_sample=prev_sample)
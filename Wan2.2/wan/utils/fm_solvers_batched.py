@@ -0,0 +1,467 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+from typing import List, Tuple, Union
+
+import numpy as np
+import torch
+from diffusers.schedulers.scheduling_utils import SchedulerOutput
+
+from .fm_solvers import get_sampling_sigmas
+
+__all__ = [
+    'BatchedFlowUniPCScheduler',
+    'BatchedFlowDPMSolverScheduler',
+]
+
+
+def _lambda(sigma):
+    # log-SNR of the flow-matching path x_t = (1 - sigma) * x_0 + sigma * eps
+    with np.errstate(divide='ignore'):
+        return np.log(1.0 - sigma) - np.log(sigma)
+
+
+class _Request:
+    """
+    Scalar state of one request: its sigma schedule, step index, solver order
+    and where its model outputs sit in the history ring of its slot.
+    """
+
+    def __init__(self, sigmas, num_train_timesteps, solver_order):
+        # sigmas: [num_steps + 1], the last one is the final zero
+        self.timesteps = torch.from_numpy(
+            sigmas[:-1] * num_train_timesteps).to(torch.int64)
+        self.sigmas = sigmas.astype(np.float32).astype(np.float64)
+        self.solver_order = solver_order
+        self.step_index = 0
+        self.lower_order_nums = 0
+        self.this_order = 0
+        self.head = 0
+
+    @property
+    def num_inference_steps(self):
+        return len(self.timesteps)
+
+    def recent(self, i, size):
+        """
+        Ring position of the `i`-th most recent model output, 0 the newest.
+        """
+        return (self.head - 1 - i) % size
+
+
+class _BatchedFlowScheduler:
+    """
+    Multistep flow-matching solver for many independent requests stepped
+    together. Every request owns a slot with its own sigma schedule, step
+    index and solver order; its converted model outputs live in row `slot`
+    of one history tensor, so a batch of rows is advanced with a single
+    vectorised update whatever step each request is at. Only the per-row
+    coefficients, a handful of scalars, are computed on the host.
+
+    All requests must share the sample shape. Subclasses implement the
+    solver by returning the coefficients of the update.
+    """
+
+    # whether the update of a step reads the sample of the previous one
+    _keeps_last_sample = False
+
+    def __init__(self,
+                 num_train_timesteps=1000,
+                 solver_order=2,
+                 shift=1.0,
+                 lower_order_final=True):
+        self.num_train_timesteps = num_train_timesteps
+        self.solver_order = solver_order
+        self.shift = shift
+        self.lower_order_final = lower_order_final
+        self.requests = {}
+        # [num_slots, solver_order, ...] data predictions, ring per slot
+        self.model_outputs = None
+        # [num_slots, ...]
+        self.last_sample = None
+
+    def _default_sigmas(self, num_inference_steps):
+        raise NotImplementedError
+
+    def add_request(self,
+                    num_inference_steps=None,
+                    shift=None,
+                    sigmas=None,
+                    solver_order=None):
+        r"""
+        Registers a request and returns its slot.
+
+        Args:
+            num_inference_steps (`int`, *optional*, defaults to None):
+                Number of sampling steps, used when `sigmas` is None.
+            shift (`float`, *optional*, defaults to None):
+                Noise schedule shift of the request, the scheduler's if None.
+            sigmas (`list[float]`, *optional*, defaults to None):
+                Custom decreasing schedule, already shifted, without the
+                final zero.
+            solver_order (`int`, *optional*, defaults to None):
+                Solver order of the request, at most the scheduler's, which
+                is also the default.
+
+        Returns:
+            `int`:
+                The slot of the request.
+        """
+        if sigmas is None:
+            shift = self.shift if shift is None else shift
+            sigmas = self._default_sigmas(num_inference_steps)
+            sigmas = shift * sigmas / (1 + (shift - 1) * sigmas)
+        sigmas = np.append(np.asarray(sigmas, dtype=np.float64), 0.0)
+        solver_order = solver_order or self.solver_order
+        assert 1 <= solver_order <= self.solver_order, \
+            f'solver_order must be in [1, {self.solver_order}]'
+
+        slot = 0
+        while slot in self.requests:
+            slot += 1
+        self.requests[slot] = _Request(sigmas, self.num_train_timesteps,
+                                       solver_order)
+        if self.model_outputs is not None and slot < len(self.model_outputs):
+            # stale values are multiplied by zero coefficients, but must not
+            # be inf or nan
+            self.model_outputs[slot].zero_()
+            self.last_sample[slot].zero_()
+        return slot
+
+    def remove_request(self, slot):
+        del self.requests[slot]
+
+    def is_done(self, slot):
+        request = self.requests[slot]
+        return request.step_index >= request.num_inference_steps
+
+    def timesteps(self, slots, device=None):
+        """
+        Current timestep of every slot in `slots`, the DiT input `t`.
+        """
+        return torch.stack([
+            self.requests[s].timesteps[self.requests[s].step_index]
+            for s in slots
+        ]).to(device)
+
+    def _reserve(self, sample, num_slots):
+        shape = tuple(sample.shape[1:])
+        if self.model_outputs is not None:
+            assert tuple(self.model_outputs.shape[2:]) == shape, \
+                'all requests of a batched scheduler must share the sample shape'
+            if len(self.model_outputs) >= num_slots:
+                return
+        model_outputs = sample.new_zeros(
+            num_slots, self.solver_order, *shape, dtype=torch.float32)
+        last_sample = sample.new_zeros(num_slots, *shape, dtype=torch.float32)
+        if self.model_outputs is not None:
+            model_outputs[:len(self.model_outputs)] = self.model_outputs
+            last_sample[:len(self.last_sample)] = self.last_sample
+        self.model_outputs, self.last_sample = model_outputs, last_sample
+
+    def _corrector(self, request):
+        """
+        Coefficients `(a, c, c_t)` correcting the sample of the row to
+        `a * last_sample + c @ history + c_t * model_output`, before the new
+        model output is pushed. None keeps the sample.
+        """
+        return None
+
+    def _predictor(self, request):
+        """
+        Coefficients `(a, c)` of the next sample `a * sample + c @ history`,
+        after the new model output is pushed.
+        """
+        raise NotImplementedError
+
+    def step(self,
+             model_output: torch.Tensor,
+             slots: List[int],
+             sample: torch.Tensor,
+             return_dict: bool = True) -> Union[SchedulerOutput, Tuple]:
+        r"""
+        Advances every request in `slots` by one step of its own schedule.
+
+        Args:
+            model_output (`torch.Tensor`):
+                Flow predictions of shape `[B, ...]`.
+            slots (`list[int]`):
+                Slot of every batch row, each at most once.
+            sample (`torch.Tensor`):
+                Current samples of shape `[B, ...]`.
+            return_dict (`bool`):
+                Whether to return a `SchedulerOutput` or a tuple.
+
+        Returns:
+            `SchedulerOutput` or `tuple`:
+                The samples at the next step of every row.
+        """
+        requests = [self.requests[s] for s in slots]
+        assert all(r.step_index < r.num_inference_steps for r in requests), \
+            'stepping a finished request'
+        self._reserve(sample, max(slots) + 1)
+        device = sample.device
+        size = self.solver_order
+
+        def rows(values):
+            return torch.tensor(
+                values, dtype=torch.float32,
+                device=device).view(-1, *[1] * (sample.dim() - 1))
+
+        def mix(coefficients, history):
+            c = torch.tensor(coefficients, dtype=torch.float32, device=device)
+            return torch.einsum('bk,bk...->b...', c, history)
+
+        index = torch.tensor(slots, device=device)
+        x = sample.float()
+        sigma = rows([r.sigmas[r.step_index] for r in requests])
+        m = x - sigma * model_output.float()
+        history = self.model_outputs[index]
+
+        corrections = [self._corrector(r) for r in requests]
+        if any(c is not None for c in corrections):
+            keep, a, c, c_t = [], [], [], []
+            for corr in corrections:
+                if corr is None:
+                    corr = (0.0, [0.0] * size, 0.0)
+                    keep.append(1.0)
+                else:
+                    keep.append(0.0)
+                a.append(corr[0])
+                c.append(corr[1])
+                c_t.append(corr[2])
+            x = (rows(keep) * x + rows(a) * self.last_sample[index] +
+                 mix(c, history) + rows(c_t) * m)
+
+        heads = torch.tensor([r.head for r in requests], device=device)
+        history[torch.arange(len(slots), device=device), heads] = m
+        self.model_outputs[index, heads] = m
+        for r in requests:
+            r.head = (r.head + 1) % size
+        if self._keeps_last_sample:
+            self.last_sample[index] = x
+
+        a, c = zip(*[self._predictor(r) for r in requests])
+        prev_sample = rows(list(a)) * x + mix(list(c), history)
+
+        for r in requests:
+            r.lower_order_nums = min(r.lower_order_nums + 1, r.solver_order)
+            r.step_index += 1
+
+        prev_sample = prev_sample.to(sample.dtype)
+        if not return_dict:
+            return (prev_sample,)
+        return SchedulerOutput(prev_sample=prev_sample)
+
+
+class BatchedFlowUniPCScheduler(_BatchedFlowScheduler):
+    r"""
+    Batched counterpart of `FlowUniPCMultistepScheduler` (data prediction,
+    flow prediction), stepping each row as the single-request scheduler
+    would.
+
+    Args:
+        num_train_timesteps (`int`, *optional*, defaults to 1000):
+            The number of diffusion steps to train the model.
+        solver_order (`int`, *optional*, defaults to 2):
+            Highest UniPC order of a request.
+        shift (`float`, *optional*, defaults to 1.0):
+            Default noise schedule shift of a request.
+        solver_type (`str`, *optional*, defaults to 'bh2'):
+            `bh1` or `bh2`.
+        lower_order_final (`bool`, *optional*, defaults to True):
+            Whether to lower the order in the final steps.
+        disable_corrector (`list[int]`, *optional*, defaults to None):
+            Step indices after which the corrector is skipped.
+    """
+
+    _keeps_last_sample = True
+
+    def __init__(self,
+                 num_train_timesteps=1000,
+                 solver_order=2,
+                 shift=1.0,
+                 solver_type='bh2',
+                 lower_order_final=True,
+                 disable_corrector=None):
+        super().__init__(num_train_timesteps, solver_order, shift,
+                         lower_order_final)
+        if solver_type not in ['bh1', 'bh2']:
+            raise NotImplementedError(
+                f'{solver_type} is not implemented for {self.__class__}')
+        self.solver_type = solver_type
+        self.disable_corrector = disable_corrector or []
+
+    def _default_sigmas(self, num_inference_steps):
+        # same grid as FlowUniPCMultistepScheduler.set_timesteps
+        sigma_max = 1.0 - 1.0 / self.num_train_timesteps
+        return np.linspace(sigma_max, 0, num_inference_steps + 1)[:-1]
+
+    def _bh(self, lambda_t, lambda_s0, lambdas, order, corrector):
+        """
+        UniPC B(h) terms: `h_phi_1`, `B_h` and the `(r_k, rho_k)` pairs
+        weighting the differences to the older outputs, plus the weight of
+        the new output for the corrector.
+        """
+        h = lambda_t - lambda_s0
+        rks = [(lambda_si - lambda_s0) / h for lambda_si in lambdas]
+        hh = -h
+        h_phi_1 = np.expm1(hh)
+        h_phi_k = h_phi_1 / hh - 1
+        B_h = hh if self.solver_type == 'bh1' else np.expm1(hh)
+
+        R, b = [], []
+        factorial_i = 1
+        r = np.array(rks + [1.0])
+        for i in range(1, order + 1):
+            R.append(r**(i - 1))
+            b.append(h_phi_k * factorial_i / B_h)
+            factorial_i *= i + 1
+            h_phi_k = h_phi_k / hh - 1 / factorial_i
+        R, b = np.stack(R), np.array(b)
+
+        if corrector:
+            rhos = [0.5] if order == 1 else list(np.linalg.solve(R, b))
+            return h_phi_1, B_h, list(zip(rks, rhos[:-1])), rhos[-1]
+        if order == 1:
+            rhos = []
+        elif order == 2:
+            rhos = [0.5]
+        else:
+            rhos = list(np.linalg.solve(R[:-1, :-1], b[:-1]))
+        return h_phi_1, B_h, list(zip(rks, rhos)), 0.0
+
+    def _expand(self, request, alpha_t, h_phi_1, B_h, terms, shift):
+        """
+        Coefficients over the history ring of
+        `-alpha_t * (h_phi_1 * m0 + B_h * sum(rho_k * (m_k - m0) / r_k))`,
+        with `m_k` the `k + shift`-th most recent output.
+        """
+        c = [0.0] * self.solver_order
+        c[request.recent(shift, self.solver_order)] = -alpha_t * h_phi_1
+        for k, (rk, rho) in enumerate(terms, start=1):
+            w = alpha_t * B_h * rho / rk
+            c[request.recent(shift, self.solver_order)] += w
+            c[request.recent(k + shift, self.solver_order)] -= w
+        return c
+
+    def _corrector(self, request):
+        s = request.step_index
+        if s == 0 or s - 1 in self.disable_corrector:
+            return None
+        order = request.this_order
+        sigmas = request.sigmas
+        sigma_t, sigma_s0 = sigmas[s], sigmas[s - 1]
+        lambdas = [_lambda(sigmas[s - (i + 1)]) for i in range(1, order)]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            h_phi_1, B_h, terms, rho_t = self._bh(
+                _lambda(sigma_t), _lambda(sigma_s0), lambdas, order, True)
+        alpha_t = 1.0 - sigma_t
+        # history is not pushed yet, so its newest entry is m0
+        c = self._expand(request, alpha_t, h_phi_1, B_h, terms, 0)
+        w_t = alpha_t * B_h * rho_t
+        c[request.recent(0, self.solver_order)] += w_t
+        return float(sigma_t / sigma_s0), [float(v) for v in c], float(-w_t)
+
+    def _predictor(self, request):
+        s = request.step_index
+        if self.lower_order_final:
+            order = min(request.solver_order, request.num_inference_steps - s)
+        else:
+            order = request.solver_order
+        order = min(order, request.lower_order_nums + 1)
+        request.this_order = order
+
+        sigmas = request.sigmas
+        sigma_t, sigma_s0 = sigmas[s + 1], sigmas[s]
+        lambdas = [_lambda(sigmas[s - i]) for i in range(1, order)]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            h_phi_1, B_h, terms, _ = self._bh(
+                _lambda(sigma_t), _lambda(sigma_s0), lambdas, order, False)
+        c = self._expand(request, 1.0 - sigma_t, h_phi_1, B_h, terms, 0)
+        return float(sigma_t / sigma_s0), [float(v) for v in c]
+
+
+class BatchedFlowDPMSolverScheduler(_BatchedFlowScheduler):
+    r"""
+    Batched counterpart of `FlowDPMSolverMultistepScheduler` with
+    `algorithm_type='dpmsolver++'` and the final sigma at zero, stepping
+    each row as the single-request scheduler would.
+
+    Args:
+        num_train_timesteps (`int`, *optional*, defaults to 1000):
+            The number of diffusion steps to train the model.
+        solver_order (`int`, *optional*, defaults to 2):
+            Highest DPM-Solver++ order of a request, at most 3.
+        shift (`float`, *optional*, defaults to 1.0):
+            Default noise schedule shift of a request.
+        solver_type (`str`, *optional*, defaults to 'midpoint'):
+            `midpoint` or `heun`, for the second-order update.
+        lower_order_final (`bool`, *optional*, defaults to True):
+            Whether to lower the order in the final steps of short schedules.
+    """
+
+    def __init__(self,
+                 num_train_timesteps=1000,
+                 solver_order=2,
+                 shift=1.0,
+                 solver_type='midpoint',
+                 lower_order_final=True):
+        super().__init__(num_train_timesteps, solver_order, shift,
+                         lower_order_final)
+        assert solver_order <= 3, 'DPM-Solver++ supports orders up to 3'
+        if solver_type not in ['midpoint', 'heun']:
+            raise NotImplementedError(
+                f'{solver_type} is not implemented for {self.__class__}')
+        self.solver_type = solver_type
+
+    def _default_sigmas(self, num_inference_steps):
+        # same grid as get_sampling_sigmas before the shift
+        return get_sampling_sigmas(num_inference_steps, 1.0)
+
+    def _predictor(self, request):
+        s, n = request.step_index, request.num_inference_steps
+        # the final sigma is zero, so the last step is always first order
+        lower_order_second = (
+            s == n - 2 and self.lower_order_final and n < 15)
+        if request.solver_order == 1 or request.lower_order_nums < 1 or \
+                s == n - 1:
+            order = 1
+        elif request.solver_order == 2 or request.lower_order_nums < 2 or \
+                lower_order_second:
+            order = 2
+        else:
+            order = 3
+
+        sigmas = request.sigmas
+        sigma_t = sigmas[s + 1]
+        lambda_t = _lambda(sigma_t)
+        lambda_s = [_lambda(sigmas[s - i]) for i in range(order)]
+        alpha_t = 1.0 - sigma_t
+
+        # D0, D1, D2 as weights of (m0, m1, m2), the newest outputs first
+        with np.errstate(divide='ignore', invalid='ignore'):
+            h = lambda_t - lambda_s[0]
+            phi = np.expm1(-h)
+            D0 = np.array([1.0, 0.0, 0.0])
+            if order == 1:
+                d = -alpha_t * phi * D0
+            elif order == 2:
+                r0 = (lambda_s[0] - lambda_s[1]) / h
+                D1 = np.array([1.0, -1.0, 0.0]) / r0
+                if self.solver_type == 'midpoint':
+                    d = -alpha_t * phi * (D0 + 0.5 * D1)
+                else:
+                    d = -alpha_t * phi * D0 + alpha_t * (phi / h + 1.0) * D1
+            else:
+                r0 = (lambda_s[0] - lambda_s[1]) / h
+                r1 = (lambda_s[1] - lambda_s[2]) / h
+                D1_0 = np.array([1.0, -1.0, 0.0]) / r0
+                D1_1 = np.array([0.0, 1.0, -1.0]) / r1
+                D1 = D1_0 + (r0 / (r0 + r1)) * (D1_0 - D1_1)
+                D2 = (1.0 / (r0 + r1)) * (D1_0 - D1_1)
+                d = (-alpha_t * phi * D0 + alpha_t * (phi / h + 1.0) * D1 -
+                     alpha_t * ((phi + h) / h**2 - 0.5) * D2)
+
+        c = [0.0] * self.solver_order
+        for k in range(order):
+            c[request.recent(k, self.solver_order)] += float(d[k])
+        return float(sigma_t / sigmas[s]), c
@@ -0,0 +1,71 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+__all__ = ['GuidanceInterval', 'expert_intervals', 'is_guided']
+
+
+class GuidanceInterval:
+    r"""
+    Part of the sampling trajectory where classifier-free guidance is applied.
+    Outside of it only the conditional forward runs, which halves the DiT cost
+    of those steps.
+
+    Args:
+        start (`float`):
+            Where guidance starts: the highest sigma if `unit` is 'sigma',
+            otherwise the fraction of the steps done.
+        end (`float`):
+            Where guidance ends: the lowest sigma if `unit` is 'sigma',
+            otherwise the fraction of the steps done (exclusive).
+        unit (`str`, *optional*, defaults to 'sigma'):
+            'sigma' or 'step'. Sigma intervals do not depend on the number of
+            steps, so they also suit the adaptive solver, whose step count is
+            only bounded.
+    """
+
+    def __init__(self, start, end, unit='sigma'):
+        assert unit in ('sigma', 'step'), f'unknown unit {unit}'
+        if unit == 'sigma':
+            assert start >= end, 'a sigma interval starts at the higher sigma'
+        else:
+            assert start <= end, 'a step interval starts at the lower fraction'
+        self.start = start
+        self.end = end
+        self.unit = unit
+
+    def __repr__(self):
+        return f'GuidanceInterval({self.start}, {self.end}, {self.unit!r})'
+
+    def contains(self, t, step, num_steps, num_train_timesteps=1000):
+        """
+        Whether step `step` of `num_steps`, at timestep `t`, is guided.
+        """
+        if self.unit == 'sigma':
+            sigma = float(t) / num_train_timesteps
+            return self.end <= sigma <= self.start
+        return self.start <= step / num_steps < self.end
+
+
+def expert_intervals(guide_interval):
+    """
+    `(low_noise, high_noise)` intervals from a single interval, None or a
+    pair, in the order of the `guide_scale` tuples.
+    """
+    if guide_interval is None or isinstance(guide_interval, GuidanceInterval):
+        return (guide_interval, guide_interval)
+    return tuple(guide_interval)
+
+
+def is_guided(guide_interval,
+              t,
+              step,
+              num_steps,
+              num_train_timesteps=1000,
+              guide_scale=None):
+    """
+    Whether a step runs the unconditional forward; None guides every step.
+    A `guide_scale` of 1 never needs it, guidance then returns the
+    conditional prediction.
+    """
+    if guide_scale == 1:
+        return False
+    return guide_interval is None or guide_interval.contains(
+        t, step, num_steps, num_train_timesteps)
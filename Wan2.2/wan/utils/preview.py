@@ -0,0 +1,113 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import logging
+import os
+
+import torch
+import torch.nn.functional as F
+
+__all__ = ['LatentPreviewer', 'flow_x0']
+
+
+def flow_x0(latent, noise_pred, t, num_train_timesteps=1000):
+    """
+    Clean-sample estimate of a flow-matching step, `x_t - sigma * v`.
+    """
+    sigma = float(t) / num_train_timesteps
+    return latent - sigma * noise_pred
+
+
+class LatentPreviewer:
+    """
+    Linear latent-to-RGB projection fitted to a VAE, for previews of
+    in-progress samples at latent resolution. One call is a single einsum
+    over the channels, so it costs milliseconds instead of a decoder pass.
+    """
+
+    def __init__(self, weight, bias):
+        # weight: [3, C], bias: [3]
+        self.weight = weight
+        self.bias = bias
+
+    @classmethod
+    @torch.no_grad()
+    def fit(cls, vae, num_images=64, size=256, seed=0):
+        r"""
+        Fits the projection by least squares on synthetic colour fields
+        encoded with the real VAE, regressing every latent pixel onto the mean
+        colour of the video pixels it covers.
+
+        Args:
+            vae (`Wan2_1_VAE` or `Wan2_2_VAE`):
+                The VAE to calibrate against.
+            num_images (`int`, *optional*, defaults to 64):
+                Number of calibration images.
+            size (`int`, *optional*, defaults to 256):
+                Calibration image size, a multiple of the VAE stride.
+            seed (`int`, *optional*, defaults to 0):
+                Seed of the calibration images.
+        """
+        g = torch.Generator().manual_seed(seed)
+        stride = vae.spatial_stride
+        xs, ys = [], []
+        for i in range(num_images):
+            # smooth fields and finer detail alternate
+            grid = 4 if i % 2 == 0 else 16
+            img = F.interpolate(
+                torch.rand(1, 3, grid, grid, generator=g) * 2 - 1,
+                size=(size, size),
+                mode='bicubic').clamp_(-1, 1)
+            z = vae.encode([img[0][:, None].to(vae.device)])[0][:, 0]
+            xs.append(z.float().cpu().flatten(1).T)
+            ys.append(F.avg_pool2d(img, stride)[0].flatten(1).T)
+        x, y = torch.cat(xs), torch.cat(ys)
+        x = torch.cat([x, torch.ones(len(x), 1)], dim=1)
+        sol = torch.linalg.lstsq(x, y).solution
+        rms = (x @ sol - y).square().mean().sqrt().item()
+        logging.info(f'Fitted latent preview for {x.shape[1] - 1} channels, '
+                     f'rms error {rms:.4f}.')
+        return cls(sol[:-1].T.contiguous(), sol[-1].contiguous())
+
+    @classmethod
+    def load(cls, path):
+        state = torch.load(path, map_location='cpu', weights_only=True)
+        return cls(state['weight'], state['bias'])
+
+    def save(self, path):
+        # replaced atomically, ranks of a data-parallel run may fit at once
+        tmp = f'{path}.{os.getpid()}.tmp'
+        torch.save(dict(weight=self.weight, bias=self.bias), tmp)
+        os.replace(tmp, path)
+
+    @classmethod
+    def for_vae(cls, vae, cache_file=None):
+        """
+        The previewer of `vae`, loaded from `cache_file` (by default next to
+        the VAE checkpoint) or fitted and saved there on first use. A fit
+        encodes a few dozen calibration images, so call it when the pipeline
+        is built rather than from the sampling loop.
+        """
+        previewer = getattr(vae, 'previewer', None)
+        if previewer is not None:
+            return previewer
+        if cache_file is None:
+            cache_file = vae.vae_pth + '.preview.pth'
+        if os.path.isfile(cache_file):
+            previewer = cls.load(cache_file)
+        else:
+            previewer = cls.fit(vae)
+            try:
+                previewer.save(cache_file)
+            except OSError as e:
+                logging.info(f'Could not save latent preview: {e}')
+        vae.previewer = previewer
+        return previewer
+
+    @torch.no_grad()
+    def __call__(self, latent):
+        """
+        latent: [C, T, h, w] -> RGB frames [3, T, h, w] in [-1, 1].
+        """
+        weight = self.weight.to(latent.device, torch.float32)
+        bias = self.bias.to(latent.device, torch.float32)
+        rgb = torch.einsum('rc,cthw->rthw', weight, latent.float())
+        return (rgb + bias.view(3, 1, 1, 1)).clamp_(-1, 1)
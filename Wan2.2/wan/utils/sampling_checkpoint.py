@@ -0,0 +1,243 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import logging
+import os
+
+import torch
+
+__all__ = [
+    'SamplingCheckpoint', 'PreemptibleSampling', 'SamplingInterrupted',
+    'remaining_timesteps'
+]
+
+
+def _map_tensors(obj, fn):
+    if isinstance(obj, torch.Tensor):
+        return fn(obj)
+    if type(obj) in (list, tuple):
+        return type(obj)(_map_tensors(o, fn) for o in obj)
+    if type(obj) is dict:
+        return {k: _map_tensors(v, fn) for k, v in obj.items()}
+    return obj
+
+
+def remaining_timesteps(timesteps, step):
+    """
+    The timesteps left after `step` steps. Adaptive timesteps are produced
+    from the scheduler state, which the restore already moved forward; none
+    are left after a final snapshot, which is saved at `len(timesteps)`
+    steps even if sampling stopped early above `sigma = 0`.
+    """
+    if isinstance(timesteps, torch.Tensor):
+        return timesteps[step:]
+    if step >= len(timesteps):
+        return []
+    return timesteps
+
+
+class SamplingCheckpoint:
+    r"""
+    On-disk snapshot of an in-flight sampling run, so a killed job can resume
+    from its last saved step instead of starting over.
+
+    A snapshot holds the latent, the whole scheduler state (the multistep
+    history of UniPC and DPM++, the step-size state of the adaptive solver),
+    the state of the sampling generator and the expert of the last step. The
+    final latent is always saved, so the VAE decode can be retried without
+    any denoising. Snapshots are replaced atomically and written by rank 0
+    only; every rank restores from the same file.
+
+    A snapshot only resumes the job it was taken of: the pipeline keys it by
+    its sampling arguments and ignores a snapshot of another job.
+
+    Args:
+        path (`str`):
+            File of the snapshot.
+        interval (`int`, *optional*, defaults to 5):
+            Sampling steps between two snapshots.
+    """
+
+    def __init__(self, path, interval=5):
+        assert interval > 0, 'the checkpoint interval must be positive'
+        self.path = path
+        self.interval = interval
+
+    def save(self,
+             job,
+             step,
+             latent,
+             scheduler,
+             generator,
+             expert=None,
+             final=False):
+        r"""
+        Snapshots the run after `step` steps if a snapshot is due.
+
+        Args:
+            job (`dict`):
+                Sampling arguments identifying the run.
+            step (`int`):
+                Number of steps done.
+            latent (`torch.Tensor`):
+                The latent after `step` steps.
+            scheduler:
+                The sampling scheduler.
+            generator (`torch.Generator`):
+                The sampling generator.
+            expert (`str`, *optional*, defaults to None):
+                Expert of the last step, for A14B models.
+            final (`bool`, *optional*, defaults to False):
+                Whether `latent` is the final one, which is always saved.
+        """
+        if not final and step % self.interval:
+            return
+        state = self._snapshot(job, step, latent, scheduler, generator,
+                               expert, final)
+        tmp = self.path + '.tmp'
+        torch.save(state, tmp)
+        os.replace(tmp, self.path)
+
+    @staticmethod
+    def _snapshot(job, step, latent, scheduler, generator, expert, final):
+        return {
+            'job': job,
+            'step': step,
+            'final': final,
+            'expert': expert,
+            'latent': latent.detach().cpu(),
+            'scheduler': _map_tensors(
+                dict(vars(scheduler)), lambda t: t.detach().cpu()),
+            'generator': generator.get_state(),
+        }
+
+    def restore(self, job, scheduler, generator, device):
+        r"""
+        Restores the scheduler and the generator of a saved run of `job`.
+
+        Args:
+            job (`dict`):
+                Sampling arguments identifying the run.
+            scheduler:
+                The sampling scheduler, after `set_timesteps`.
+            generator (`torch.Generator`):
+                The sampling generator.
+            device (`torch.device`):
+                Device of the sampling.
+
+        Returns:
+            `tuple[int, torch.Tensor]` or None:
+                Number of steps done and the latent after them, or None if
+                there is no snapshot of `job`.
+        """
+        if not os.path.exists(self.path):
+            return None
+        state = torch.load(self.path, map_location='cpu', weights_only=False)
+        return self._resume(state, self.path, job, scheduler, generator,
+                            device)
+
+    @staticmethod
+    def _resume(state, source, job, scheduler, generator, device):
+        if state['job'] != job:
+            logging.warning(
+                f'{source} is a snapshot of another job, sampling starts over.')
+            return None
+
+        current = vars(scheduler)
+        for name, value in state['scheduler'].items():
+            # keep tensors where the scheduler keeps them, e.g. CPU sigmas
+            target = current[name].device if isinstance(
+                current.get(name), torch.Tensor) else device
+            current[name] = _map_tensors(value, lambda t: t.to(target))
+        generator.set_state(state['generator'])
+
+        if state['final']:
+            logging.info(f'Resuming from the final latent in {source}.')
+        else:
+            expert = '' if state['expert'] is None else \
+                f' with the {state["expert"]} expert'
+            logging.info(f'Resuming sampling at step {state["step"]}{expert} '
+                         f'from {source}.')
+        return state['step'], state['latent'].to(device)
+
+    def clear(self):
+        """
+        Removes the snapshot, once its video is saved.
+        """
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class SamplingInterrupted(Exception):
+    """
+    Raised out of the sampling loop of a `PreemptibleSampling` run that is
+    suspended, or cancelled if `cancelled` is set.
+    """
+
+    def __init__(self, cancelled=False):
+        super().__init__('cancelled' if cancelled else 'suspended')
+        self.cancelled = cancelled
+
+
+class PreemptibleSampling(SamplingCheckpoint):
+    r"""
+    Sampling state kept in host memory, so a run can be suspended between
+    two steps and resumed later, e.g. to let a more urgent job use the
+    device in between.
+
+    After every step `poll()` is called. If it returns 'suspend', the state
+    of the run is copied to host memory and `SamplingInterrupted` leaves the
+    sampling loop; the next `generate` call of the same job with this object
+    resumes from it. If it returns 'cancel', the loop is left without any
+    state. Passed as the `sampling_checkpoint` of a pipeline, so the runs
+    that support one are preemptible.
+
+    Args:
+        poll (`callable`):
+            Returns None to go on, 'suspend' or 'cancel'.
+        path (`str`, *optional*, defaults to None):
+            If given, snapshots are also saved to this file as by
+            `SamplingCheckpoint`.
+        interval (`int`, *optional*, defaults to 5):
+            Sampling steps between two snapshots to `path`.
+    """
+
+    def __init__(self, poll, path=None, interval=5):
+        assert interval > 0, 'the checkpoint interval must be positive'
+        self.poll = poll
+        self.path = path
+        self.interval = interval
+        self.state = None
+
+    def save(self,
+             job,
+             step,
+             latent,
+             scheduler,
+             generator,
+             expert=None,
+             final=False):
+        if self.path is not None:
+            super().save(job, step, latent, scheduler, generator, expert,
+                         final)
+        if final:
+            return
+        action = self.poll()
+        if action == 'cancel':
+            raise SamplingInterrupted(cancelled=True)
+        if action == 'suspend':
+            self.state = self._snapshot(job, step, latent, scheduler,
+                                        generator, expert, final)
+            raise SamplingInterrupted()
+
+    def restore(self, job, scheduler, generator, device):
+        if self.state is not None:
+            state, self.state = self.state, None
+            return self._resume(state, 'host memory', job, scheduler,
+                                generator, device)
+        if self.path is not None:
+            return super().restore(job, scheduler, generator, device)
+        return None
+
+    def clear(self):
+        self.state = None
+        if self.path is not None:
+            super().clear()
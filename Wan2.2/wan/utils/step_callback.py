@@ -0,0 +1,154 @@
+# Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import time
+
+import torch
+import torch.distributed as dist
+
+from .preview import flow_x0
+from .sampling_checkpoint import SamplingInterrupted
+
+__all__ = ['StepInfo', 'StepReporter']
+
+
+class StepInfo:
+    r"""
+    Progress of one sampling step, passed to the `step_callback` of the
+    pipelines.
+
+    Attributes:
+        step (`int`):
+            Number of steps taken, counting this one.
+        num_steps (`int`):
+            Number of steps of the schedule, an upper bound for the adaptive
+            solver.
+        timestep (`float`):
+            Timestep of the step, in [0, num_train_timesteps].
+        expert (`str` or None):
+            'high_noise' or 'low_noise', the model of the A14B pipelines that
+            took the step. None for the single-model pipelines.
+        elapsed (`float`):
+            Seconds since the first step started.
+        clip (`int`):
+            Index of the clip of speech-to-video, 0 for the other pipelines.
+    """
+
+    def __init__(self, step, num_steps, timestep, expert, elapsed, clip,
+                 latent, noise_pred, num_train_timesteps, blend):
+        self.step = step
+        self.num_steps = num_steps
+        self.timestep = timestep
+        self.expert = expert
+        self.elapsed = elapsed
+        self.clip = clip
+        self._latent = latent
+        self._noise_pred = noise_pred
+        self._num_train_timesteps = num_train_timesteps
+        self._blend = blend
+        self._x0 = None
+
+    @property
+    def x0(self):
+        r"""
+        Clean-sample estimate of the step, [C, F, H, W], or [B, C, F, H, W]
+        for `generate_batch`. Computed on first access, so callbacks that do
+        not read it cost nothing.
+        """
+        if self._x0 is None:
+            self._x0 = flow_x0(self._latent, self._noise_pred, self.timestep,
+                               self._num_train_timesteps)
+            if self._blend is not None:
+                self._x0 = self._blend(self._x0)
+        return self._x0
+
+
+class StepReporter:
+    r"""
+    Calls a `step_callback` after every sampling step and relays its request
+    to stop early to all ranks.
+
+    The callback is called on rank 0 as `step_callback(info)` with a
+    `StepInfo`. A truthy return value stops sampling after the step, and the
+    pipeline decodes `info.x0` in place of the finished sample. A callback
+    that raises `SamplingInterrupted` with `cancelled` set cancels the run:
+    every rank raises it. Under torchrun the callback must be given on every
+    rank, since the ranks agree on stopping through a broadcast; it is only
+    called on rank 0.
+
+    Args:
+        step_callback (`callable`):
+            The callback.
+        num_steps (`int`):
+            Number of steps of the schedule.
+        num_train_timesteps (`int`):
+            Number of training timesteps of the model.
+        rank (`int`):
+            Rank of this process.
+        clip (`int`, *optional*, defaults to 0):
+            Index of the clip of speech-to-video.
+    """
+
+    def __init__(self,
+                 step_callback,
+                 num_steps,
+                 num_train_timesteps,
+                 rank,
+                 clip=0):
+        self.step_callback = step_callback
+        self.num_steps = num_steps
+        self.num_train_timesteps = num_train_timesteps
+        self.rank = rank
+        self.clip = clip
+        self.start = time.perf_counter()
+        self.x0 = None
+
+    def __call__(self, step, t, latent, noise_pred, expert=None, blend=None):
+        r"""
+        Reports a step, returns whether to stop. After a stop `self.x0` holds
+        the clean-sample estimate to finish with. Raises
+        `SamplingInterrupted` if the callback cancelled the run.
+
+        Args:
+            step (`int`):
+                Number of steps taken, counting this one.
+            t (`torch.Tensor` or `float`):
+                Timestep of the step.
+            latent (`torch.Tensor`):
+                Latent the step started from.
+            noise_pred (`torch.Tensor`):
+                Guided velocity prediction of the step.
+            expert (`str`, *optional*, defaults to None):
+                Model of the A14B pipelines that took the step.
+            blend (`callable`, *optional*, defaults to None):
+                Applied to the clean-sample estimate, e.g. to paste the
+                conditioning frames back.
+        """
+        # 0 goes on, 1 stops, 2 cancels
+        action = 0
+        info = None
+        if self.rank == 0:
+            if torch.cuda.is_available():
+                # the kernels of the step are queued asynchronously
+                torch.cuda.synchronize()
+            info = StepInfo(step, self.num_steps, float(t), expert,
+                            time.perf_counter() - self.start, self.clip,
+                            latent, noise_pred, self.num_train_timesteps,
+                            blend)
+            try:
+                action = int(bool(self.step_callback(info)))
+            except SamplingInterrupted as e:
+                if not e.cancelled:
+                    raise
+                action = 2
+        if dist.is_initialized() and dist.get_world_size() > 1:
+            flag = torch.tensor([action], device=latent.device)
+            dist.broadcast(flag, src=0)
+            action = flag.item()
+        if action == 2:
+            raise SamplingInterrupted(cancelled=True)
+        stop = action == 1
+        if stop:
+            self.x0 = info.x0 if info is not None else flow_x0(
+                latent, noise_pred, t, self.num_train_timesteps)
+            if info is None and blend is not None:
+                self.x0 = blend(self.x0)
+        return stop
@@ -11,7 +11,7 @@ import imageio
 import torch
 import torchvision
 
-__all__ = ['save_video', 'save_image', 'str2bool']
+__all__ = ['save_video', 'save_video_stream', 'save_image', 'str2bool']
 
 
 def rand_name(length=8, suffix=''):
@@ -116,8 +116,80 @@ def save_video(tensor,
         for frame in tensor.numpy():
             writer.append_data(frame)
         writer.close()
+        return cache_file
     except Exception as e:
-        logging.info(f'save_video failed, error: {e}')
+        logging.error(f'save_video failed, error: {e}')
+
+
+def save_video_stream(frames,
+                      save_file=None,
+                      fps=30,
+                      suffix='.mp4',
+                      value_range=(-1, 1)):
+    """
+    Like `save_video` for a single video, but consumes an iterable of frame
+    groups ([C, N, H, W], e.g. from `vae.decode_stream`) and encodes every
+    group as soon as it arrives.
+
+    Returns the path of the video, or None if writing it failed. Errors of
+    the iterable, e.g. of the decoder, are raised, as the video would be
+    truncated.
+    """
+    # cache file
+    cache_file = osp.join('/tmp', rand_name(
+        suffix=suffix)) if save_file is None else save_file
+
+    low, high = min(value_range), max(value_range)
+    try:
+        writer = imageio.get_writer(
+            cache_file, fps=fps, codec='libx264', quality=8)
+    except Exception as e:
+        logging.error(f'save_video_stream failed, error: {e}')
+        return None
+    saved = False
+    try:
+        for group in frames:
+            group = (group.clamp(low, high) - low) / (high - low)
+            group = (group.permute(1, 2, 3, 0) * 255).type(torch.uint8).cpu()
+            try:
+                for frame in group.numpy():
+                    writer.append_data(frame)
+            except Exception as e:
+                logging.error(f'save_video_stream failed, error: {e}')
+                return None
+        saved = True
+    finally:
+        try:
+            writer.close()
+        except Exception as e:
+            logging.error(f'save_video_stream failed, error: {e}')
+            saved = False
+    return cache_file if saved else None
+
+
+def load_video(video_path, frame_num, fps=None):
+    """
+    First `frame_num` frames of a video as a float tensor [3, F, H, W] in
+    [-1, 1], resampled to about `fps` frames per second if given.
+    """
+    reader = imageio.get_reader(video_path)
+    try:
+        interval = 1
+        if fps is not None:
+            original_fps = reader.get_meta_data().get('fps', fps)
+            interval = max(1, round(original_fps / fps))
+        frames = []
+        for i, frame in enumerate(reader):
+            if i % interval == 0:
+                frames.append(torch.from_numpy(frame[..., :3]))
+                if len(frames) == frame_num:
+                    break
+    finally:
+        reader.close()
+    assert len(frames) == frame_num, \
+        f'{video_path} has fewer than {frame_num} frames'
+    video = torch.stack(frames).permute(3, 0, 1, 2).float()
+    return video.div_(127.5).sub_(1)
 
 
 def save_image(tensor, save_file, nrow=8, normalize=True, value_range=(-1, 1)):
@@ -19,6 +19,7 @@ sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.
 
 from Wan2.2.wan.speech2video import WanS2V
 from Wan2.2.wan.configs.wan_s2v_14B import s2v_14B
+from Wan2.2.wan.utils.guidance import GuidanceInterval
 from Wan2.2.wan.utils.utils import save_video
 
 class S2VGenerator:
@@ -68,6 +69,13 @@ class S2VGenerator:
             num_repeat = int(params.get('num_repeat', 1))
             steps = int(params.get('steps', 40))
             guide_scale = float(params.get('guide_scale', 5.0))
+            # [start, end] of classifier-free guidance, guided everywhere if unset
+            guide_interval = params.get('guide_interval')
+            if guide_interval is not None:
+                guide_interval = GuidanceInterval(
+                    float(guide_interval[0]),
+                    float(guide_interval[1]),
+                    unit=params.get('guide_interval_unit', 'sigma'))
             seed = int(params.get('seed', -1))
             fps = int(params.get('fps', 16))
             
@@ -87,6 +95,7 @@ class S2VGenerator:
                 sample_solver='unipc',
                 sampling_steps=steps,
                 guide_scale=guide_scale,
+                guide_interval=guide_interval,
                 n_prompt=negative_prompt,
                 seed=seed,
                 offload_model=True,